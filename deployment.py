@@ -0,0 +1,284 @@
+import numpy as np
+import os
+import copy
+import time
+import inspect
+
+#torch
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.onnx
+
+# optional, only needed for verifying and benchmarking the ONNX export
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+from TonyWang_MasterThesis.functions_and_constants import *
+from TonyWang_MasterThesis.visualisation_and_evaluation import *
+from TonyWang_MasterThesis.models import *
+
+#################################################################
+############### TorchScript and ONNX Export #####################
+#################################################################
+
+def model_input_names(data_source):
+    '''
+    Description: Names of the model inputs in the exported graphs, matching the forward arguments of the models (model registry).
+    Input: Model or Data Source (String)
+    Output: List of Input Names
+    '''
+    return [model_input.name for model_input in model_input_spec(data_source)]
+
+def export_torchscript(model, example_inputs, path):
+    '''
+    Description: Exports a model to TorchScript by tracing it on CPU. The traced model can be loaded with torch.jit.load (also from
+    C++ via libtorch) without the model classes.
+    Input: Model, Example Inputs (Tuple of Torch Tensors), File Path
+    Output: Traced Model
+    '''
+    model = copy.deepcopy(model).to('cpu').eval()
+    example_inputs = tuple(x.to('cpu') for x in example_inputs)
+
+    with torch.no_grad():
+        traced_model = torch.jit.trace(model, example_inputs)
+    torch.jit.save(traced_model, path)
+
+    return traced_model
+
+def export_onnx(model, example_inputs, data_source, path, opset_version=17):
+    '''
+    Description: Exports a single input (x) or dual input (x_rgb, x_hsi) model to ONNX. Batch size, height and width are dynamic
+    axes, so the exported graph accepts any batch size and any spatial size the model itself accepts. The TorchScript based
+    exporter is used, newer PyTorch versions default to the dynamo exporter, which needs onnxscript and ignores dynamic_axes.
+    Input: Model, Example Inputs (Tuple of Torch Tensors), Data Source (String), File Path, ONNX Opset Version
+    '''
+    model = copy.deepcopy(model).to('cpu').eval()
+    example_inputs = tuple(x.to('cpu') for x in example_inputs)
+
+    input_names = model_input_names(data_source)
+    dynamic_axes = {name: {0: 'batch', 2: 'height', 3: 'width'} for name in input_names + ['logits']}
+
+    # the dynamo argument only exists since PyTorch 2.5
+    exporter = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+    with torch.no_grad():
+        torch.onnx.export(model, example_inputs, path, input_names=input_names, output_names=['logits'],
+                          dynamic_axes=dynamic_axes, opset_version=opset_version, **exporter)
+
+def onnx_session(path, num_threads=None):
+    '''
+    Description: Creates an ONNX Runtime session on the CPU.
+    Input: File Path, Number of Intra Op Threads (None for the ONNX Runtime default)
+    Output: ONNX Runtime Inference Session
+    '''
+    if ort is None:
+        raise ImportError('onnxruntime is required for running ONNX models: pip install onnxruntime')
+
+    options = ort.SessionOptions()
+    if num_threads is not None:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+def verify_exported_model(model, traced_model, session, test_inputs, data_source, atol=1e-4, rtol=1e-3):
+    '''
+    Description: Compares the outputs of the TorchScript and ONNX export with the PyTorch model on the CPU for a list of inputs,
+    which should cover different batch and spatial sizes to check the dynamic axes as well.
+    Input: Model, Traced Model, ONNX Runtime Session, List of Model Inputs (Tuples of Torch Tensors), Data Source (String),
+    Absolute and Relative Tolerance
+    Output: Bool (True if all outputs are within tolerance), List of Max Absolute Errors per Input (TorchScript, ONNX)
+    '''
+    model = copy.deepcopy(model).to('cpu').eval()
+    input_names = model_input_names(data_source)
+
+    all_close = True
+    errors = []
+    with torch.no_grad():
+        for model_inputs in test_inputs:
+            model_inputs = tuple(x.to('cpu').float() for x in model_inputs)
+            reference = model(*model_inputs)
+
+            traced_output = traced_model(*model_inputs)
+            onnx_output = torch.from_numpy(session.run(['logits'], {name: x.numpy() for name, x in zip(input_names, model_inputs)})[0])
+
+            traced_close = torch.allclose(traced_output, reference, atol=atol, rtol=rtol)
+            onnx_close = torch.allclose(onnx_output, reference, atol=atol, rtol=rtol)
+            all_close = all_close and traced_close and onnx_close
+
+            traced_error = (traced_output - reference).abs().max().item()
+            onnx_error = (onnx_output - reference).abs().max().item()
+            errors.append((traced_error, onnx_error))
+
+            print(f'Input {tuple(model_inputs[0].shape)}: TorchScript max error {traced_error:.2e} ({"ok" if traced_close else "FAILED"}), '
+                  f'ONNX max error {onnx_error:.2e} ({"ok" if onnx_close else "FAILED"})')
+
+    return all_close, errors
+
+def measure_onnx_latency(session, model_inputs, data_source, n_warmup=3, n_runs=10):
+    '''
+    Description: Measures the average latency of a single run of an ONNX Runtime session.
+    Input: ONNX Runtime Session, Model Inputs (Tuple of Torch Tensors), Data Source (String), Number of Warm Up and Timed Runs
+    Output: Average Latency per Run in Seconds
+    '''
+    feed = {name: x.to('cpu').float().numpy() for name, x in zip(model_input_names(data_source), model_inputs)}
+
+    for _ in range(n_warmup):
+        session.run(['logits'], feed)
+
+    start_time = time.perf_counter()
+    for _ in range(n_runs):
+        session.run(['logits'], feed)
+    end_time = time.perf_counter()
+
+    return (end_time - start_time) / n_runs
+
+def export_and_verify_model(model, dataset, data_source, export_dir, model_name, atol=1e-4, rtol=1e-3, n_runs=10):
+    '''
+    Description: Complete export pipeline. Exports a model to TorchScript and ONNX, verifies both against PyTorch on a full frame,
+    a batch of two and a different spatial size, and benchmarks PyTorch, TorchScript and ONNX Runtime on the CPU.
+    Input: Trained Model, Dataset without Augmentation, Data Source (String), Export Directory, Model Name, Tolerances,
+    Number of Timed Runs
+    Output: Dictionary with the File Paths, Verification Result and CPU Latencies
+    '''
+    os.makedirs(export_dir, exist_ok=True)
+    torchscript_path = os.path.join(export_dir, f'{model_name}.pt')
+    onnx_path = os.path.join(export_dir, f'{model_name}.onnx')
+
+    model = copy.deepcopy(model).to('cpu').eval()
+
+    rgb_img, hsi_img, _ = dataset[0]
+    frame_inputs = select_model_inputs(rgb_img.unsqueeze(0), hsi_img.unsqueeze(0), data_source, device='cpu')
+    batch_inputs = tuple(torch.cat([x, x], dim=0) for x in frame_inputs)
+    # half size crop, rounded to a multiple of 32 so every model accepts it
+    height, width = frame_inputs[0].shape[2] // 64 * 32, frame_inputs[0].shape[3] // 64 * 32
+    crop_inputs = tuple(x[:, :, :height, :width] for x in frame_inputs)
+
+    traced_model = export_torchscript(model, frame_inputs, torchscript_path)
+    export_onnx(model, frame_inputs, data_source, onnx_path)
+    session = onnx_session(onnx_path)
+
+    verified, errors = verify_exported_model(model, traced_model, session, [frame_inputs, batch_inputs, crop_inputs], data_source,
+                                             atol=atol, rtol=rtol)
+
+    latency = {'pytorch': measure_model_latency(model, frame_inputs, n_runs=n_runs),
+               'torchscript': measure_model_latency(traced_model, frame_inputs, n_runs=n_runs),
+               'onnxruntime': measure_onnx_latency(session, frame_inputs, data_source, n_runs=n_runs)}
+
+    print(f'Verification: {"passed" if verified else "FAILED"}')
+    for runtime, value in latency.items():
+        print(f'CPU Latency per Frame {runtime}: {value*1000:.1f}ms')
+
+    return {'torchscript_path': torchscript_path, 'onnx_path': onnx_path, 'verified': verified, 'errors': errors, 'latency': latency}
+
+#################################################################
+############### Channels Last CPU Execution #####################
+#################################################################
+
+def configure_cpu_threads(num_threads=None, num_interop_threads=None, pin_threads=True):
+    '''
+    Description: Thread and affinity settings for CPU inference boxes. Sets the number of intra op threads (default: number of
+    cores available to the process) and inter op threads, and pins the process to that many cores, so the oneDNN threads do
+    not migrate between cores. The number of inter op threads can only be set before the first parallel work in the process.
+    Input: Number of Intra Op Threads, Number of Inter Op Threads, Pin Threads Option (Bool)
+    Output: Dictionary with the applied Settings
+    '''
+    available_cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    if num_threads is None:
+        num_threads = len(available_cores)
+
+    torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            print('Inter op threads can only be set before any parallel work, keeping', torch.get_num_interop_threads())
+
+    if pin_threads and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, available_cores[:num_threads])
+
+    settings = {'num_threads': torch.get_num_threads(), 'num_interop_threads': torch.get_num_interop_threads(),
+                'cores': sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None,
+                'mkldnn': torch.backends.mkldnn.is_available() and torch.backends.mkldnn.enabled}
+    print(f'CPU Threads: {settings["num_threads"]} intra op, {settings["num_interop_threads"]} inter op, oneDNN: {settings["mkldnn"]}')
+    return settings
+
+class channels_last_model(nn.Module):
+    '''
+    Description: Runs a model in channels last (NHWC) memory format, which is the faster layout for the oneDNN convolutions on
+    the CPU. The weights are converted once and the inputs on every call, the activations (including the torch.cat of the skip
+    connections, as all inputs of the concatenation are channels last) stay in that layout throughout the UNet.
+    '''
+    def __init__(self, model):
+        super(channels_last_model, self).__init__()
+        self.model = model.to(memory_format=torch.channels_last)
+
+    def forward(self, *model_inputs):
+        model_inputs = [x.contiguous(memory_format=torch.channels_last) if x is not None and x.dim() == 4 else x for x in model_inputs]
+        return self.model(*model_inputs)
+
+def cpu_inference_model(model, example_inputs, channels_last=True, freeze=True):
+    '''
+    Description: Prepares a model for CPU inference: eval mode, optionally channels last and optionally traced and frozen with
+    TorchScript, which folds BatchNorm into the convolutions and lets oneDNN pick its preferred weight layout.
+    Input: Model, Example Inputs (Tuple of Torch Tensors), Channels Last Option, Freeze Option
+    Output: CPU Inference Model
+    '''
+    model = copy.deepcopy(model).to('cpu').eval()
+    example_inputs = tuple(x.to('cpu').float() for x in example_inputs)
+
+    if channels_last:
+        model = channels_last_model(model)
+        example_inputs = tuple(x.contiguous(memory_format=torch.channels_last) if x.dim() == 4 else x for x in example_inputs)
+
+    if freeze:
+        with torch.no_grad():
+            model = torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.trace(model, example_inputs).eval()))
+
+    return model
+
+def benchmark_cpu_execution_modes(model, model_inputs, num_threads=None, n_runs=10, atol=1e-4, rtol=1e-3, pin_threads=False):
+    '''
+    Description: Benchmarks a model on the CPU in NCHW and channels last, eager and frozen TorchScript, after applying the
+    thread settings. The outputs of all modes are checked against the NCHW eager model. The number of threads and the core
+    affinity of the process are restored afterwards, so later training or data loader workers are not pinned.
+    Input: Model, Model Inputs (Tuple of Torch Tensors), Number of Threads, Number of Timed Runs, Absolute and Relative Tolerance,
+    Pin Threads Option (Bool)
+    Output: Dictionary of Mode -> Dictionary with Latency, Speedup over NCHW and Max Absolute Error
+    '''
+    previous_num_threads = torch.get_num_threads()
+    previous_cores = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else None
+    try:
+        configure_cpu_threads(num_threads, pin_threads=pin_threads)
+        return _benchmark_cpu_execution_modes(model, model_inputs, n_runs, atol, rtol)
+    finally:
+        torch.set_num_threads(previous_num_threads)
+        if previous_cores is not None:
+            os.sched_setaffinity(0, previous_cores)
+
+def _benchmark_cpu_execution_modes(model, model_inputs, n_runs, atol, rtol):
+    model_inputs = tuple(x.to('cpu').float() for x in model_inputs)
+
+    modes = {'nchw': cpu_inference_model(model, model_inputs, channels_last=False, freeze=False),
+             'nchw_frozen': cpu_inference_model(model, model_inputs, channels_last=False, freeze=True),
+             'channels_last': cpu_inference_model(model, model_inputs, channels_last=True, freeze=False),
+             'channels_last_frozen': cpu_inference_model(model, model_inputs, channels_last=True, freeze=True)}
+
+    with torch.no_grad():
+        reference = modes['nchw'](*model_inputs)
+
+    report = {}
+    print(f'{"Mode":<24}{"Latency":>11}{"Speedup":>9}{"Max Error":>11}')
+    for mode, mode_model in modes.items():
+        with torch.no_grad():
+            output = mode_model(*model_inputs)
+        latency = measure_model_latency(mode_model, model_inputs, n_runs=n_runs)
+        report[mode] = {'latency': latency,
+                        'speedup': report['nchw']['latency'] / latency if report else 1.0,
+                        'max_error': (output - reference).abs().max().item(),
+                        'close': torch.allclose(output, reference, atol=atol, rtol=rtol)}
+        print(f'{mode:<24}{latency*1000:>9.1f}ms{report[mode]["speedup"]:>8.2f}x{report[mode]["max_error"]:>11.2e}'
+              f'{"" if report[mode]["close"] else " (FAILED)"}')
+
+    return report
@@ -0,0 +1,204 @@
+import os
+import argparse
+import json
+
+#torch
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.optim import Adam
+from torch.utils.data import DataLoader, Sampler
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+from TonyWang_MasterThesis.functions_and_constants import *
+from TonyWang_MasterThesis.functions_and_constants import _WH_RGB_HSI_Dataset
+from TonyWang_MasterThesis.models import *
+
+#################################################################
+############### Distributed Data Parallel Training ##############
+#################################################################
+
+def setup_distributed(backend=None):
+    '''
+    Description: Joins the process group of a distributed training. Rank, world size and local rank are read from the
+    environment variables set by torchrun (or launch_distributed). The backend is nccl on GPUs and gloo on CPU only machines,
+    each process uses the GPU of its local rank.
+    Input: Backend (String, None for automatic choice)
+    Output: Rank, World Size, Device
+    '''
+    rank = int(os.environ.get('RANK', 0))
+    n_processes = int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cpu')
+
+    dist.init_process_group(backend=backend, rank=rank, world_size=n_processes)
+    return rank, n_processes, device
+
+def cleanup_distributed():
+    '''
+    Description: Leaves the process group at the end of the training.
+    '''
+    if is_distributed():
+        dist.destroy_process_group()
+
+def distributed_data_loader(dataset, batch_size, shuffle=True, num_workers=2, drop_last=False, seed=0, persistent_workers=True):
+    '''
+    Description: Data loader for distributed training, every process gets a different shard of the dataset (DistributedSampler).
+    The shards are padded to the same length, so all processes run the same number of steps. train_model reshuffles the shards
+    every epoch with set_epoch. For an exact resume with workers pass persistent_workers=False (see create_data_loader).
+    Input: Dataset (e.g. _WH_RGB_HSI_Dataset), Batch Size per Process, Shuffle Option, Number of Workers, Drop Last Option, Seed,
+    Persistent Workers Option
+    Output: Data Loader
+    '''
+    sampler = DistributedSampler(dataset, shuffle=shuffle, seed=seed, drop_last=drop_last)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers, drop_last=drop_last,
+                      pin_memory=torch.cuda.is_available(), persistent_workers=persistent_workers and num_workers > 0,
+                      worker_init_fn=seed_transforms_worker)
+
+class ShardSampler(Sampler):
+    '''
+    Description: Sampler for distributed evaluation, every process gets every num_replicas-th sample (starting at its rank) in
+    a fixed order. Unlike DistributedSampler the shards are not padded with repeated samples, so every sample is evaluated
+    exactly once and the all-reduced loss and confusion matrix are exact. The shards can differ by one sample.
+    Input: Dataset, Rank (None for the rank of the process), Number of Processes (None for the size of the process group)
+    '''
+    def __init__(self, dataset, rank=None, num_replicas=None):
+        self.n_samples = len(dataset)
+        self.rank = rank if rank is not None else (dist.get_rank() if is_distributed() else 0)
+        self.num_replicas = num_replicas if num_replicas is not None else world_size()
+
+    def __iter__(self):
+        return iter(range(self.rank, self.n_samples, self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, self.n_samples, self.num_replicas))
+
+def distributed_eval_data_loader(dataset, batch_size, num_workers=2):
+    '''
+    Description: Data loader for distributed validation/testing, every process gets an unpadded shard of the dataset
+    (ShardSampler), so no sample is counted twice.
+    Input: Dataset (e.g. _WH_RGB_HSI_Dataset), Batch Size per Process, Number of Workers
+    Output: Data Loader
+    '''
+    return DataLoader(dataset, batch_size=batch_size, sampler=ShardSampler(dataset), num_workers=num_workers,
+                      pin_memory=torch.cuda.is_available(), persistent_workers=num_workers > 0)
+
+def distributed_model(model, device, sync_batchnorm=False, find_unused_parameters=False):
+    '''
+    Description: Wraps any model of models.py in DistributedDataParallel, which all-reduces the gradients during the backward
+    pass. The model inputs are still found in the model registry through the module attribute. With sync_batchnorm the
+    BatchNorm statistics are calculated over the batches of all processes (GPU only). find_unused_parameters is needed if
+    parameters of a model are not used in the forward pass, e.g. deconv_bridge_2 of unet_model_gelu_feature_level_fusion or
+    the HSI branch of the fusion models with x_hsi=None.
+    Input: Model, Device, SyncBatchNorm Option, Find Unused Parameters Option
+    Output: DistributedDataParallel Model
+    '''
+    if sync_batchnorm:
+        model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    model = model.to(device)
+    device_ids = [device.index] if device.type == 'cuda' else None
+    return DDP(model, device_ids=device_ids, find_unused_parameters=find_unused_parameters)
+
+def _distributed_worker(local_rank, n_processes, train_fn, args, master_port):
+    os.environ['RANK'] = str(local_rank)
+    os.environ['LOCAL_RANK'] = str(local_rank)
+    os.environ['WORLD_SIZE'] = str(n_processes)
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(master_port))
+
+    _, _, device = setup_distributed()
+    try:
+        train_fn(device, *args)
+    finally:
+        cleanup_distributed()
+
+def launch_distributed(train_fn, n_processes, *args, master_port=29500):
+    '''
+    Description: Launcher for single node training, starts n_processes processes which call train_fn(device, *args) inside
+    the process group. For several nodes start the training script with torchrun on every node instead and call
+    setup_distributed in the script.
+    Input: Training Function (module level function of device and args), Number of Processes, Arguments, Master Port
+    '''
+    mp.spawn(_distributed_worker, args=(n_processes, train_fn, args, master_port), nprocs=n_processes, join=True)
+
+#################################################################
+############### Command Line Entry Point ########################
+#################################################################
+
+def train_registered_model(device, args):
+    '''
+    Description: Trains a registered model (MODEL_REGISTRY) with CE and Dice Loss on the RGB/HSI dataset inside a process
+    group. Used by the command line entry point.
+    Input: Device, Parsed Command Line Arguments
+    '''
+    model = MODEL_REGISTRY[args.model](**json.loads(args.model_kwargs))
+    model = distributed_model(model, device, sync_batchnorm=args.sync_batchnorm, find_unused_parameters=args.find_unused_parameters)
+
+    train_dataset = _WH_RGB_HSI_Dataset(*args.train_dirs, transform=sf_transformation, hsi_scale=args.hsi_scale)
+    val_dataset = _WH_RGB_HSI_Dataset(*args.val_dirs, transform=sf_no_transformation, hsi_scale=args.hsi_scale)
+    # a resumable training restarts the workers every epoch, seed_transforms_worker then seeds their augmentations from the
+    # torch RNG, which is saved in the checkpoints
+    train_loader = distributed_data_loader(train_dataset, args.batch_size, shuffle=True, num_workers=args.num_workers,
+                                           persistent_workers=not args.save_last)
+    val_loader = distributed_eval_data_loader(val_dataset, args.batch_size, num_workers=args.num_workers)
+
+    loss_fn = CombinedLoss(nn.CrossEntropyLoss(), DiceLoss(n_classes=N_CLASSES))
+    optimizer = Adam(model.parameters(), lr=args.learning_rate, weight_decay=0.0001)
+
+    train_model(model, train_loader, val_loader, args.num_epochs, loss_fn, optimizer, patience=args.patience,
+                model_name=args.model_name, save_state=args.save_state, plot_loss=False,
+                accumulation_steps=args.accumulation_steps, early_stopping_metric=args.early_stopping_metric,
+                save_last=args.save_last, resume_from=args.resume_from, metrics_path=args.metrics_path)
+
+def main(argv=None):
+    '''
+    Description: Command line entry point for distributed training, e.g.
+    python -m TonyWang_MasterThesis.distributed_training --n_processes 2 --model unet_model_gelu --model_kwargs '{"out_channels": 10}'
+    --train_dirs rgb_train hsi_train mask_train --val_dirs rgb_val hsi_val mask_val
+    Started by torchrun (RANK is set) the process joins the existing process group, otherwise n_processes processes are started.
+    '''
+    parser = argparse.ArgumentParser(description='Distributed data parallel training of a registered model')
+    parser.add_argument('--model', required=True, choices=sorted(MODEL_REGISTRY))
+    parser.add_argument('--model_kwargs', default='{}', help='keyword arguments of the model as JSON')
+    parser.add_argument('--train_dirs', nargs=3, required=True, metavar=('RGB_DIR', 'HSI_DIR', 'MASK_DIR'))
+    parser.add_argument('--val_dirs', nargs=3, required=True, metavar=('RGB_DIR', 'HSI_DIR', 'MASK_DIR'))
+    parser.add_argument('--n_processes', type=int, default=max(torch.cuda.device_count(), 1))
+    parser.add_argument('--num_epochs', type=int, default=100)
+    parser.add_argument('--batch_size', type=int, default=12, help='batch size per process')
+    parser.add_argument('--accumulation_steps', type=int, default=1)
+    parser.add_argument('--learning_rate', type=float, default=0.00037)
+    parser.add_argument('--patience', type=int, default=15)
+    parser.add_argument('--early_stopping_metric', default='val_loss')
+    parser.add_argument('--hsi_scale', type=int, default=1)
+    parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--model_name', default='')
+    parser.add_argument('--save_state', action='store_true')
+    parser.add_argument('--save_last', action='store_true', help='checkpoint after every epoch to resume from')
+    parser.add_argument('--resume_from', default=None, help='checkpoint to resume an interrupted training from')
+    parser.add_argument('--metrics_path', default=None, help='JSONL file the training metrics are appended to')
+    parser.add_argument('--sync_batchnorm', action='store_true')
+    parser.add_argument('--find_unused_parameters', action='store_true', help='needed for unet_model_gelu_feature_level_fusion')
+    parser.add_argument('--master_port', type=int, default=29500)
+    args = parser.parse_args(argv)
+
+    if 'RANK' in os.environ:
+        _, _, device = setup_distributed()
+        try:
+            train_registered_model(device, args)
+        finally:
+            cleanup_distributed()
+    else:
+        launch_distributed(train_registered_model, args.n_processes, args, master_port=args.master_port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,552 @@
+import numpy as np
+import os
+import copy
+import time
+import matplotlib.pyplot as plt
+
+#torch
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from TonyWang_MasterThesis.functions_and_constants import *
+from TonyWang_MasterThesis.visualisation_and_evaluation import *
+from TonyWang_MasterThesis.models import *
+from TonyWang_MasterThesis.model_compression import *
+
+# classes 0 - 2 are background, chicken_front and chicken_back, everything above is a defect
+FIRST_DEFECT_CLASS = 3
+
+#######################################################################
+############### Cascaded Inference ####################################
+#######################################################################
+
+def defect_probability(logits):
+    '''
+    Description: Probability that a pixel belongs to any defect class, i.e. the summed softmax of all defect classes.
+    Input: Logits (Torch Tensor, batch x classes x height x width)
+    Output: Defect Probability (Torch Tensor, batch x height x width)
+    '''
+    return F.softmax(logits.float(), dim=1)[:, FIRST_DEFECT_CLASS:].sum(dim=1)
+
+def image_to_tiles(x, tile_size):
+    '''
+    Description: Splits a batch of images into non overlapping square tiles. Height and width have to be divisible by the tile size.
+    Input: Images (Torch Tensor, batch x channels x height x width), Tile Size
+    Output: Tiles (Torch Tensor, batch * tiles_h * tiles_w x channels x tile_size x tile_size)
+    '''
+    b, c, h, w = x.shape
+    x = x.reshape(b, c, h // tile_size, tile_size, w // tile_size, tile_size)
+    return x.permute(0, 2, 4, 1, 3, 5).reshape(-1, c, tile_size, tile_size)
+
+def tiles_to_image(tiles, batch_size, height, width):
+    '''
+    Description: Inverse of image_to_tiles.
+    Input: Tiles (Torch Tensor, batch * tiles_h * tiles_w x channels x tile_size x tile_size), Batch Size, Height, Width
+    Output: Images (Torch Tensor, batch x channels x height x width)
+    '''
+    tile_size, c = tiles.shape[-1], tiles.shape[1]
+    tiles = tiles.reshape(batch_size, height // tile_size, width // tile_size, c, tile_size, tile_size)
+    return tiles.permute(0, 3, 1, 4, 2, 5).reshape(batch_size, c, height, width)
+
+@register_model(FUSION_INPUTS[0], FUSION_INPUTS[1]._replace(device='cpu'))
+class cascade_model(nn.Module):
+    '''
+    Description: Two stage cascade for the production line. A cheap RGB model (unet_model_gelu or a distilled student) runs on
+    every frame first. Only frames (tile_size=None) or tiles, in which the defect probability of any pixel reaches the threshold,
+    are passed on to the sensor fusion model and their logits are replaced by the fusion logits. Since most fillets are defect
+    free, the mean latency per frame scales with the defect rate instead of the line rate. The HSI image is only moved to the
+    device of the RGB image for escalated frames/tiles, so its input is registered on the CPU and select_model_inputs leaves it
+    there. In tile mode the tile size has to divide the image size and has to be a multiple of 16, and the fusion model only
+    sees the tile as context.
+    Counts of processed and escalated frames/tiles are kept in n_regions and n_escalated (reset with reset_statistics).
+    '''
+    def __init__(self, rgb_model, fusion_model, threshold=0.5, tile_size=None):
+        super(cascade_model, self).__init__()
+        self.rgb_model = rgb_model
+        self.fusion_model = fusion_model
+        self.threshold = threshold
+        self.tile_size = tile_size
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.n_regions = 0
+        self.n_escalated = 0
+
+    @property
+    def escalation_rate(self):
+        return self.n_escalated / max(self.n_regions, 1)
+
+    def region_scores(self, rgb_logits):
+        '''
+        Description: Highest defect probability of each frame (batch x 1 x 1) or tile (batch x tiles_h x tiles_w).
+        '''
+        prob = defect_probability(rgb_logits)
+        if self.tile_size is None:
+            return prob.amax(dim=(1,2)).reshape(-1, 1, 1)
+        return F.max_pool2d(prob.unsqueeze(1), self.tile_size).squeeze(1)
+
+    def fusion_logits(self, rgb_logits, x_rgb, x_hsi, escalate):
+        '''
+        Description: Runs the fusion model on the escalated frames/tiles and writes its logits into the RGB logits.
+        Input: RGB Logits, RGB Image, HSI Image, Escalation Mask (Bool Torch Tensor, shape of the region scores)
+        Output: Cascade Logits
+        '''
+        logits = rgb_logits.clone()
+        if not escalate.any():
+            return logits
+
+        if self.tile_size is None:
+            idx = escalate.flatten().nonzero().squeeze(1)
+            logits[idx] = self.fusion_model(x_rgb[idx], x_hsi[idx.to(x_hsi.device)].to(x_rgb.device).float()).to(logits.dtype)
+            return logits
+
+        b, _, h, w = x_rgb.shape
+        if h % self.tile_size or w % self.tile_size:
+            raise ValueError(f'Image size {h}x{w} is not divisible by the tile size {self.tile_size}')
+
+        idx = escalate.flatten().nonzero().squeeze(1)
+        rgb_tiles = image_to_tiles(x_rgb, self.tile_size)[idx]
+        hsi_tiles = image_to_tiles(x_hsi, self.tile_size)[idx.to(x_hsi.device)].to(x_rgb.device).float()
+
+        logit_tiles = image_to_tiles(logits, self.tile_size)
+        logit_tiles[idx] = self.fusion_model(rgb_tiles, hsi_tiles).to(logits.dtype)
+        return tiles_to_image(logit_tiles, b, h, w)
+
+    def forward(self, x_rgb, x_hsi):
+        rgb_logits = self.rgb_model(x_rgb)
+        escalate = self.region_scores(rgb_logits) >= self.threshold
+
+        self.n_regions += escalate.numel()
+        self.n_escalated += int(escalate.sum())
+
+        return self.fusion_logits(rgb_logits, x_rgb, x_hsi, escalate)
+
+def calibrate_cascade(cascade, test_dataset, thresholds=(0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 0.9), num_images=None, n_runs=10,
+                      visualize=True, file_name=''):
+    '''
+    Description: Calibration tool for the threshold of a cascade_model. Both stages are run once per test image (the fusion model
+    on all frames/tiles), afterwards the cascade output is put together for every threshold. For each threshold the escalation
+    rate, the defect recall (share of ground truth defect pixels inside escalated frames/tiles), the share of defect frames that
+    are escalated, the defect IoU and the estimated latency per frame (RGB latency + escalation rate * fusion latency, measured on
+    a full frame) are reported, next to the RGB only and fusion only model.
+    Input: Cascade Model, Test Dataset without Augmentation, List of Thresholds, Number of Images (None for entire Dataset),
+    Number of Timed Runs, Visualisation Option, File Name for the Plot
+    Output: List of Dictionaries (one per Threshold, plus 'rgb_only' and 'fusion_only')
+    '''
+    if num_images is None:
+        num_images = len(test_dataset)
+
+    cascade = cascade.to(DEVICE).eval()
+    thresholds = list(thresholds)
+    n_settings = len(thresholds) + 2
+
+    intersection = np.zeros((n_settings, N_CLASSES))
+    union = np.zeros((n_settings, N_CLASSES))
+    escalated_regions = np.zeros(n_settings)
+    recalled_defect_pixels = np.zeros(n_settings)
+    escalated_defect_frames = np.zeros(n_settings)
+    n_regions, n_defect_pixels, n_defect_frames = 0, 0, 0
+
+    with torch.no_grad():
+        for n in tqdm(range(num_images), total=num_images):
+            rgb_img, hsi_img, mask = test_dataset[n]
+            x_rgb, x_hsi = select_model_inputs(rgb_img.unsqueeze(0), hsi_img.unsqueeze(0), cascade)
+
+            rgb_logits = cascade.rgb_model(x_rgb)
+            scores = cascade.region_scores(rgb_logits)
+            fusion_pred = torch.argmax(cascade.fusion_logits(rgb_logits, x_rgb, x_hsi, torch.ones_like(scores, dtype=torch.bool)), dim=1)
+            rgb_pred = torch.argmax(rgb_logits, dim=1)
+
+            defect_pixels = (mask >= FIRST_DEFECT_CLASS).to(DEVICE)
+            n_regions += scores.numel()
+            n_defect_pixels += int(defect_pixels.sum())
+            n_defect_frames += int(defect_pixels.any())
+
+            # last two settings are the RGB only (never escalate) and fusion only (always escalate) model
+            for i, threshold in enumerate(thresholds + [float('inf'), float('-inf')]):
+                escalate = scores >= threshold
+                if cascade.tile_size is None:
+                    escalate_pixels = escalate.expand(-1, *mask.shape)
+                else:
+                    escalate_pixels = escalate.repeat_interleave(cascade.tile_size, dim=1).repeat_interleave(cascade.tile_size, dim=2)
+
+                pred = torch.where(escalate_pixels, fusion_pred, rgb_pred).to('cpu')
+                is_list, u_list = intersection_and_union_all_classes(mask, pred, SINGLE_PREDICTION=True)
+                intersection[i] += is_list
+                union[i] += u_list
+
+                escalated_regions[i] += int(escalate.sum())
+                recalled_defect_pixels[i] += int((defect_pixels & escalate_pixels.squeeze(0)).sum())
+                escalated_defect_frames[i] += int(defect_pixels.any() and escalate.any())
+
+    model_inputs = select_model_inputs(rgb_img.unsqueeze(0), hsi_img.unsqueeze(0), 'sf')
+    rgb_latency = measure_model_latency(cascade.rgb_model, model_inputs[:1], n_runs=n_runs)
+    fusion_latency = measure_model_latency(cascade.fusion_model, model_inputs, n_runs=n_runs)
+
+    report = []
+    print(f'{"Threshold":<12}{"Escalated":>10}{"Recall":>9}{"Frame Rec.":>11}{"Defect IoU":>11}{"Latency":>11}{"FPS":>8}')
+    for i, threshold in enumerate(thresholds + ['rgb_only', 'fusion_only']):
+        escalation_rate = escalated_regions[i] / max(n_regions, 1)
+        latency = fusion_latency if threshold == 'fusion_only' else rgb_latency + escalation_rate * fusion_latency
+        row = {'threshold': threshold,
+               'escalation_rate': escalation_rate,
+               'defect_recall': recalled_defect_pixels[i] / max(n_defect_pixels, 1),
+               'defect_frame_recall': escalated_defect_frames[i] / max(n_defect_frames, 1),
+               'defect_iou': intersection[i][FIRST_DEFECT_CLASS:].sum() / (union[i][FIRST_DEFECT_CLASS:].sum() + 1e-06),
+               'latency': latency}
+        report.append(row)
+
+        print(f'{str(threshold):<12}{row["escalation_rate"]:>10.3f}{row["defect_recall"]:>9.3f}{row["defect_frame_recall"]:>11.3f}'
+              f'{row["defect_iou"]:>11.4f}{latency*1000:>9.1f}ms{1/latency:>8.1f}')
+
+    if visualize:
+        rows = report[:len(thresholds)]
+        fig, ax = plt.subplots(figsize=(7,5))
+        ax.plot([1/row['latency'] for row in rows], [row['defect_recall'] for row in rows], marker='o', label='Cascade')
+        for row in rows:
+            ax.annotate(f'{row["threshold"]}', (1/row['latency'], row['defect_recall']))
+        ax.axvline(1/fusion_latency, color='red', linestyle='--', label='Fusion only')
+        ax.axvline(1/rgb_latency, color='green', linestyle='--', label='RGB only')
+        ax.set_xlabel('Estimated Frames per Second')
+        ax.set_ylabel('Defect Recall')
+        ax.set_title('Cascade Recall/Throughput Trade-Off')
+        ax.legend()
+        if file_name:
+            plt.savefig(f'cascade_calibration_{file_name}.png')
+        plt.show()
+
+    return report
+
+#######################################################################
+############### Background Tile Skipping ##############################
+#######################################################################
+
+class fillet_detector(nn.Module):
+    '''
+    Description: Very cheap per pixel classifier that separates the fillet (classes 1 - 9) from the conveyor background (class 0).
+    A single 1x1 convolution (logistic regression on the pixel values) on a downscaled image, fitted with fit_fillet_detector.
+    Input of forward: Image (RGB or HSI, batch x channels x height x width)
+    Output of forward: Fillet Logits at the downscaled resolution (batch x 1 x height/scale x width/scale)
+    '''
+    def __init__(self, in_channels=3, scale=4):
+        super(fillet_detector, self).__init__()
+        self.scale = scale
+        self.classifier = nn.Conv2d(in_channels, 1, kernel_size=1)
+
+    def forward(self, x):
+        return self.classifier(F.avg_pool2d(x.float(), self.scale))
+
+    def fillet_mask(self, x, threshold=0.5, margin=8):
+        '''
+        Description: Boolean fillet mask at full resolution. The mask is dilated by a margin, so that the fillet boundary and
+        defects at the edge of the fillet are not cut off.
+        Input: Image, Probability Threshold, Margin in Pixels
+        Output: Fillet Mask (Bool Torch Tensor, batch x height x width)
+        '''
+        mask = (torch.sigmoid(self(x)) >= threshold).float()
+        kernel = 2 * (-(-margin // self.scale)) + 1
+        mask = F.max_pool2d(mask, kernel, stride=1, padding=kernel // 2)
+        return F.interpolate(mask, size=x.shape[2:], mode='nearest').squeeze(1).bool()
+
+def fit_fillet_detector(dataset, data_source='rgb', num_images=None, num_epochs=20, learning_rate=0.05, scale=4, batch_size=64):
+    '''
+    Description: Fits a fillet_detector on the ground truth masks (fillet = every class except background) of a dataset. The
+    detector only sees the downscaled images, so every image is downscaled when it is loaded (scale^2 less memory than the full
+    resolution images) and the detector is fitted on mini-batches of them.
+    Input: Dataset, Data Source of the Detector Input ('rgb' or 'hsi'), Number of Images (None for entire Dataset), Number of Epochs,
+    Learning Rate, Downscaling Factor, Batch Size
+    Output: Fitted Fillet Detector (on the CPU)
+    '''
+    if num_images is None:
+        num_images = len(dataset)
+
+    images, targets = [], []
+    for n in range(num_images):
+        rgb_img, hsi_img, mask = dataset[n]
+        image = select_model_inputs(rgb_img.unsqueeze(0), hsi_img.unsqueeze(0), data_source, device='cpu')[0]
+        images.append(F.avg_pool2d(image.float(), scale))
+        targets.append(F.avg_pool2d((torch.as_tensor(mask) > 0).float()[None, None], scale))
+    images, targets = torch.cat(images), torch.cat(targets)
+    loader = DataLoader(torch.utils.data.TensorDataset(images, targets), batch_size=batch_size, shuffle=True)
+
+    detector = fillet_detector(in_channels=images.shape[1], scale=scale)
+    optimizer = torch.optim.Adam(detector.parameters(), lr=learning_rate)
+
+    for epoch in range(num_epochs):
+        for pooled_images, pooled_targets in loader:
+            optimizer.zero_grad()
+            # the images are already downscaled, so only the classifier of the detector is applied
+            loss = F.binary_cross_entropy_with_logits(detector.classifier(pooled_images), pooled_targets)
+            loss.backward()
+            optimizer.step()
+
+    with torch.no_grad():
+        loss = F.binary_cross_entropy_with_logits(detector.classifier(images), targets)
+    print(f'Fillet Detector BCE Loss: {loss.item():.4f}')
+    return detector.eval()
+
+def tile_positions(height, width, tile_size, overlap):
+    '''
+    Description: Top left corners of overlapping tiles covering an image. The last tile of each row/column is moved to the image
+    border, so the tiles always have the full tile size.
+    Input: Image Height, Image Width, Tile Size, Overlap in Pixels
+    Output: Torch Tensor of Tile Positions (tiles x 2, top and left)
+    '''
+    stride = tile_size - overlap
+    tops = sorted(set(list(range(0, max(height - tile_size, 0) + 1, stride)) + [max(height - tile_size, 0)]))
+    lefts = sorted(set(list(range(0, max(width - tile_size, 0) + 1, stride)) + [max(width - tile_size, 0)]))
+    return torch.tensor([(top, left) for top in tops for left in lefts])
+
+def blending_window(tile_size, overlap, device='cpu'):
+    '''
+    Description: Weights for blending overlapping tiles. The weights ramp up linearly over the overlap at the tile borders and
+    are 1 in the center, which avoids seams between tiles.
+    Input: Tile Size, Overlap in Pixels, Device
+    Output: Torch Tensor (tile_size x tile_size)
+    '''
+    ramp = torch.ones(tile_size, device=device)
+    if overlap > 0:
+        ramp[:overlap] = torch.arange(1, overlap + 1, device=device) / (overlap + 1)
+        ramp[-overlap:] = torch.flip(ramp[:overlap], dims=[0])
+    return ramp[:, None] * ramp[None, :]
+
+def gather_tiles(x, batch_idx, positions, tile_size):
+    '''
+    Description: Cuts tiles out of a batch of images with a single indexing operation.
+    Input: Images (Torch Tensor, batch x channels x height x width), Batch Index of each Tile (Torch Tensor), Tile Positions
+    (Torch Tensor, tiles x 2), Tile Size
+    Output: Tiles (Torch Tensor, tiles x channels x tile_size x tile_size)
+    '''
+    offsets = torch.arange(tile_size, device=positions.device)
+    rows = (positions[:, 0, None] + offsets)[:, :, None]
+    cols = (positions[:, 1, None] + offsets)[:, None, :]
+    return x[batch_idx[:, None, None], :, rows, cols].permute(0, 3, 1, 2)
+
+def scatter_tiles(tiles, batch_idx, positions, output_shape, window):
+    '''
+    Description: Inverse of gather_tiles with blending. The tiles are weighted with the blending window and accumulated into the
+    output, overlapping areas are normalized by the summed weights.
+    Input: Tiles (Torch Tensor, tiles x channels x tile_size x tile_size), Batch Index of each Tile, Tile Positions, Output Shape
+    (batch x channels x height x width), Blending Window
+    Output: Blended Images, Coverage Mask (Bool Torch Tensor, batch x height x width, True where any tile was written)
+    '''
+    b, c, h, w = output_shape
+    tile_size = tiles.shape[-1]
+    offsets = torch.arange(tile_size, device=tiles.device)
+    rows = (positions[:, 0, None] + offsets)[:, :, None].expand(-1, -1, tile_size)
+    cols = (positions[:, 1, None] + offsets)[:, None, :].expand(-1, tile_size, -1)
+    batch = batch_idx[:, None, None].expand(-1, tile_size, tile_size)
+
+    output = torch.zeros((b, h, w, c), device=tiles.device, dtype=tiles.dtype)
+    weights = torch.zeros((b, h, w), device=tiles.device, dtype=tiles.dtype)
+    window = window.to(tiles.dtype).expand(len(tiles), -1, -1)
+
+    output.index_put_((batch, rows, cols), tiles.permute(0, 2, 3, 1) * window[..., None], accumulate=True)
+    weights.index_put_((batch, rows, cols), window, accumulate=True)
+
+    covered = weights > 0
+    output = output / weights.clamp(min=1e-06)[..., None]
+    return output.permute(0, 3, 1, 2), covered
+
+def model_out_channels(model):
+    '''
+    Description: Number of output channels (classes) of a model, taken from its final layer (final_layer of the UNets, out of
+    UNetWithResnet50Encoder). Wrappers are unwrapped through their model/module attribute, cascades through their fusion model.
+    Input: Model
+    Output: Number of Output Channels
+    '''
+    module = model
+    while module is not None:
+        for name in ('final_layer', 'out'):
+            if hasattr(getattr(module, name, None), 'out_channels'):
+                return getattr(module, name).out_channels
+        module = getattr(module, 'model', getattr(module, 'module', getattr(module, 'fusion_model', None)))
+    raise ValueError(f'Number of output channels of {type(model).__name__} is unknown, pass out_channels instead')
+
+class tiled_sparse_model(nn.Module):
+    '''
+    Description: Sparse tiled inference for conveyor frames. The fillet_detector finds the fillet pixels, the segmentation
+    model only runs on the (overlapping) tiles that contain fillet pixels, all tiles of all frames in one batch, and the results
+    are blended back into the frame. Pixels without any processed tile are filled with background. The compute per frame
+    therefore scales with the fillet area. The tile size has to be a multiple of 16 (32 for UNetWithResnet50Encoder) and the
+    detector input is the first model input (RGB for 'rgb' and 'sf'). Inputs at a reduced resolution (e.g. HSI for the
+    feature level fusion model with hsi_scale 2 or 4) are cut at the tile positions and tile size divided by their scale, so the
+    overlap has to be a multiple of the scale. Frames smaller than a tile are padded to the tile size.
+    The number of output channels is taken from the final layer of the model (see model_out_channels) if out_channels is None.
+    Counts of all and processed tiles are kept in n_tiles and n_processed (reset with reset_statistics).
+    '''
+    def __init__(self, model, detector, tile_size=128, overlap=32, threshold=0.5, margin=8, max_tiles_per_batch=None,
+                 out_channels=None):
+        super(tiled_sparse_model, self).__init__()
+        if not 0 <= overlap < tile_size:
+            raise ValueError(f'The overlap has to be at least 0 and smaller than the tile size {tile_size}, not {overlap}')
+        self.model = model
+        self.out_channels = out_channels if out_channels is not None else model_out_channels(model)
+        self.detector = detector
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.threshold = threshold
+        self.margin = margin
+        self.max_tiles_per_batch = max_tiles_per_batch
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.n_tiles = 0
+        self.n_processed = 0
+
+    @property
+    def processed_rate(self):
+        return self.n_processed / max(self.n_tiles, 1)
+
+    def forward(self, *model_inputs):
+        b, _, h, w = model_inputs[0].shape
+        device = model_inputs[0].device
+
+        # inputs at a reduced resolution get the tile positions and sizes divided by their scale
+        scales = [h // x.shape[2] for x in model_inputs]
+        for x, scale in zip(model_inputs, scales):
+            if x.shape[2] * scale != h or x.shape[3] * scale != w or self.tile_size % scale:
+                raise ValueError(f'Input size {tuple(x.shape[2:])} is not the size {(h, w)} of the first input divided by a '
+                                 f'divisor of the tile size {self.tile_size}')
+
+        # frames smaller than a tile are padded at the bottom/right by replicating the border and the logits are cropped back
+        if h < self.tile_size or w < self.tile_size:
+            padding = (0, max(self.tile_size - w, 0), 0, max(self.tile_size - h, 0))
+            padded_inputs = [F.pad(x, [p // scale for p in padding], mode='replicate') for x, scale in zip(model_inputs, scales)]
+            return self.forward(*padded_inputs)[:, :, :h, :w]
+
+        fillet = self.detector.fillet_mask(model_inputs[0], self.threshold, self.margin)
+
+        positions = tile_positions(h, w, self.tile_size, self.overlap).to(device)
+        batch_idx = torch.arange(b, device=device).repeat_interleave(len(positions))
+        positions = positions.repeat(b, 1)
+
+        keep = gather_tiles(fillet.unsqueeze(1), batch_idx, positions, self.tile_size).flatten(1).any(dim=1)
+        batch_idx, positions = batch_idx[keep], positions[keep]
+
+        self.n_tiles += len(keep)
+        self.n_processed += len(positions)
+
+        # background logits with a clear margin, so the skipped pixels also have a background probability of ~1 after softmax
+        background = torch.full((b, self.out_channels, h, w), -1e4, device=device)
+        background[:, 0] = 0
+        if len(positions) == 0:
+            return background
+
+        if any(positions.remainder(scale).any() for scale in scales):
+            raise ValueError(f'Tile positions are not aligned with the reduced resolution inputs, the overlap {self.overlap} '
+                             f'has to be a multiple of their scale {max(scales)}')
+
+        chunk = self.max_tiles_per_batch or len(positions)
+        logit_tiles = []
+        for start in range(0, len(positions), chunk):
+            tiles = [gather_tiles(x, batch_idx[start:start+chunk], positions[start:start+chunk] // scale, self.tile_size // scale).float()
+                     for x, scale in zip(model_inputs, scales)]
+            logit_tiles.append(self.model(*tiles).float())
+
+        window = blending_window(self.tile_size, self.overlap, device=device)
+        logits, covered = scatter_tiles(torch.cat(logit_tiles), batch_idx, positions, (b, self.out_channels, h, w), window)
+
+        return torch.where(covered.unsqueeze(1), logits, background)
+
+def tile_skipping_report(model, tiled_model, test_dataset, data_source, num_images=None, n_runs=10):
+    '''
+    Description: Compares the full frame model with the tiled_sparse_model on a test dataset: defect IoU, share of processed
+    tiles and latency per frame.
+    Input: Full Frame Model, Tiled Sparse Model (wrapping the same model), Test Dataset without Augmentation, Data Source (String),
+    Number of Images (None for entire Dataset), Number of Timed Runs
+    Output: Dictionary with Defect IoU, Processed Tile Rate and Latency of both
+    '''
+    model = model.to(DEVICE).eval()
+    tiled_model = tiled_model.to(DEVICE).eval()
+    tiled_model.reset_statistics()
+
+    report = {}
+    for name, m in [('full_frame', model), ('tiled', tiled_model)]:
+        intersection, union, _, _ = class_metrics_over_dataset(m, test_dataset, data_source, num_images)
+        report[f'{name}_defect_iou'] = np.sum(intersection[FIRST_DEFECT_CLASS:]) / (np.sum(union[FIRST_DEFECT_CLASS:]) + 1e-06)
+
+    report['processed_rate'] = tiled_model.processed_rate
+
+    rgb_img, hsi_img, _ = test_dataset[0]
+    model_inputs = select_model_inputs(rgb_img.unsqueeze(0), hsi_img.unsqueeze(0), data_source)
+    report['full_frame_latency'] = measure_model_latency(model, model_inputs, n_runs=n_runs)
+    report['tiled_latency'] = measure_model_latency(tiled_model, model_inputs, n_runs=n_runs)
+
+    print(f'Defect IoU full frame: {report["full_frame_defect_iou"]:.4f}, tiled: {report["tiled_defect_iou"]:.4f}')
+    print(f'Processed Tiles: {report["processed_rate"]*100:.1f}%')
+    print(f'Latency per Frame full frame: {report["full_frame_latency"]*1000:.1f}ms, tiled: {report["tiled_latency"]*1000:.1f}ms')
+
+    return report
+
+#######################################################################
+############### Model Cost Comparison #################################
+#######################################################################
+
+def model_cost_report(models, test_dataset, data_source, num_images=None, n_runs=10, file_name=''):
+    '''
+    Description: Compares model variants (e.g. fusion modes of unet_model_gelu_feature_level_fusion) by their cost and accuracy.
+    Parameters, FLOPs and latency per frame are reported next to the defect IoU and the IoU of the entire image on the test dataset.
+    Input: Dictionary of Model Name -> Model, Test Dataset without Augmentation, Data Source (String), Number of Images (None for
+    entire Dataset), Number of Timed Runs, File Name for the Report
+    Output: Dictionary of Model Name -> Dictionary with Parameters, FLOPs, Latency, Defect IoU and IoU
+    '''
+    rgb_img, hsi_img, _ = test_dataset[0]
+    model_inputs = select_model_inputs(rgb_img.unsqueeze(0), hsi_img.unsqueeze(0), data_source)
+
+    report = {}
+    for name, model in models.items():
+        model = model.to(DEVICE).eval()
+        intersection, union, _, _ = class_metrics_over_dataset(model, test_dataset, data_source, num_images)
+
+        report[name] = {'parameters': count_model_parameters(model),
+                        'flops': count_model_flops(model, model_inputs),
+                        'latency': measure_model_latency(model, model_inputs, n_runs=n_runs),
+                        'defect_iou': np.sum(intersection[FIRST_DEFECT_CLASS:]) / (np.sum(union[FIRST_DEFECT_CLASS:]) + 1e-06),
+                        'iou': np.sum(intersection) / (np.sum(union) + 1e-06)}
+
+    lines = [f'{"Model":<30}{"Params (M)":>11}{"GFLOPs":>9}{"Latency":>11}{"Defect IoU":>11}{"IoU":>8}']
+    for name, row in report.items():
+        lines.append(f'{name:<30}{row["parameters"]/1e6:>11.2f}{row["flops"]/1e9:>9.1f}{row["latency"]*1000:>9.1f}ms'
+                     f'{row["defect_iou"]:>11.4f}{row["iou"]:>8.4f}')
+    print('\n'.join(lines))
+
+    if file_name:
+        with open(f'model_cost_{file_name}.txt', 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+
+    return report
+
+def upsampling_benchmark(model_type, model_inputs, methods=('conv_transpose', 'bilinear', 'pixel_shuffle'), n_runs=10, file_name='',
+                         **model_kwargs):
+    '''
+    Description: Benchmark table of the decoder upsampling methods of a UNet model (upsampling_method option of all models in
+    models.py) on the current device: parameters, FLOPs, latency and memory (see measure_model_memory) per forward pass.
+    Input: Model Class (e.g. unet_model_gelu), Model Inputs (Tuple of Torch Tensors), Upsampling Methods, Number of Timed Runs,
+    File Name for the Table, Keyword Arguments for the Model (e.g. out_channels=10)
+    Output: Dictionary of Upsampling Method -> Dictionary with Parameters, FLOPs, Latency and Memory
+    '''
+    model_inputs = tuple(x.to(DEVICE).float() for x in model_inputs)
+
+    report = {}
+    for method in methods:
+        model = model_type(**model_kwargs, upsampling_method=method).to(DEVICE).eval()
+        report[method] = {'parameters': count_model_parameters(model),
+                          'flops': count_model_flops(model, model_inputs),
+                          'latency': measure_model_latency(model, model_inputs, n_runs=n_runs),
+                          'memory': measure_model_memory(model, model_inputs)}
+
+    lines = [f'{model_type.__name__} on {DEVICE}, input {tuple(model_inputs[0].shape)}',
+             f'{"Upsampling":<16}{"Params (M)":>11}{"GFLOPs":>9}{"Latency":>11}{"Memory (MB)":>13}']
+    for method, row in report.items():
+        lines.append(f'{method:<16}{row["parameters"]/1e6:>11.2f}{row["flops"]/1e9:>9.1f}{row["latency"]*1000:>9.1f}ms'
+                     f'{row["memory"]/2**20:>13.1f}')
+    print('\n'.join(lines))
+
+    if file_name:
+        with open(f'upsampling_benchmark_{file_name}.txt', 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+
+    return report
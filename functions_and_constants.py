@@ -7,6 +7,12 @@ from matplotlib.colors import ListedColormap, BoundaryNorm
 from datetime import datetime
 import random
 import copy
+import time
+import json
+import contextlib
+import threading
+import queue
+from collections import namedtuple
 
 #augmentation
 from albumentations.pytorch import ToTensorV2
@@ -15,6 +21,9 @@ import albumentations as A
 #torch
 import torch
 from torch.utils.data import Dataset, SubsetRandomSampler, DataLoader, random_split
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel as DDP
+import torch.distributed as dist
 from torch.cuda.amp import GradScaler
 #from torchvision.transforms import v2
 import torchvision.transforms as transforms
@@ -28,6 +37,8 @@ from torch.optim.lr_scheduler import StepLR, MultiStepLR, ReduceLROnPlateau, Exp
 from sklearn.metrics import ConfusionMatrixDisplay, confusion_matrix, f1_score
 import skimage.io as skio # lighter dependency than tensorflow for working with our tensors/arrays
 
+from TonyWang_MasterThesis.models import *
+
 ###########################################################
 #################### Augmentations ########################
 ###########################################################
@@ -98,6 +109,17 @@ sf_transformation = A.Compose([
 additional_targets={'image1':'image'}
 )
 
+sf_distillation_transformation = A.Compose([
+    A.RandomCrop(width=224, height=224),
+    A.RandomRotate90(p=0.5),
+    A.Rotate(limit=20, p=0.5, border_mode=cv2.BORDER_CONSTANT),
+    A.HorizontalFlip(p=0.5),
+    A.VerticalFlip(p=0.5),
+    ToTensorV2()
+],
+additional_targets={'image1':'image', 'image2':'image'}
+)
+
 sf_no_transformation = A.Compose([
     ToTensorV2()
 ],
@@ -189,19 +211,35 @@ def img_contains_nothing(mask):
     else:
         return True
 
+def downsample_hsi(hsi_image, scale):
+    '''
+    Description: Downsamples an HSI image by averaging scale x scale pixel blocks, for the reduced resolution HSI branch.
+    Input: HSI Image (Torch Tensor in (channels, height, width) or Numpy Array in (height, width, channels)), Scale (Int)
+    Output: Downsampled HSI Image of the same type
+    '''
+    if scale == 1:
+        return hsi_image
+    if isinstance(hsi_image, torch.Tensor):
+        return F.avg_pool2d(hsi_image.unsqueeze(0), scale).squeeze(0)
+    h, w, c = hsi_image.shape
+    hsi_image = hsi_image[:h // scale * scale, :w // scale * scale]
+    return hsi_image.reshape(h // scale, scale, w // scale, scale, c).mean(axis=(1, 3))
+
 ################################ Sensor Fusion #####################################
 
 class _WH_RGB_HSI_Dataset(Dataset):
     '''
     Description: Custom Dataset for Pytorch. Inputted RGB and HSI Images are normalized and converted not float32. Since HSI images
     were preprocessed with PCA, they have to be scaled as well. Masks have their values replaced and then all three sources undergo 
-    data augmentation.
+    data augmentation. With hsi_scale 2 or 4 the HSI image is returned at 1/2 or 1/4 resolution (after the augmentation, which
+    needs all sources at the same size) for the reduced resolution HSI branch of unet_model_gelu_feature_level_fusion.
     '''
-    def __init__(self, rgb_img_dir, hsi_img_dir, mask_dir, transform):
+    def __init__(self, rgb_img_dir, hsi_img_dir, mask_dir, transform, hsi_scale=1):
         self.rgb_img_dir=rgb_img_dir
         self.hsi_img_dir=hsi_img_dir
         self.mask_dir=mask_dir
         self.transform=transform
+        self.hsi_scale=hsi_scale
 
         self.rgb_images=os.listdir(rgb_img_dir)
         self.hsi_images=os.listdir(hsi_img_dir)
@@ -209,8 +247,10 @@ class _WH_RGB_HSI_Dataset(Dataset):
     def __len__(self):
         return len(self.hsi_images)
 
-    def __getitem__(self, idx):
-        
+    def _load_sample(self, idx):
+        '''
+        Description: Reads in the RGB image, HSI image and mask of an index without data augmentation.
+        '''
         rgb_img_name=os.path.join(self.rgb_img_dir, self.rgb_images[idx])
         hsi_img_name=os.path.join(self.hsi_img_dir, self.rgb_images[idx].replace('.png', '.npy'))
         mask_name=os.path.join(self.mask_dir, self.rgb_images[idx].replace('.png', '.npy'))
@@ -229,6 +269,12 @@ class _WH_RGB_HSI_Dataset(Dataset):
         #replace mask values with 0,1,2,3,4,5, etc.
         replace_np_values(mask, defects_only=False)
 
+        return rgb_image, hsi_image, mask
+
+    def __getitem__(self, idx):
+        
+        rgb_image, hsi_image, mask = self._load_sample(idx)
+
         #loops around to find transformed images with defects, after 7 loops it just takes whatever it finds
         if self.transform:
             for i in range(14):
@@ -243,18 +289,55 @@ class _WH_RGB_HSI_Dataset(Dataset):
                 if img_contains_nothing(mask_trans):
                     i = i - 1
      
-            return rgb_image_trans, hsi_image_trans, mask_trans
+            return rgb_image_trans, downsample_hsi(hsi_image_trans, self.hsi_scale), mask_trans
     
         elif self.transform == None:
-            return rgb_image, hsi_image, mask
+            return rgb_image, downsample_hsi(hsi_image, self.hsi_scale), mask
         
+class _WH_RGB_HSI_Distillation_Dataset(_WH_RGB_HSI_Dataset):
+    '''
+    Description: Same as _WH_RGB_HSI_Dataset, but additionally returns the cached teacher logits of each image (see
+    cache_teacher_logits) for knowledge distillation. The logits undergo the same data augmentation as the images, so the
+    transform needs the additional target 'image2' (e.g. sf_distillation_transformation).
+    '''
+    def __init__(self, rgb_img_dir, hsi_img_dir, mask_dir, logits_dir, transform, hsi_scale=1):
+        super(_WH_RGB_HSI_Distillation_Dataset, self).__init__(rgb_img_dir, hsi_img_dir, mask_dir, transform, hsi_scale)
+        self.logits_dir=logits_dir
+
+    def __getitem__(self, idx):
+
+        rgb_image, hsi_image, mask = self._load_sample(idx)
+
+        #teacher logits are stored as float16 in (height, width, classes)
+        logits_name=os.path.join(self.logits_dir, self.rgb_images[idx].replace('.png', '.npy'))
+        teacher_logits=np.load(logits_name).astype(np.float32)
+
+        if self.transform:
+            for i in range(14):
+                transformed = self.transform(image=rgb_image, image1 = hsi_image, image2 = teacher_logits, mask=mask)
+                rgb_image_trans = transformed["image"]
+                hsi_image_trans = transformed["image1"]
+                logits_trans = transformed["image2"]
+                mask_trans = transformed["mask"]
+
+                #check if mask contains defects, if not then reroll
+                if img_contains_defects(mask_trans):
+                    break;
+
+            return rgb_image_trans, downsample_hsi(hsi_image_trans, self.hsi_scale), mask_trans, logits_trans
+
+        elif self.transform == None:
+            return rgb_image, downsample_hsi(hsi_image, self.hsi_scale), mask, teacher_logits
+
 class _WH_RGB_HSI_Dataset_Wrapper(Dataset):
     '''
     Description: Custom Dataset Wrapper for Pytorch. This comes into effect because the test dataset should not undergo data augmentation. 
+    The HSI image is downsampled by hsi_scale after the transform, the wrapped dataset should use hsi_scale=1.
     '''
-    def __init__(self, dataset, transform):
+    def __init__(self, dataset, transform, hsi_scale=1):
         self.dataset = dataset
         self.transform = transform
+        self.hsi_scale = hsi_scale
 
     def __len__(self):
         return len(self.dataset)
@@ -269,7 +352,69 @@ class _WH_RGB_HSI_Dataset_Wrapper(Dataset):
         hsi_image_trans = transformed["image1"]
         mask_trans = transformed["mask"]
         
-        return rgb_image_trans, hsi_image_trans, mask_trans
+        return rgb_image_trans, downsample_hsi(hsi_image_trans, self.hsi_scale), mask_trans
+
+################################ ResNet-50 Feature Cache #####################################
+
+def cache_encoder_features(model, dataset, cache_dir, overwrite=False):
+    '''
+    Description: Runs the (frozen) encoder of a UNetWithResnet50Encoder once over every image of a dataset without augmentation and
+    stores the feature pyramid packed into one flat float16 vector together with the mask, named like the RGB images. The
+    feature shapes are stored in feature_shapes.json for resnet50_cached_decoder. Already cached images are skipped, an
+    existing cache is only encoded again if it has no feature_shapes.json.
+    Input: UNetWithResnet50Encoder, Dataset without Augmentation (e.g. _WH_RGB_HSI_Dataset with sf_no_transformation), Cache
+    Directory, Overwrite Option
+    Output: Feature Shapes (List of Name and Shape)
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    shapes_path = os.path.join(cache_dir, 'feature_shapes.json')
+
+    feature_shapes = None
+    if os.path.exists(shapes_path) and not overwrite:
+        with open(shapes_path, 'r') as file:
+            feature_shapes = [(name, shape) for name, shape in json.load(file)]
+
+    model = model.to(DEVICE).eval()
+    with torch.no_grad():
+        for idx in tqdm(range(len(dataset)), total=len(dataset)):
+            cache_name = os.path.join(cache_dir, dataset.rgb_images[idx].replace('.png', '.npz'))
+            if os.path.exists(cache_name) and not overwrite and feature_shapes is not None:
+                continue
+
+            rgb_img, _, mask = dataset[idx]
+            pre_pools = model.encode(rgb_img.unsqueeze(0).to(DEVICE).float())
+            feature_shapes = [(name, list(feature.shape[1:])) for name, feature in pre_pools.items()]
+
+            # cache without feature_shapes.json, the first image was only encoded for its feature shapes
+            if os.path.exists(cache_name) and not overwrite:
+                continue
+            packed_features = torch.cat([feature.flatten() for feature in pre_pools.values()])
+            np.savez(cache_name, features=packed_features.to('cpu').numpy().astype(np.float16), mask=np.asarray(mask))
+
+    with open(shapes_path, 'w') as file:
+        json.dump(feature_shapes, file)
+
+    return feature_shapes
+
+class _ResNet50_Feature_Cache_Dataset(Dataset):
+    '''
+    Description: Dataset of cached ResNet-50 encoder features (see cache_encoder_features) for resnet50_cached_decoder. Returns
+    the packed features (data source 'features') and the mask in the layout of the image datasets, the cache has no HSI image
+    (empty tensor). The features are float16 and converted to float by select_model_inputs.
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir=cache_dir
+        self.cached_images=sorted(name for name in os.listdir(cache_dir) if name.endswith('.npz'))
+
+        with open(os.path.join(cache_dir, 'feature_shapes.json'), 'r') as file:
+            self.feature_shapes=[(name, tuple(shape)) for name, shape in json.load(file)]
+
+    def __len__(self):
+        return len(self.cached_images)
+
+    def __getitem__(self, idx):
+        cache=np.load(os.path.join(self.cache_dir, self.cached_images[idx]))
+        return torch.from_numpy(cache['features']), torch.zeros(0), torch.from_numpy(cache['mask'])
 
 #################################################
 ################  Constants  ####################
@@ -315,25 +460,29 @@ class DiceLoss(nn.Module):
 
     def _one_hot_encoder(self, input_tensor):
         '''
-        Description: Custom One hot encoding function, because the regular one hot function in this case throws a weird error
+        Description: One hot encoding of the mask (batch x height x width) to batch x classes x height x width by scattering
+        ones into a zero tensor, a single kernel instead of one comparison per class. Ignore or out of range labels
+        (e.g. 255) belong to no class, their pixels are all zero like with a comparison per class.
         '''
-        tensor_list = []
-        for i in range(self.n_classes):
-            temp_prob = input_tensor == i  # * torch.ones_like(input_tensor)
-            tensor_list.append(temp_prob.unsqueeze(1))
-        output_tensor = torch.cat(tensor_list, dim=1)
-        return output_tensor.float()
+        input_tensor = input_tensor.long()
+        valid = (input_tensor >= 0) & (input_tensor < self.n_classes)
+        output_tensor = torch.zeros((input_tensor.shape[0], self.n_classes, *input_tensor.shape[1:]), dtype=torch.float,
+                                    device=input_tensor.device)
+        output_tensor.scatter_(1, torch.where(valid, input_tensor, 0).unsqueeze(1), valid.unsqueeze(1).float())
+        return output_tensor
 
 
     def _dice_loss(self, score, target):
         '''
-        Description: The actual dice loss function. Modeled after dice score from: https://en.wikipedia.org/wiki/Dice-Sørensen_coefficient
+        Description: The actual dice loss function, calculated for all classes at once by reducing over all but the class
+        dimension. Modeled after dice score from: https://en.wikipedia.org/wiki/Dice-Sørensen_coefficient
         '''
         target = target.float()
         smooth = 1e-5
-        intersect = torch.sum(score * target)
-        y_sum = torch.sum(target * target)
-        z_sum = torch.sum(score * score)
+        dims = [0] + list(range(2, score.dim()))
+        intersect = torch.sum(score * target, dim=dims)
+        y_sum = torch.sum(target * target, dim=dims)
+        z_sum = torch.sum(score * score, dim=dims)
         loss = (2 * intersect + smooth) / (z_sum + y_sum + smooth)
 
         # loss has to be negative, since its being minimized
@@ -341,33 +490,74 @@ class DiceLoss(nn.Module):
         return loss
 
 
-    def forward(self, inputs, target, weight=None, softmax=True):
+    def forward(self, inputs, target, weight=None, softmax=True, return_class_wise=False):
         '''
-        Description: Forward function where weighted dice loss for multiclassification is calculated. 
+        Description: Forward function where weighted dice loss for multiclassification is calculated. The dice of all classes
+        is calculated in one pass and stays on the device, so the loss does not synchronize with the host. With
+        return_class_wise the dice score of each class is returned as well (detached tensor with n_classes elements).
         '''
         if softmax:
             inputs = torch.softmax(inputs, dim=1)
         target = self._one_hot_encoder(target)
-        if weight is None:
-            weight = [1] * self.n_classes
-        
+
         #check if input size is equal target size
         assert inputs.size() == target.size(), 'predict {} & target {} shape do not match'.format(inputs.size(), target.size())
-        class_wise_dice = []
-        loss = 0.0
 
-        #loops through all classes
-        for i in range(0, self.n_classes):
+        #dice loss of all classes
+        class_wise_loss = self._dice_loss(inputs, target)
+
+        #add loss for all classes
+        if weight is None:
+            loss = class_wise_loss.sum() / self.n_classes
+        else:
+            weight = torch.as_tensor(weight, dtype=class_wise_loss.dtype, device=class_wise_loss.device)
+            loss = (class_wise_loss * weight).sum() / self.n_classes
+
+        if return_class_wise:
+            return loss, 1.0 - class_wise_loss.detach()
+        return loss
 
-            #calculate dice for each class
-            dice = self._dice_loss(inputs[:, i], target[:, i])
+class DistillationLoss(nn.Module):
+    '''
+    Description: Knowledge distillation loss. The softened class probabilities of a (cached) teacher model supervise the student
+    through the KL divergence at temperature T. The loss is scaled by T^2, so its gradients keep the same magnitude as the CE
+    and Dice loss it is added to.
+    '''
+    def __init__(self, temperature=2.0, alpha=1.0):
+        super(DistillationLoss, self).__init__()
+        self.temperature = temperature
+        self.alpha = alpha
 
-            #independently track dice
-            class_wise_dice.append(1.0 - dice.item())
+    def forward(self, student_logits, teacher_logits):
+        '''
+        Description: Pixelwise KL divergence between softened teacher and student predictions, averaged over all pixels.
+        '''
+        student_log_prob = F.log_softmax(student_logits.float() / self.temperature, dim=1)
+        teacher_prob = F.softmax(teacher_logits.float() / self.temperature, dim=1)
+        kl_div = F.kl_div(student_log_prob, teacher_prob, reduction='none').sum(dim=1).mean()
+        return self.alpha * kl_div * self.temperature ** 2
 
-            #add loss for all classes
-            loss += dice * weight[i]
-        return loss / self.n_classes
+def select_model_inputs(rgb_img, hsi_img, data_source, device=DEVICE, non_blocking=False):
+    '''
+    Description: Selects the model inputs of a batch and puts them onto the device. The dataset always returns RGB image, HSI
+    image and mask, but most models only need one of them. Feature cache datasets (_ResNet50_Feature_Cache_Dataset) return
+    the packed encoder features in place of the images, which models read from the 'features' source. The inputs are looked
+    up in the model registry (model_input_spec), so only the tensors the model needs are transferred and cast to the declared
+    dtype in the same step. Instead of the model a data source string ('rgb', 'hsi', 'sf', 'features') can be given. For
+    fusion models the HSI image can be None (missing HSI frame), which the fusion models handle by skipping the HSI branch.
+    Inputs which declare their own device (e.g. the HSI input of cascade_model, which stays on the CPU) are put onto that
+    device instead.
+    Input: RGB Image (Torch Tensor), HSI Image (Torch Tensor), Model or Data Source (String), Device, Non Blocking Transfer (Bool)
+    Output: Tuple of Model Inputs
+    '''
+    batch_inputs = {'rgb': rgb_img, 'hsi': hsi_img, 'features': rgb_img}
+    model_inputs = []
+    for model_input in model_input_spec(data_source):
+        x = batch_inputs[model_input.source]
+        if x is not None:
+            x = x.to(model_input.device or device, dtype=model_input.dtype, non_blocking=non_blocking)
+        model_inputs.append(x)
+    return tuple(model_inputs)
 
 ###################################################################################
 
@@ -377,445 +567,1104 @@ class DiceLoss(nn.Module):
 
 ###################################################################################
 
-# sensor fusion model training with two possible loss functions
-def sf_model_training_multiloss(model, train_loader, val_loader, num_epochs, ce_loss_fn, dice_loss_fn, optimizer, scaler, scheduler, 
-                            avg_train_loss_list, avg_val_loss_list, TRAIN_BATCH_SIZE, VAL_BATCH_SIZE,
-                             activate_scheduler=True, patience=15, model_name='', data_source='rgb', save_state = False):
+def is_distributed():
     '''
-    Description: Model Training for Sensor fusion with two loss functions. Needs a data source option since dataloader
-    for all models is the same.
-    - Early stop option, if patience is 0, early stop is deactivated
-    - Scheduler Option
-    - Save state option
-    Input: Pytorch Model, Train Loader, Validation Loader, Number of Epochs, Cross Entropy Loss, Dice Loss, Optimizer, Pytorch Scaler, 
-    Scheduler, List to track the average Train & Val Loss (for complete Visualisation of Training), Batch sizes, Scheduler Options,
-    Patience for Early Stop Option, Model Name for Save state, Data Source, Save State option
-    Output: Trained Model, List to track the average Train & Val Loss (for complete Visualisation of Training)
+    Description: True if the process is part of a distributed process group (see distributed_training.py).
     '''
+    return dist.is_available() and dist.is_initialized()
 
-    _today=datetime.today().strftime('%Y-%m-%d')
-    print('Training beginning with following parameters:')
-    print(f'No. Epochs: {num_epochs}')
+def is_main_process():
+    '''
+    Description: True for rank 0 or if the training is not distributed. Only the main process logs and saves checkpoints.
+    '''
+    return not is_distributed() or dist.get_rank() == 0
 
-    #this is used for early stopping, value should be pretty large
-    best_val_loss = 1000
-    
-    #training with Cross Entropy Loss
-    for epoch in range(num_epochs):
-        
-        print(f'Epoch: {epoch}')
-        train_batch_loss=0
-        val_batch_loss=0
-        train_batch_iou=0
-        val_batch_iou=0
-        
-        #####################################################
-        ############### training instance ###################
-        #####################################################
-        
-        #training loop
-        model.train()
-        train_loop = tqdm(enumerate(train_loader),total=len(train_loader))
-        for batch_idx, (rgb_img, hsi_img, mask) in train_loop:
-
-            if data_source == 'rgb':
-                rgb_img = rgb_img.to(DEVICE) #put data sources onto cuda device if available
-                mask = mask.to(DEVICE)
-                mask = mask.type(torch.long) #convert to correct data type for training
-
-                # forward pass
-                with torch.cuda.amp.autocast():
-                    predictions = model(rgb_img.float()) #prediction
-                    ce_loss = ce_loss_fn(predictions, mask)
-                    dice_loss = dice_loss_fn(predictions, mask)
-                    loss = ce_loss + dice_loss #add losses together
-
-            elif data_source == 'hsi':
-                hsi_img = hsi_img.to(DEVICE)
-                mask = mask.to(DEVICE)
-                mask = mask.type(torch.long)
-
-                # forward pass
-                with torch.cuda.amp.autocast():
-                    predictions = model(hsi_img)
-                    ce_loss = ce_loss_fn(predictions, mask)
-                    dice_loss = dice_loss_fn(predictions, mask)
-                    loss = ce_loss + dice_loss
-            
-            elif data_source == 'sf':
-                rgb_img = rgb_img.to(DEVICE)
-                hsi_img = hsi_img.to(DEVICE)
-                mask = mask.to(DEVICE)
-                mask = mask.type(torch.long)
-            
-                # forward pass
-                with torch.cuda.amp.autocast():
-                    predictions = model(rgb_img.float(), hsi_img)
-                    ce_loss = ce_loss_fn(predictions, mask)
-                    dice_loss = dice_loss_fn(predictions, mask)
-                    loss = ce_loss + dice_loss
-                
-            # backward pass
-            optimizer.zero_grad()
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scaler.update()
-    
-            # update tqdm loop
-            train_loop.set_postfix(loss=loss.item())
-            
-            train_batch_loss = train_batch_loss + loss.item()
-    
-        #calculate average loss and add to the list for later visualisation
-        print(f'Average Train Batch Loss: {train_batch_loss/TRAIN_BATCH_SIZE:.4f}')
-        avg_train_loss_list.append(train_batch_loss/TRAIN_BATCH_SIZE)
-        
-        ####################################################
-        ############## validation instance #################
-        ####################################################
-        
-        #evaluation loop, so same thing without a backward pass
-        model.eval()
-        val_loop = tqdm(enumerate(val_loader),total=len(val_loader))
-        for batch_idx, (rgb_img, hsi_img, mask) in val_loop:
-            with torch.no_grad():
-                if data_source == 'rgb':
-                    rgb_img = rgb_img.to(DEVICE)
-                    mask = mask.to(DEVICE)
-                    mask = mask.type(torch.long)
-
-                    with torch.cuda.amp.autocast():
-                        predictions = model(rgb_img.float())
-                        ce_loss = ce_loss_fn(predictions, mask)
-                        dice_loss = dice_loss_fn(predictions, mask)
-                        val_loss = ce_loss + dice_loss
-
-                elif data_source == 'hsi':
-                    hsi_img = hsi_img.to(DEVICE)
-                    mask = mask.to(DEVICE)
-                    mask = mask.type(torch.long)
-
-                    with torch.cuda.amp.autocast():
-                        predictions = model(hsi_img)
-                        ce_loss = ce_loss_fn(predictions, mask)
-                        dice_loss = dice_loss_fn(predictions, mask)
-                        val_loss = ce_loss + dice_loss
-            
-                elif data_source == 'sf':
-                    rgb_img = rgb_img.to(DEVICE)
-                    hsi_img = hsi_img.to(DEVICE)
-                    mask = mask.to(DEVICE)
-                    mask = mask.type(torch.long)
-            
-                    # forward
-                    with torch.cuda.amp.autocast():
-                        predictions = model(rgb_img.float(), hsi_img)
-                        ce_loss = ce_loss_fn(predictions, mask)
-                        dice_loss = dice_loss_fn(predictions, mask)
-                        val_loss = ce_loss + dice_loss
+def world_size():
+    '''
+    Description: Number of processes of the distributed training, 1 if the training is not distributed.
+    '''
+    return dist.get_world_size() if is_distributed() else 1
 
-    
-            # update tqdm loop
-            val_loop.set_postfix(val_loss=val_loss.item())
-            
-            val_batch_loss = val_batch_loss + val_loss.item()
-
-        #calculate average loss and add to the list for later visualisation
-        avg_val_loss = val_batch_loss / len(val_loader)
-        print(f'Average Validation Batch Loss: {val_batch_loss/VAL_BATCH_SIZE:.4f}')        
-        avg_val_loss_list.append(val_batch_loss/VAL_BATCH_SIZE)
-        
-        #######################################################
-        ############### adjust learning rate ##################
-        #######################################################
-        
-        if activate_scheduler:
+def all_reduce_sum(tensor):
+    '''
+    Description: Sums a tensor (e.g. running loss or confusion matrix) over all processes, does nothing if the training is not
+    distributed.
+    Input: Torch Tensor
+    Output: Summed Torch Tensor
+    '''
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
 
-            #adjust scheduler if one is available
-            before_lr = optimizer.param_groups[0]["lr"]
-            scheduler.step()
-            after_lr = optimizer.param_groups[0]["lr"]
-            print(f"Epoch {epoch}: Adam lr {before_lr:.4f} -> {after_lr:.4f}")
-        
-        ###################################################################################################################
-        ############## visualize training and validation results and also save model after 50 epochs ######################
-        ###################################################################################################################
-            
-        #visualize training loss every 10 epochs
-        if ((epoch%10==0) and (epoch>0) or (epoch==num_epochs)):
-            
-            plot_range=range(epoch)
-            
-            fig, axs = plt.subplots(figsize=(9,6))
-            
-            ###
-            # Loss
-            ###
-            
-            axs.plot(range(len(avg_train_loss_list)), avg_train_loss_list, marker='o', linestyle='-', label='Training Loss', color='blue')
-            
-            #create twin axis
-            ax2 = axs.twinx()
-            ax2.plot(range(len(avg_val_loss_list)), avg_val_loss_list, marker='o', linestyle='-', label='Validation Loss', color='orange')
-            
-            # Add labels and title
-            axs.set_xlabel('Epochs')
-            axs.set_ylabel('Training Loss', color='blue')
-            ax2.set_ylabel('Validation Loss', color='orange')
-            axs.set_title('Training vs Validation Loss')
-            
-            # Show legend for both axes
-            axs.legend(loc='upper left')
-            ax2.legend(loc='upper right')
-    
-            plt.grid(True)
-            plt.show()
-            
-        ######################################################
-        ################# early stopping #####################
-        ######################################################
-        if patience > 0 and epoch>int(1/3*num_epochs):
-            if avg_val_loss < best_val_loss:
-                best_val_loss = avg_val_loss
-                patience_counter = 0
+def unwrap_model(model):
+    '''
+    Description: The model inside a DistributedDataParallel wrapper, so checkpoints have the keys of the plain model.
+    '''
+    return model.module if isinstance(model, DDP) else model
+
+class CombinedLoss(nn.Module):
+    '''
+    Description: Sum of several loss functions (e.g. Cross Entropy and Dice Loss), so they can be passed to the training engine
+    as a single loss function.
+    '''
+    def __init__(self, *loss_fns):
+        super(CombinedLoss, self).__init__()
+        self.loss_fns = loss_fns
+
+    def forward(self, predictions, target):
+        return sum(loss_fn(predictions, target) for loss_fn in self.loss_fns)
+
+def create_data_loader(dataset, batch_size, shuffle=True, num_workers=2, drop_last=False, persistent_workers=True):
+    '''
+    Description: Data loader with throughput settings for the training engine. Batches are collated into pinned memory when
+    CUDA is available, so the engine can copy them to the GPU asynchronously (non_blocking), and the workers are kept alive
+    between epochs instead of being restarted. The augmentations of every worker are seeded from the torch RNG of the main
+    process (seed_transforms_worker). Persistent workers are seeded only once, which a checkpoint can not capture, so for an
+    exact resume (resume_from in train_model) with workers pass persistent_workers=False: the workers are then restarted
+    every epoch with seeds from the saved torch RNG.
+    Input: Dataset, Batch Size, Shuffle Option, Number of Workers, Drop Last Option, Persistent Workers Option
+    Output: Data Loader
+    '''
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, drop_last=drop_last,
+                      pin_memory=torch.cuda.is_available(), persistent_workers=persistent_workers and num_workers > 0,
+                      worker_init_fn=seed_transforms_worker)
+
+def _is_out_of_memory_error(error):
+    return isinstance(error, torch.cuda.OutOfMemoryError) or 'out of memory' in str(error)
+
+def find_max_batch_size(model, dataset, loss_fn, data_source=None, max_batch_size=256, use_amp=True, safety_margin=0.9):
+    '''
+    Description: Binary searches the largest micro batch size a model can be trained with on the device for the crop size of
+    the dataset. A sample of the dataset is repeated to a batch and a forward and backward pass is run for increasing batch
+    sizes (doubling, then bisection between the largest fitting and the smallest failing size) until CUDA runs out of memory.
+    The optimizer states are not allocated by the probe, so the result is reduced by a safety margin. Buffers like the
+    BatchNorm running statistics are restored afterwards. On the CPU there is no out of memory error, so max_batch_size is
+    returned. The effective batch size can then be reached with gradient accumulation in train_model
+    (accumulation_steps = ceil(effective batch size / micro batch size)).
+    Input: Model (on the device), Dataset, Loss Function, Data Source, Upper Limit, AMP Option, Safety Margin
+    Output: Micro Batch Size (Int)
+    '''
+    if not torch.cuda.is_available():
+        return max_batch_size
+
+    rgb_img, hsi_img, mask = dataset[0][:3]
+    input_source = model if data_source is None else data_source
+    buffers = {name: buffer.clone() for name, buffer in model.named_buffers()}
+    model.train()
+
+    def fits(batch_size):
+        repeat = lambda x: x.unsqueeze(0).repeat(batch_size, *([1] * x.dim())) if torch.is_tensor(x) and x.numel() > 0 else x
+        try:
+            model_inputs = select_model_inputs(repeat(rgb_img), repeat(hsi_img), input_source)
+            target = repeat(torch.as_tensor(mask)).to(DEVICE, dtype=torch.long)
+            with torch.cuda.amp.autocast(enabled=use_amp):
+                loss = loss_fn(model(*model_inputs), target)
+            loss.backward()
+            return True
+        except RuntimeError as error:
+            if not _is_out_of_memory_error(error):
+                raise
+            return False
+        finally:
+            model_inputs = target = loss = None
+            model.zero_grad(set_to_none=True)
+            torch.cuda.empty_cache()
+
+    # double until the batch does not fit anymore
+    low, high = 0, 1
+    while high <= max_batch_size and fits(high):
+        low, high = high, high * 2
+    high = min(high, max_batch_size + 1)
+
+    # bisection between the largest fitting and the smallest failing batch size
+    while high - low > 1:
+        middle = (low + high) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle
+
+    with torch.no_grad():
+        for name, buffer in model.named_buffers():
+            buffer.copy_(buffers[name])
+
+    if low == 0:
+        raise RuntimeError('Not even a batch of a single image fits into the device memory')
+    return max(1, int(low * safety_margin))
+
+def snapshot_to_cpu(obj):
+    '''
+    Description: Copies all tensors of a (nested) state dict to the CPU, so the snapshot does not change when the training
+    continues to update the parameters and optimizer states.
+    Input: State Dict (or List, Tuple, Tensor)
+    Output: Copy with CPU Tensors
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(value) for value in obj)
+    return obj
+
+def atomic_torch_save(obj, path):
+    '''
+    Description: Saves to a temporary file next to the target and renames it, so a crash during saving never leaves a
+    truncated checkpoint behind. The temporary file of a failed save is removed.
+    Input: Object to Save, File Path
+    '''
+    tmp_path = f'{path}.tmp'
+    try:
+        torch.save(obj, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class AsyncCheckpointWriter:
+    '''
+    Description: Writes checkpoints on a background thread. save takes a CPU snapshot of the checkpoint and returns, the
+    serialisation (atomic_torch_save) and deletions of old checkpoints run in order on the writer thread, so the training loop
+    does not wait for the disk. The first error of the writer thread is raised at the next save, wait or close. Once a save has
+    failed, queued and later deletions are dropped, so a checkpoint displaced by a checkpoint that was never written is kept.
+    '''
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.error = None
+        self.save_failed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                action, path, obj = job
+                if action == 'save':
+                    try:
+                        atomic_torch_save(obj, path)
+                    except Exception:
+                        self.save_failed = True
+                        raise
+                elif not self.save_failed and os.path.exists(path):
+                    os.remove(path)
+            except Exception as error:
+                # the first error is the cause, later ones are often follow-up errors
+                if self.error is None:
+                    self.error = error
+            finally:
+                self.jobs.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, checkpoint, path):
+        self._raise_error()
+        self.jobs.put(('save', path, snapshot_to_cpu(checkpoint)))
+
+    def delete(self, path):
+        self.jobs.put(('delete', path, None))
+
+    def wait(self):
+        '''
+        Description: Blocks until all queued checkpoints are written.
+        '''
+        self.jobs.join()
+        self._raise_error()
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+        self._raise_error()
+
+def callback_state_keys(callbacks):
+    '''
+    Description: Keys of the callback states in a checkpoint, the class name of each callback with a counter for repeated
+    classes (e.g. EarlyStopping, TopKCheckpoint, MetricsLogger_1).
+    Input: List of Callbacks
+    Output: List of Keys (Strings)
+    '''
+    counts = {}
+    keys = []
+    for callback in callbacks:
+        name = type(callback).__name__
+        keys.append(f'{name}_{counts[name]}' if name in counts else name)
+        counts[name] = counts.get(name, 0) + 1
+    return keys
+
+def save_training_checkpoint(state, path):
+    '''
+    Description: Saves model, optimizer, scaler, epoch and last training loss of the training state to a .pt file, which can
+    be loaded with load_model. The checkpoint contains the full training state (scheduler, loss lists, callback states like
+    the early stopping counter, random number generator and data order states), so the training can be resumed from it
+    (load_training_checkpoint). If the training state has a checkpoint_writer (AsyncCheckpointWriter) the checkpoint is written
+    in the background, otherwise directly. In distributed training only rank 0 saves.
+    Input: Training State (Dictionary), File Path
+    '''
+    if not is_main_process():
+        return
+    checkpoint = {
+        'epoch': state['epoch'],
+        'model_state_dict': unwrap_model(state['model']).state_dict(),
+        'optimizer_state_dict': state['optimizer'].state_dict(),
+        'loss': state['loss'],
+        'scaler_state_dict': state['scaler'].state_dict(),
+        # everything else needed to resume the training exactly (resume_from in train_model)
+        'scheduler_state_dict': state['scheduler'].state_dict() if state['scheduler'] is not None else None,
+        'avg_train_loss_list': list(state['avg_train_loss_list']),
+        'avg_val_loss_list': list(state['avg_val_loss_list']),
+        'callback_states': {key: callback.state_dict()
+                            for key, callback in zip(callback_state_keys(state['callbacks']), state['callbacks'])},
+        'rng_state': training_rng_state(),
+        'data_order_state': data_order_state(state['train_loader']),
+        'transform_rng_state': transform_rng_state(getattr(state['train_loader'], 'dataset', None)),
+        'date': state['date']
+    }
+    if state.get('checkpoint_writer') is not None:
+        state['checkpoint_writer'].save(checkpoint, path)
+    else:
+        atomic_torch_save(checkpoint, path)
+
+def delete_training_checkpoint(state, path):
+    '''
+    Description: Deletes a checkpoint (after all queued checkpoints of the checkpoint_writer are written).
+    Input: Training State (Dictionary), File Path
+    '''
+    if not is_main_process():
+        return
+    if state.get('checkpoint_writer') is not None:
+        state['checkpoint_writer'].delete(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def plot_training_loss(avg_train_loss_list, avg_val_loss_list):
+    '''
+    Description: Plots the average training and validation loss over the epochs on twin axes.
+    Input: List of the average Train Loss, List of the average Validation Loss
+    '''
+    fig, axs = plt.subplots(figsize=(9,6))
+
+    axs.plot(range(len(avg_train_loss_list)), avg_train_loss_list, marker='o', linestyle='-', label='Training Loss', color='blue')
+
+    #create twin axis
+    ax2 = axs.twinx()
+    ax2.plot(range(len(avg_val_loss_list)), avg_val_loss_list, marker='o', linestyle='-', label='Validation Loss', color='orange')
+
+    # Add labels and title
+    axs.set_xlabel('Epochs')
+    axs.set_ylabel('Training Loss', color='blue')
+    ax2.set_ylabel('Validation Loss', color='orange')
+    axs.set_title('Training vs Validation Loss')
+
+    # Show legend for both axes
+    axs.legend(loc='upper left')
+    ax2.legend(loc='upper right')
+
+    plt.grid(True)
+    plt.show()
+
+def update_confusion_matrix(confusion, predictions, mask):
+    '''
+    Description: Adds the pixels of a batch to a running confusion matrix (rows ground truth, columns prediction) on the device
+    with a single bincount, without a sync with the host. Ignore or out of range labels (e.g. 255) are not counted, they go
+    to an extra bin that is dropped.
+    Input: Confusion Matrix (Torch Tensor, classes x classes), Predictions (Logits), Mask
+    Output: Updated Confusion Matrix
+    '''
+    n_classes = confusion.shape[0]
+    mask = mask.flatten().long()
+    valid = (mask >= 0) & (mask < n_classes)
+    index = torch.where(valid, mask * n_classes + predictions.argmax(dim=1).flatten(), n_classes * n_classes)
+    confusion += torch.bincount(index, minlength=n_classes * n_classes + 1)[:n_classes * n_classes].reshape(n_classes, n_classes)
+    return confusion
+
+def confusion_matrix_metrics(confusion, first_defect_class=3):
+    '''
+    Description: IoU and Dice Score per class and averaged over the defect classes and the entire image from a confusion
+    matrix, calculated like calculate_model_metrics (summed intersections over summed unions).
+    Input: Confusion Matrix (Torch Tensor, rows ground truth, columns prediction), First Defect Class
+    Output: Dictionary with class_iou and class_dice (Lists), defect_iou, defect_dice, iou and dice (Floats)
+    '''
+    confusion = confusion.double().cpu()
+    intersection = confusion.diag()
+    denominator = confusion.sum(dim=0) + confusion.sum(dim=1)
+    union = denominator - intersection
+    return {'class_iou': (intersection / (union + 1e-06)).tolist(),
+            'class_dice': (2 * intersection / (denominator + 1e-06)).tolist(),
+            'defect_iou': (intersection[first_defect_class:].sum() / (union[first_defect_class:].sum() + 1e-06)).item(),
+            'defect_dice': (2 * intersection[first_defect_class:].sum() / (denominator[first_defect_class:].sum() + 1e-06)).item(),
+            'iou': (intersection.sum() / (union.sum() + 1e-06)).item(),
+            'dice': (2 * intersection.sum() / (denominator.sum() + 1e-06)).item()}
+
+################################ Training Callbacks #####################################
+
+class TrainingCallback:
+    '''
+    Description: Base class of the training engine callbacks. Every hook gets the training state (dictionary with model,
+    optimizer, scaler, scheduler, epoch, num_epochs, loss, predictions, mask, avg_val_loss, val_confusion_matrix, val_metrics,
+    loss lists, model_name, date, stop_training, data_wait_time, n_train_samples and train_time), which callbacks can read and modify, e.g. set stop_training to end the
+    training after the current epoch.
+    '''
+    def on_train_begin(self, state):
+        pass
+
+    def on_epoch_begin(self, state):
+        pass
+
+    def on_batch_end(self, state):
+        pass
+
+    def on_validation_end(self, state):
+        pass
+
+    def on_epoch_end(self, state):
+        pass
+
+    def on_train_end(self, state):
+        pass
+
+    def state_dict(self):
+        '''
+        Description: State of the callback, which is saved in the checkpoints to resume a training.
+        '''
+        return {}
+
+    def load_state_dict(self, state_dict):
+        pass
+
+class LossPlot(TrainingCallback):
+    '''
+    Description: Plots the training and validation loss every few epochs (plot_loss of train_model). The plot blocks in
+    non-interactive runs, without it nothing is rendered during the training and the curves of the metrics log are plotted
+    afterwards with plot_training_metrics.
+    '''
+    def __init__(self, every_n_epochs=10):
+        self.every_n_epochs = every_n_epochs
+
+    def on_epoch_end(self, state):
+        epoch = state['epoch']
+        if not is_main_process():
+            return
+        if ((epoch%self.every_n_epochs==0) and (epoch>0) or (epoch==state['num_epochs'])):
+            plot_training_loss(state['avg_train_loss_list'], state['avg_val_loss_list'])
+
+def monitored_value(state, monitor):
+    '''
+    Description: Value of the monitored validation result to be minimized, the average validation loss for 'val_loss' or the
+    negative value of a metric of confusion_matrix_metrics (e.g. 'defect_iou').
+    Input: Training State (Dictionary), Monitor (String)
+    Output: Value (Float)
+    '''
+    if monitor == 'val_loss':
+        return state['avg_val_loss']
+    # metrics are maximized, so the negative value is minimized
+    return -state['val_metrics'][monitor]
+
+class EarlyStopping(TrainingCallback):
+    '''
+    Description: Early stopping after the first third of the epochs on the average validation loss ('val_loss') or on a
+    validation metric of the confusion matrix, e.g. 'defect_iou' (higher is better). The best model is saved to
+    best_model_{date}_{model_name}.pt. If patience is 0, early stopping is deactivated.
+    '''
+    def __init__(self, patience=15, monitor='val_loss'):
+        self.patience = patience
+        self.monitor = monitor
+
+    def on_train_begin(self, state):
+        #this is used for early stopping, value should be pretty large
+        self.best_value = 1000
+        self.patience_counter = 0
+
+    def on_epoch_end(self, state):
+        if self.patience > 0 and state['epoch']>int(1/3*state['num_epochs']):
+            value = monitored_value(state, self.monitor)
+            if value < self.best_value:
+                self.best_value = value
+                self.patience_counter = 0
                 # Save the best model
-                torch.save({
-                    'epoch': epoch,
-                    'model_state_dict': model.state_dict(),
-                    'optimizer_state_dict': optimizer.state_dict(),
-                    'loss': loss,
-                    'scaler_state_dict': scaler.state_dict()
-                }, f'best_model_{_today}_{model_name}.pt')
+                save_training_checkpoint(state, f"best_model_{state['date']}_{state['model_name']}.pt")
             else:
-                patience_counter += 1
-                if patience_counter >= patience:
-                    print(f'Early stopping at epoch {epoch}')
+                self.patience_counter += 1
+                if self.patience_counter >= self.patience:
+                    if is_main_process():
+                        print(f"Early stopping at epoch {state['epoch']}")
+                    state['stop_training'] = True
+
+    def state_dict(self):
+        return {'best_value': self.best_value, 'patience_counter': self.patience_counter}
+
+    def load_state_dict(self, state_dict):
+        self.best_value = state_dict['best_value']
+        self.patience_counter = state_dict['patience_counter']
+
+class PeriodicCheckpoint(TrainingCallback):
+    '''
+    Description: Saves the model to model_e{epoch}_{date}_{model_name}.pt at the end of the training and, with save_state, at
+    epoch 50 and 75. Nothing is saved in the epoch in which early stopping ends the training.
+    '''
+    def __init__(self, save_state=False, save_epochs=(50, 75)):
+        self.save_state = save_state
+        self.save_epochs = save_epochs
+
+    def on_epoch_end(self, state):
+        if state['stop_training']:
+            return
+        epoch = state['epoch']
+        if (epoch in self.save_epochs and self.save_state == True) or epoch==(state['num_epochs']-1):
+            save_training_checkpoint(state, f"model_e{epoch}_{state['date']}_{state['model_name']}.pt")
+
+class TopKCheckpoint(TrainingCallback):
+    '''
+    Description: Keeps the checkpoints of the k best epochs by a validation result ('val_loss' or a metric like 'defect_iou')
+    as checkpoint_e{epoch}_{date}_{model_name}.pt and deletes checkpoints that drop out of the top k.
+    '''
+    def __init__(self, k=3, monitor='val_loss'):
+        self.k = k
+        self.monitor = monitor
+
+    def on_train_begin(self, state):
+        self.best_checkpoints = []
+
+    def on_epoch_end(self, state):
+        value = monitored_value(state, self.monitor)
+        if len(self.best_checkpoints) == self.k and value >= self.best_checkpoints[-1][0]:
+            return
+
+        path = f"checkpoint_e{state['epoch']}_{state['date']}_{state['model_name']}.pt"
+        self.best_checkpoints.append((value, path))
+        self.best_checkpoints.sort(key=lambda checkpoint: checkpoint[0])
+        worst_path = self.best_checkpoints.pop()[1] if len(self.best_checkpoints) > self.k else None
+
+        # the saved state already tracks this checkpoint, so a resumed training keeps deleting it when it drops out
+        save_training_checkpoint(state, path)
+        if worst_path is not None:
+            delete_training_checkpoint(state, worst_path)
+
+    def state_dict(self):
+        return {'best_checkpoints': list(self.best_checkpoints)}
+
+    def load_state_dict(self, state_dict):
+        self.best_checkpoints = list(state_dict['best_checkpoints'])
+
+class LastCheckpoint(TrainingCallback):
+    '''
+    Description: Overwrites last_checkpoint_{model_name}.pt at the end of every epoch, so an interrupted training (e.g. on a
+    preemptible machine) can be resumed with resume_from and loses at most one epoch. The resumed training continues with the
+    same data order and augmentations only with num_workers=0 or non persistent workers seeded by seed_transforms_worker (see
+    create_data_loader), since persistent workers keep their own augmentation random state.
+    '''
+    def on_epoch_end(self, state):
+        save_training_checkpoint(state, f"last_checkpoint_{state['model_name']}.pt")
+
+class MetricsLogger(TrainingCallback):
+    '''
+    Description: Headless metrics sink, appends one JSON line per record to a log file: a 'run' record at the start of the
+    training, a 'step' record (training loss and learning rate) every log_every_n_steps steps and an 'epoch' record with the
+    average losses, learning rate, validation metrics, epoch and training time, training throughput (samples per second) and
+    the time spent waiting for the data loader. The file is only appended to, so a resumed training continues the same log.
+    Only the main process writes. The log is read by load_training_metrics and plotted by plot_training_metrics.
+    '''
+    def __init__(self, path, log_every_n_steps=25):
+        self.path = path
+        self.log_every_n_steps = log_every_n_steps
+        self.step = 0
+
+    def write(self, record):
+        if not is_main_process():
+            return
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def on_train_begin(self, state):
+        self.write({'type': 'run', 'model_name': state['model_name'], 'date': state['date'],
+                    'num_epochs': state['num_epochs'], 'time': datetime.now().isoformat()})
+
+    def on_epoch_begin(self, state):
+        self.epoch_start = time.perf_counter()
+        self.lr = state['optimizer'].param_groups[0]['lr']
+
+    def on_batch_end(self, state):
+        self.step += 1
+        if self.step % self.log_every_n_steps == 0:
+            # the only host sync of this callback during the epoch
+            self.write({'type': 'step', 'epoch': state['epoch'], 'step': self.step, 'loss': state['loss'].item(), 'lr': self.lr})
+
+    def on_epoch_end(self, state):
+        self.write({'type': 'epoch', 'epoch': state['epoch'], 'step': self.step,
+                    'train_loss': state['avg_train_loss_list'][-1], 'val_loss': state['avg_val_loss_list'][-1], 'lr': self.lr,
+                    'epoch_time': time.perf_counter() - self.epoch_start, 'train_time': state['train_time'],
+                    'throughput': state['n_train_samples'] / state['train_time'], 'data_wait_time': state['data_wait_time'],
+                    **state['val_metrics']})
+
+    def state_dict(self):
+        return {'step': self.step}
+
+    def load_state_dict(self, state_dict):
+        self.step = state_dict['step']
+
+class TrainingProfiler(TrainingCallback):
+    '''
+    Description: Profiles the training steps with torch.profiler (CPU and CUDA activities, input shapes and memory). The first
+    wait steps are skipped (cudnn benchmark, allocator warm-up), the profiler warms up for warmup steps and records the next
+    active steps, which are written to path as Chrome trace (chrome://tracing or Perfetto). The remaining steps run without the
+    profiler. Only the main process profiles.
+    '''
+    def __init__(self, path, wait=5, warmup=2, active=5):
+        self.path = path
+        self.wait = wait
+        self.warmup = warmup
+        self.active = active
+        self.profiler = None
+
+    def on_train_begin(self, state):
+        if not is_main_process():
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities,
+                                               schedule=torch.profiler.schedule(wait=self.wait, warmup=self.warmup,
+                                                                                active=self.active, repeat=1),
+                                               on_trace_ready=lambda profiler: profiler.export_chrome_trace(self.path),
+                                               record_shapes=True, profile_memory=True)
+        self.profiler.start()
+
+    def on_batch_end(self, state):
+        if self.profiler is not None:
+            self.profiler.step()
+
+    def on_train_end(self, state):
+        # also writes the trace if the training ends while the profiler is recording
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+def load_training_checkpoint(state, path):
+    '''
+    Description: Restores the full training state of a checkpoint (model, optimizer, scaler, scheduler, loss lists, callback
+    states, random number generator, augmentation and data order states) into the training state of train_model. The callback states are
+    matched by class name, so callbacks can be added or removed on resume (e.g. plot_loss, keep_top_k or save_last),
+    callbacks without a saved state keep their initial state. Checkpoints without the full state (saved before) restore what they contain.
+    Input: Training State (Dictionary), File Path
+    Output: Epoch to continue the training with
+    '''
+    device = next(state['model'].parameters()).device
+    checkpoint = torch.load(path, map_location=device, weights_only=False)
+
+    unwrap_model(state['model']).load_state_dict(checkpoint['model_state_dict'])
+    state['optimizer'].load_state_dict(checkpoint['optimizer_state_dict'])
+    state['scaler'].load_state_dict(checkpoint['scaler_state_dict'])
+    if state['scheduler'] is not None and checkpoint.get('scheduler_state_dict') is not None:
+        state['scheduler'].load_state_dict(checkpoint['scheduler_state_dict'])
+
+    # the lists are changed in place, since they belong to the caller
+    state['avg_train_loss_list'][:] = checkpoint.get('avg_train_loss_list', [])
+    state['avg_val_loss_list'][:] = checkpoint.get('avg_val_loss_list', [])
+    callback_states = checkpoint.get('callback_states', {})
+    for key, callback in zip(callback_state_keys(state['callbacks']), state['callbacks']):
+        if key in callback_states:
+            callback.load_state_dict(callback_states[key])
+
+    if checkpoint.get('rng_state') is not None:
+        set_training_rng_state(checkpoint['rng_state'])
+    if checkpoint.get('data_order_state') is not None:
+        set_data_order_state(state['train_loader'], checkpoint['data_order_state'])
+    if checkpoint.get('transform_rng_state') is not None:
+        set_transform_rng_state(getattr(state['train_loader'], 'dataset', None), checkpoint['transform_rng_state'])
+
+    state['loss'] = checkpoint['loss']
+    state['date'] = checkpoint.get('date', state['date'])
+    return checkpoint['epoch'] + 1
+
+################################ Training Engine #####################################
+
+@contextlib.contextmanager
+def cudnn_benchmark_mode(enabled):
+    '''
+    Description: Sets torch.backends.cudnn.benchmark inside the block and restores the previous setting afterwards, so the
+    training engine does not change the global backend state (e.g. the determinism of seed_everything). With benchmark cudnn
+    picks the fastest convolution algorithms for the fixed input size, pass False for deterministic runs.
+    Input: Benchmark Option (Bool)
+    '''
+    previous = torch.backends.cudnn.benchmark
+    torch.backends.cudnn.benchmark = enabled
+    try:
+        yield
+    finally:
+        torch.backends.cudnn.benchmark = previous
+
+def _run_callbacks(state, hook):
+    for callback in state['callbacks']:
+        getattr(callback, hook)(state)
+
+def _create_training_state(model, loss_fn, optimizer, num_epochs, train_loader, scaler=None, scheduler=None,
+                           avg_train_loss_list=None, avg_val_loss_list=None, TRAIN_BATCH_SIZE=None, VAL_BATCH_SIZE=None,
+                           activate_scheduler=True, patience=15, model_name='', data_source=None, save_state=False,
+                           distillation_loss_fn=None, callbacks=None, plot_loss=False, use_amp=True,
+                           early_stopping_metric='val_loss', accumulation_steps=1, async_checkpoints=True, keep_top_k=None,
+                           save_last=False, metrics_path=None, log_every_n_steps=25, compile_model=False, profile_path=None,
+                           log_prefix=''):
+    '''
+    Description: Training state of one model with its default callbacks, shared by train_model and train_models. The
+    parameters are the ones of train_model. With compile_model the forward passes run through torch.compile, the checkpoints
+    and callbacks use the uncompiled model (same parameters).
+    Output: Training State (Dictionary)
+    '''
+    amp_enabled = use_amp and torch.cuda.is_available()
+    if scaler is None:
+        scaler = GradScaler(enabled=amp_enabled)
+    if avg_train_loss_list is None:
+        avg_train_loss_list = []
+    if avg_val_loss_list is None:
+        avg_val_loss_list = []
+
+    default_callbacks = ([LossPlot()] if plot_loss else []) + [EarlyStopping(patience, early_stopping_metric), PeriodicCheckpoint(save_state)]
+    if keep_top_k is not None:
+        default_callbacks.append(TopKCheckpoint(keep_top_k, early_stopping_metric))
+    if save_last:
+        default_callbacks.append(LastCheckpoint())
+    if metrics_path is not None:
+        default_callbacks.append(MetricsLogger(metrics_path, log_every_n_steps))
+    if profile_path is not None:
+        default_callbacks.append(TrainingProfiler(profile_path))
+
+    #in distributed mode (DistributedDataParallel model) only rank 0 logs and saves
+    if is_main_process():
+        log = lambda message: print(f'{log_prefix}{message}')
+    else:
+        log = lambda message: None
+
+    return {'model': model, 'optimizer': optimizer, 'scaler': scaler, 'scheduler': scheduler, 'num_epochs': num_epochs,
+            'model_name': model_name, 'date': datetime.today().strftime('%Y-%m-%d'), 'epoch': 0, 'loss': None,
+            'avg_train_loss_list': avg_train_loss_list, 'avg_val_loss_list': avg_val_loss_list, 'stop_training': False,
+            'checkpoint_writer': AsyncCheckpointWriter() if async_checkpoints and is_main_process() else None,
+            'callbacks': default_callbacks + list(callbacks or []), 'train_loader': train_loader,
+            # engine settings of the model
+            'forward_model': torch.compile(model) if compile_model else model,
+            'loss_fn': loss_fn, 'distillation_loss_fn': distillation_loss_fn, 'device': next(model.parameters()).device,
+            'input_source': model if data_source is None else data_source, 'amp_enabled': amp_enabled,
+            'accumulation_steps': accumulation_steps, 'activate_scheduler': activate_scheduler,
+            'train_divisor': TRAIN_BATCH_SIZE, 'val_divisor': VAL_BATCH_SIZE, 'log': log}
+
+def _begin_epoch(state, epoch):
+    state['log'](f'Epoch: {epoch}')
+    state['epoch'] = epoch
+    _run_callbacks(state, 'on_epoch_begin')
+
+    #running losses are kept on the device (in double precision, like a sum of python floats)
+    state['train_batch_loss'] = torch.zeros((), dtype=torch.float64, device=state['device'])
+    state['val_batch_loss'] = torch.zeros((), dtype=torch.float64, device=state['device'])
+    state['val_confusion'] = None
+    # host side timing of the epoch for the metrics log (time spent waiting for the data loader and samples per second)
+    state['data_wait_time'] = 0.0
+    state['n_train_samples'] = 0
+
+    state['model'].train()
+    state['optimizer'].zero_grad(set_to_none=True)
+
+def _training_step(state, model_inputs, mask, batch, batch_idx, n_batches, non_blocking):
+    '''
+    Description: Forward and backward pass of one batch (already on the device of the model). With accumulation_steps > 1 the
+    gradients of several (micro) batches are accumulated and the optimizer steps at the end of every accumulation window, so
+    the effective batch size is decoupled from the memory (see find_max_batch_size); GradScaler only unscales and checks the
+    summed gradients once per optimizer step. With a distillation loss the train loader has to return the cached teacher
+    logits as fourth element (_WH_RGB_HSI_Distillation_Dataset), the distillation loss is added to the training loss.
+    Output: Loss of the Batch
+    '''
+    model, optimizer, scaler = state['model'], state['optimizer'], state['scaler']
+    accumulation_steps, amp_enabled = state['accumulation_steps'], state['amp_enabled']
+    state['n_train_samples'] += mask.shape[0]
+
+    # the gradients of DistributedDataParallel are only all-reduced in the last batch of an accumulation window
+    window_start = batch_idx - batch_idx % accumulation_steps
+    window_size = min(accumulation_steps, n_batches - window_start)
+    last_in_window = batch_idx + 1 == window_start + window_size
+    sync_context = model.no_sync() if isinstance(model, DDP) and not last_in_window else contextlib.nullcontext()
+
+    with sync_context:
+        with torch.cuda.amp.autocast(enabled=amp_enabled):
+            predictions = state['forward_model'](*model_inputs)
+            loss = state['loss_fn'](predictions, mask)
+
+        # distillation from cached teacher logits
+        if state['distillation_loss_fn'] is not None:
+            teacher_logits = batch[3].to(state['device'], non_blocking=non_blocking)
+            with torch.cuda.amp.autocast(enabled=amp_enabled):
+                loss = loss + state['distillation_loss_fn'](predictions, teacher_logits)
+
+        # backward pass, the gradients are accumulated over accumulation_steps batches (fewer for the last ones)
+        scaler.scale(loss / window_size).backward()
+    if last_in_window:
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad(set_to_none=True)
+
+    # accumulate on the device
+    state['train_batch_loss'] += loss.detach()
+
+    state.update(loss=loss, predictions=predictions, mask=mask)
+    _run_callbacks(state, 'on_batch_end')
+    return loss
+
+def _end_training_epoch(state, n_batches, train_start):
+    #calculate average loss (averaged over all processes) and add to the list for later visualisation
+    train_batch_loss = (all_reduce_sum(state['train_batch_loss']) / world_size()).item()
+    state['train_time'] = time.perf_counter() - train_start
+    train_divisor = state['train_divisor'] if state['train_divisor'] is not None else n_batches
+    state['log'](f'Average Train Batch Loss: {train_batch_loss/train_divisor:.4f}')
+    state['avg_train_loss_list'].append(train_batch_loss/train_divisor)
+
+def _validation_step(state, model_inputs, mask):
+    '''
+    Description: Validation loss of one batch (already on the device of the model) and update of the running confusion matrix,
+    has to be called without gradients.
+    Output: Validation Loss of the Batch
+    '''
+    with torch.cuda.amp.autocast(enabled=state['amp_enabled']):
+        predictions = state['forward_model'](*model_inputs)
+        val_loss = state['loss_fn'](predictions, mask)
+
+    # running confusion matrix of the validation set
+    if state['val_confusion'] is None:
+        state['val_confusion'] = torch.zeros(predictions.shape[1], predictions.shape[1], dtype=torch.long, device=predictions.device)
+    update_confusion_matrix(state['val_confusion'], predictions, mask)
+
+    # accumulate on the device
+    state['val_batch_loss'] += val_loss.detach()
+    return val_loss
+
+def _end_epoch(state, n_batches):
+    log, optimizer, scheduler = state['log'], state['optimizer'], state['scheduler']
+
+    #calculate average loss (averaged over all processes) and add to the list for later visualisation
+    #the validation shards of the processes can differ in size, so the number of batches is averaged over all processes too
+    #without validation batches the loss is nan (so it never counts as an improvement) and the confusion matrix is empty
+    if is_distributed():
+        n_batches = all_reduce_sum(torch.tensor(float(n_batches), device=state['device'])).item() / world_size()
+    val_batch_loss = (all_reduce_sum(state['val_batch_loss']) / world_size()).item() if n_batches else float('nan')
+    state['avg_val_loss'] = val_batch_loss / max(n_batches, 1)
+    val_divisor = state['val_divisor'] if state['val_divisor'] is not None else max(n_batches, 1)
+    log(f'Average Validation Batch Loss: {val_batch_loss/val_divisor:.4f}')
+    state['avg_val_loss_list'].append(val_batch_loss/val_divisor)
+    if state['val_confusion'] is None:
+        n_classes = state['predictions'].shape[1] if state.get('predictions') is not None else N_CLASSES
+        state['val_confusion'] = torch.zeros(n_classes, n_classes, dtype=torch.long, device=state['device'])
+
+    #per class IoU and Dice Score of the validation set (of all processes)
+    state['val_confusion_matrix'] = all_reduce_sum(state['val_confusion'])
+    state['val_metrics'] = confusion_matrix_metrics(state['val_confusion_matrix'])
+    log(f"Validation IoU (Defects Only): {state['val_metrics']['defect_iou']:.4f}, Dice Score (Defects Only): {state['val_metrics']['defect_dice']:.4f}")
+    _run_callbacks(state, 'on_validation_end')
+
+    #######################################################
+    ############### adjust learning rate ##################
+    #######################################################
+
+    if state['activate_scheduler'] and scheduler is not None:
+        before_lr = optimizer.param_groups[0]["lr"]
+        scheduler.step()
+        after_lr = optimizer.param_groups[0]["lr"]
+        log(f"Epoch {state['epoch']}: Adam lr {before_lr:.4f} -> {after_lr:.4f}")
+
+    # visualisation, early stopping and saving
+    _run_callbacks(state, 'on_epoch_end')
+
+def train_model(model, train_loader, val_loader, num_epochs, loss_fn, optimizer, scaler=None, scheduler=None,
+                avg_train_loss_list=None, avg_val_loss_list=None, TRAIN_BATCH_SIZE=None, VAL_BATCH_SIZE=None,
+                activate_scheduler=True, patience=15, model_name='', data_source=None, save_state=False,
+                distillation_loss_fn=None, callbacks=None, plot_loss=False, use_amp=True, non_blocking=True, sync_every_n_steps=25,
+                early_stopping_metric='val_loss', accumulation_steps=1, async_checkpoints=True, keep_top_k=None,
+                save_last=False, resume_from=None, metrics_path=None, log_every_n_steps=25, cudnn_benchmark=True,
+                compile_model=False, profile_path=None):
+    '''
+    Description: Training engine for all models. The loss is pluggable (any function of predictions and mask, e.g.
+    CombinedLoss(ce_loss_fn, dice_loss_fn)) and the model inputs are taken from the model registry, unless a data source is
+    given. Each batch is moved to the device once with non_blocking copies and the running losses and the validation confusion
+    matrix stay on the device until the end of the epoch. Early stopping, saving, loss plotting, metrics logging and profiling
+    are callbacks (EarlyStopping, PeriodicCheckpoint, TopKCheckpoint, LastCheckpoint, LossPlot, MetricsLogger, TrainingProfiler),
+    further TrainingCallbacks can be added with callbacks. With resume_from an interrupted training continues after the epoch
+    of the checkpoint (load_training_checkpoint). Several models can be trained on the same data loaders with train_models.
+    Input: Pytorch Model, Train Loader, Validation Loader, Number of Epochs, Loss Function, Optimizer, Pytorch Scaler,
+    Scheduler, List to track the average Train & Val Loss (for complete Visualisation of Training), Batch sizes the summed
+    losses are divided by (number of batches if None), Scheduler Options, Patience for Early Stop Option (0 to deactivate),
+    Model Name for Save state, Data Source, Save State option, Distillation Loss, Additional Callbacks, Plot Option, AMP Option,
+    Non Blocking Option, Number of Steps between Progress Bar Updates, Early Stopping Metric ('val_loss' or a key of
+    confusion_matrix_metrics), Number of Batches per Optimizer Step, Asynchronous Checkpoint Option, Number of best
+    Checkpoints to keep (None for none), Save Last Checkpoint Option, Checkpoint to Resume from (File Path), Metrics Log (JSONL
+    File Path, None for none), Number of Steps between logged Training Losses, cudnn Benchmark Option, torch.compile Option,
+    Profiler Trace (File Path, None for none)
+    Output: Trained Model, Last Training Loss, List to track the average Train & Val Loss
+    '''
+    state = _create_training_state(model, loss_fn, optimizer, num_epochs, train_loader, scaler=scaler, scheduler=scheduler,
+                                   avg_train_loss_list=avg_train_loss_list, avg_val_loss_list=avg_val_loss_list,
+                                   TRAIN_BATCH_SIZE=TRAIN_BATCH_SIZE, VAL_BATCH_SIZE=VAL_BATCH_SIZE,
+                                   activate_scheduler=activate_scheduler, patience=patience, model_name=model_name,
+                                   data_source=data_source, save_state=save_state, distillation_loss_fn=distillation_loss_fn,
+                                   callbacks=callbacks, plot_loss=plot_loss, use_amp=use_amp,
+                                   early_stopping_metric=early_stopping_metric, accumulation_steps=accumulation_steps,
+                                   async_checkpoints=async_checkpoints, keep_top_k=keep_top_k, save_last=save_last,
+                                   metrics_path=metrics_path, log_every_n_steps=log_every_n_steps,
+                                   compile_model=compile_model, profile_path=profile_path)
+    log = state['log']
+
+    log('Training beginning with following parameters:')
+    log(f'No. Epochs: {num_epochs}')
+    _run_callbacks(state, 'on_train_begin')
+
+    start_epoch = 0
+    if resume_from is not None:
+        start_epoch = load_training_checkpoint(state, resume_from)
+        log(f'Resuming training at epoch {start_epoch}')
+
+    try:
+        with cudnn_benchmark_mode(cudnn_benchmark):
+            for epoch in range(start_epoch, num_epochs):
+
+                if isinstance(getattr(train_loader, 'sampler', None), DistributedSampler):
+                    train_loader.sampler.set_epoch(epoch)
+                _begin_epoch(state, epoch)
+
+                #####################################################
+                ############### training instance ###################
+                #####################################################
+
+                train_loop = tqdm(enumerate(train_loader),total=len(train_loader), mininterval=1.0, disable=not is_main_process())
+                train_start = data_start = time.perf_counter()
+                for batch_idx, batch in train_loop:
+                    state['data_wait_time'] += time.perf_counter() - data_start
+                    rgb_img, hsi_img, mask = batch[:3]
+
+                    #put the model inputs onto cuda device if available, only once per batch
+                    model_inputs = select_model_inputs(rgb_img, hsi_img, state['input_source'], device=state['device'], non_blocking=non_blocking)
+                    mask = mask.to(state['device'], dtype=torch.long, non_blocking=non_blocking)
+
+                    loss = _training_step(state, model_inputs, mask, batch, batch_idx, len(train_loader), non_blocking)
+
+                    # only sync for the tqdm loop every few steps
+                    if batch_idx % sync_every_n_steps == 0:
+                        train_loop.set_postfix(loss=loss.item(), refresh=False)
+                    data_start = time.perf_counter()
+
+                _end_training_epoch(state, len(train_loader), train_start)
+
+                ####################################################
+                ############## validation instance #################
+                ####################################################
+
+                #evaluation loop, so same thing without a backward pass
+                model.eval()
+                val_loop = tqdm(enumerate(val_loader),total=len(val_loader), mininterval=1.0, disable=not is_main_process())
+                for batch_idx, batch in val_loop:
+                    rgb_img, hsi_img, mask = batch[:3]
+                    with torch.no_grad():
+                        model_inputs = select_model_inputs(rgb_img, hsi_img, state['input_source'], device=state['device'], non_blocking=non_blocking)
+                        mask = mask.to(state['device'], dtype=torch.long, non_blocking=non_blocking)
+                        val_loss = _validation_step(state, model_inputs, mask)
+
+                    if batch_idx % sync_every_n_steps == 0:
+                        val_loop.set_postfix(val_loss=val_loss.item(), refresh=False)
+
+                # validation results, learning rate, visualisation, early stopping and saving
+                _end_epoch(state, len(val_loader))
+                if state['stop_training']:
                     break
 
-        #save model every at epoch 50 and 75 and at the end of the training
-        if (epoch==50 and save_state == True) or (epoch==75 and save_state == True) or epoch==(num_epochs-1):
-            # Save all the elements to a file
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'loss': loss,
-                'scaler_state_dict': scaler.state_dict()
-            }, f'model_e{epoch}_{_today}_{model_name}.pt')
-            
-    return model, loss, avg_train_loss_list, avg_val_loss_list
+            _run_callbacks(state, 'on_train_end')
+    finally:
+        # wait until all checkpoints are written
+        if state['checkpoint_writer'] is not None:
+            state['checkpoint_writer'].close()
+
+    return model, state['loss'], state['avg_train_loss_list'], state['avg_val_loss_list']
+
+TrainingEntry = namedtuple('TrainingEntry', ['model', 'loss_fn', 'optimizer', 'data_source', 'model_name', 'scheduler',
+                                             'callbacks', 'metrics_path', 'distillation_loss_fn'],
+                           defaults=(None, '', None, None, None, None))
+
+def _shared_model_inputs(batch_cache, rgb_img, hsi_img, mask, state, non_blocking):
+    '''
+    Description: Model inputs and mask of a batch on the device of a model, every input is copied to each device only once
+    and shared by all models with the same inputs.
+    '''
+    key = (state['device'], model_input_spec(state['input_source']))
+    if key not in batch_cache:
+        batch_cache[key] = select_model_inputs(rgb_img, hsi_img, state['input_source'], device=state['device'], non_blocking=non_blocking)
+    mask_key = (state['device'], 'mask')
+    if mask_key not in batch_cache:
+        batch_cache[mask_key] = mask.to(state['device'], dtype=torch.long, non_blocking=non_blocking)
+    return batch_cache[key], batch_cache[mask_key]
+
+def train_models(entries, train_loader, val_loader, num_epochs, activate_scheduler=True, patience=15, save_state=False,
+                 plot_loss=False, use_amp=True, non_blocking=True, sync_every_n_steps=25, early_stopping_metric='val_loss',
+                 accumulation_steps=1, async_checkpoints=True, keep_top_k=None, save_last=False, log_every_n_steps=25,
+                 cudnn_benchmark=True, compile_model=False):
+    '''
+    Description: Trains several models in one pass over a shared data pipeline, e.g. for comparing models on the same data.
+    Every batch is loaded and augmented once and fed to all models in turn, the model inputs are copied once per device and
+    data source (models can be placed on different GPUs, the kernels of the models then run concurrently). Each model has its
+    own training state like in train_model: loss, optimizer, scheduler, scaler, callbacks, checkpoints, metrics log, early
+    stopping and distillation loss (with a distillation loss the train loader has to return the cached teacher logits, see
+    train_model). Models that stopped early are skipped, the training ends when all models stopped. All models see the same data
+    order; to resume a single interrupted model use train_model with resume_from.
+    Input: List of TrainingEntry (model, loss_fn, optimizer and optionally data_source, model_name, scheduler, callbacks,
+    metrics_path, distillation_loss_fn; plain tuples in this order work as well), Train Loader, Validation Loader, Number of Epochs, the remaining
+    options apply to all models (see train_model)
+    Output: List of (Trained Model, Last Training Loss, List of the average Train Loss, List of the average Validation Loss)
+    '''
+    entries = [TrainingEntry(*entry) for entry in entries]
+    # the model names are part of the checkpoint file names
+    model_names = [entry.model_name or f'model_{i}' for i, entry in enumerate(entries)]
+    if len(set(model_names)) != len(model_names):
+        raise ValueError(f'Model names have to be unique: {model_names}')
+
+    states = [_create_training_state(entry.model, entry.loss_fn, entry.optimizer, num_epochs, train_loader,
+                                     scheduler=entry.scheduler, activate_scheduler=activate_scheduler, patience=patience,
+                                     model_name=model_name, data_source=entry.data_source, save_state=save_state,
+                                     distillation_loss_fn=entry.distillation_loss_fn, callbacks=entry.callbacks,
+                                     plot_loss=plot_loss, use_amp=use_amp,
+                                     early_stopping_metric=early_stopping_metric, accumulation_steps=accumulation_steps,
+                                     async_checkpoints=async_checkpoints, keep_top_k=keep_top_k, save_last=save_last,
+                                     metrics_path=entry.metrics_path, log_every_n_steps=log_every_n_steps,
+                                     compile_model=compile_model, log_prefix=f'[{model_name}] ')
+              for entry, model_name in zip(entries, model_names)]
+
+    if is_main_process():
+        print('Training beginning with following parameters:')
+        print(f'No. Epochs: {num_epochs}, Models: {", ".join(model_names)}')
+    for state in states:
+        _run_callbacks(state, 'on_train_begin')
+
+    try:
+        with cudnn_benchmark_mode(cudnn_benchmark):
+            for epoch in range(num_epochs):
+
+                active_states = [state for state in states if not state['stop_training']]
+                if not active_states:
+                    break
+
+                if isinstance(getattr(train_loader, 'sampler', None), DistributedSampler):
+                    train_loader.sampler.set_epoch(epoch)
+                for state in active_states:
+                    _begin_epoch(state, epoch)
+
+                #####################################################
+                ############### training instance ###################
+                #####################################################
+
+                train_loop = tqdm(enumerate(train_loader),total=len(train_loader), mininterval=1.0, disable=not is_main_process())
+                train_start = data_start = time.perf_counter()
+                for batch_idx, batch in train_loop:
+                    data_wait_time = time.perf_counter() - data_start
+                    rgb_img, hsi_img, mask = batch[:3]
+
+                    batch_cache = {}
+                    losses = {}
+                    for state in active_states:
+                        state['data_wait_time'] += data_wait_time
+                        model_inputs, model_mask = _shared_model_inputs(batch_cache, rgb_img, hsi_img, mask, state, non_blocking)
+                        losses[state['model_name']] = _training_step(state, model_inputs, model_mask, batch, batch_idx,
+                                                                     len(train_loader), non_blocking)
+
+                    if batch_idx % sync_every_n_steps == 0:
+                        train_loop.set_postfix({name: loss.item() for name, loss in losses.items()}, refresh=False)
+                    data_start = time.perf_counter()
+
+                for state in active_states:
+                    _end_training_epoch(state, len(train_loader), train_start)
+
+                ####################################################
+                ############## validation instance #################
+                ####################################################
+
+                for state in active_states:
+                    state['model'].eval()
+                val_loop = tqdm(enumerate(val_loader),total=len(val_loader), mininterval=1.0, disable=not is_main_process())
+                for batch_idx, batch in val_loop:
+                    rgb_img, hsi_img, mask = batch[:3]
+
+                    batch_cache = {}
+                    val_losses = {}
+                    with torch.no_grad():
+                        for state in active_states:
+                            model_inputs, model_mask = _shared_model_inputs(batch_cache, rgb_img, hsi_img, mask, state, non_blocking)
+                            val_losses[state['model_name']] = _validation_step(state, model_inputs, model_mask)
+
+                    if batch_idx % sync_every_n_steps == 0:
+                        val_loop.set_postfix({name: loss.item() for name, loss in val_losses.items()}, refresh=False)
+
+                # validation results, learning rate, visualisation, early stopping and saving of every model
+                for state in active_states:
+                    _end_epoch(state, len(val_loader))
+
+            for state in states:
+                _run_callbacks(state, 'on_train_end')
+    finally:
+        # wait until all checkpoints are written
+        for state in states:
+            if state['checkpoint_writer'] is not None:
+                state['checkpoint_writer'].close()
+
+    return [(state['model'], state['loss'], state['avg_train_loss_list'], state['avg_val_loss_list']) for state in states]
+
+# sensor fusion model training with two possible loss functions
+def sf_model_training_multiloss(model, train_loader, val_loader, num_epochs, ce_loss_fn, dice_loss_fn, optimizer, scaler, scheduler, 
+                            avg_train_loss_list, avg_val_loss_list, TRAIN_BATCH_SIZE, VAL_BATCH_SIZE,
+                             activate_scheduler=True, patience=15, model_name='', data_source=None, save_state = False,
+                             distillation_loss_fn=None, resume_from=None, plot_loss=False, metrics_path=None):
+    '''
+    Description: Model Training for Sensor fusion with two loss functions (Cross Entropy and Dice Loss), runs train_model with
+    their sum as loss function.
+    Input: Pytorch Model, Train Loader, Validation Loader, Number of Epochs, Cross Entropy Loss, Dice Loss, Optimizer, Pytorch Scaler, 
+    Scheduler, List to track the average Train & Val Loss (for complete Visualisation of Training), Batch sizes, Scheduler Options,
+    Patience for Early Stop Option, Model Name for Save state, Data Source, Save State option, Distillation Loss,
+    Checkpoint to Resume from (File Path, see train_model), Plot Option, Metrics Log (JSONL File Path, see train_model)
+    Output: Trained Model, List to track the average Train & Val Loss (for complete Visualisation of Training)
+    '''
+    return train_model(model, train_loader, val_loader, num_epochs, CombinedLoss(ce_loss_fn, dice_loss_fn), optimizer, scaler,
+                       scheduler, avg_train_loss_list, avg_val_loss_list, TRAIN_BATCH_SIZE, VAL_BATCH_SIZE,
+                       activate_scheduler=activate_scheduler, patience=patience, model_name=model_name, data_source=data_source,
+                       save_state=save_state, distillation_loss_fn=distillation_loss_fn, resume_from=resume_from,
+                       plot_loss=plot_loss, metrics_path=metrics_path)
 
 # sensor fusion model training with one possible loss functions (same as above, only used for the baseline model)
 def sf_model_training(model, train_loader, val_loader, num_epochs, loss_fn, optimizer, scaler, scheduler, 
                             avg_train_loss_list, avg_val_loss_list, TRAIN_BATCH_SIZE, VAL_BATCH_SIZE,
-                             activate_scheduler=True, patience=15, model_name='', data_source='rgb', save_state = False):
-
-    _today=datetime.today().strftime('%Y-%m-%d')
-    print('Training beginning with following parameters:')
-    print(f'No. Epochs: {num_epochs}')
+                             activate_scheduler=True, patience=15, model_name='', data_source=None, save_state = False,
+                             resume_from=None, plot_loss=False, metrics_path=None):
+    '''
+    Description: Model Training for Sensor fusion with one loss function, runs train_model.
+    '''
+    return train_model(model, train_loader, val_loader, num_epochs, loss_fn, optimizer, scaler, scheduler,
+                       avg_train_loss_list, avg_val_loss_list, TRAIN_BATCH_SIZE, VAL_BATCH_SIZE,
+                       activate_scheduler=activate_scheduler, patience=patience, model_name=model_name, data_source=data_source,
+                       save_state=save_state, resume_from=resume_from, plot_loss=plot_loss, metrics_path=metrics_path)
 
-    #this is used for early stopping, value should be pretty large
-    best_val_loss = 1000
-    
-    #training with Cross Entropy Loss
-    for epoch in range(num_epochs):
-        
-        print(f'Epoch: {epoch}')
-        train_batch_loss=0
-        val_batch_loss=0
-        train_batch_iou=0
-        val_batch_iou=0
-        
-        #####################################################
-        ############### training instance ###################
-        #####################################################
-        
-        model.train()
-        train_loop = tqdm(enumerate(train_loader),total=len(train_loader))
-        for batch_idx, (rgb_img, hsi_img, mask) in train_loop:
-
-            if data_source == 'rgb':
-                rgb_img = rgb_img.to(DEVICE)
-                mask = mask.to(DEVICE)
-                mask = mask.type(torch.long)
-
-                with torch.cuda.amp.autocast():
-                    predictions = model(rgb_img.float())
-                    loss = loss_fn(predictions, mask)
-
-            elif data_source == 'hsi':
-                hsi_img = hsi_img.to(DEVICE)
-                mask = mask.to(DEVICE)
-                mask = mask.type(torch.long)
-
-                with torch.cuda.amp.autocast():
-                    predictions = model(hsi_img)
-                    loss = loss_fn(predictions, mask)
-            
-            elif data_source == 'sf':
-                rgb_img = rgb_img.to(DEVICE)
-                hsi_img = hsi_img.to(DEVICE)
-                mask = mask.to(DEVICE)
-                mask = mask.type(torch.long)
-            
-                # forward
-                with torch.cuda.amp.autocast():
-                    predictions = model(rgb_img.float(), hsi_img)
-                    loss = loss_fn(predictions, mask)
-                
-            # backward
-            optimizer.zero_grad()
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scaler.update()
-    
-            # update tqdm loop
-            train_loop.set_postfix(loss=loss.item())
-            
-            train_batch_loss = train_batch_loss + loss.item()
-    
-        #calculate average loss
-        print(f'Average Train Batch Loss: {train_batch_loss/TRAIN_BATCH_SIZE:.4f}')
-        avg_train_loss_list.append(train_batch_loss/TRAIN_BATCH_SIZE)
-        
-        ####################################################
-        ############## validation instance #################
-        ####################################################
-        
-        model.eval()
-        val_loop = tqdm(enumerate(val_loader),total=len(val_loader))
-        for batch_idx, (rgb_img, hsi_img, mask) in val_loop:
-            with torch.no_grad():
-                if data_source == 'rgb':
-                    rgb_img = rgb_img.to(DEVICE)
-                    mask = mask.to(DEVICE)
-                    mask = mask.type(torch.long)
-
-                    with torch.cuda.amp.autocast():
-                        predictions = model(rgb_img.float())
-                        val_loss = loss_fn(predictions, mask)
-
-                elif data_source == 'hsi':
-                    hsi_img = hsi_img.to(DEVICE)
-                    mask = mask.to(DEVICE)
-                    mask = mask.type(torch.long)
-
-                    with torch.cuda.amp.autocast():
-                        predictions = model(hsi_img)
-                        val_loss = loss_fn(predictions, mask)
-            
-                elif data_source == 'sf':
-                    rgb_img = rgb_img.to(DEVICE)
-                    hsi_img = hsi_img.to(DEVICE)
-                    mask = mask.to(DEVICE)
-                    mask = mask.type(torch.long)
-            
-                    # forward
-                    with torch.cuda.amp.autocast():
-                        predictions = model(rgb_img.float(), hsi_img)
-                        val_loss = loss_fn(predictions, mask)
 
-    
-            # update tqdm loop
-            val_loop.set_postfix(val_loss=val_loss.item())
-            
-            val_batch_loss = val_batch_loss + val_loss.item()
-
-        avg_val_loss = val_batch_loss / len(val_loader)
-        print(f'Average Validation Batch Loss: {val_batch_loss/VAL_BATCH_SIZE:.4f}')        
-        avg_val_loss_list.append(val_batch_loss/VAL_BATCH_SIZE)
-        
-        #######################################################
-        ############### adjust learning rate ##################
-        #######################################################
-        
-        if activate_scheduler:
-            before_lr = optimizer.param_groups[0]["lr"]
-            scheduler.step()
-            after_lr = optimizer.param_groups[0]["lr"]
-            print(f"Epoch {epoch}: Adam lr {before_lr:.4f} -> {after_lr:.4f}")
-        
-        ###################################################################################################################
-        ############## visualize training and validation results and also save model after 50 epochs ######################
-        ###################################################################################################################
-            
-        if ((epoch%10==0) and (epoch>0) or (epoch==num_epochs)):
-            
-            plot_range=range(epoch)
-            
-            fig, axs = plt.subplots(figsize=(9,6))
-            
-            ###
-            # Loss
-            ###
-            
-            axs.plot(range(len(avg_train_loss_list)), avg_train_loss_list, marker='o', linestyle='-', label='Training Loss', color='blue')
-            
-            #create twin axis
-            ax2 = axs.twinx()
-            ax2.plot(range(len(avg_val_loss_list)), avg_val_loss_list, marker='o', linestyle='-', label='Validation Loss', color='orange')
-            
-            # Add labels and title
-            axs.set_xlabel('Epochs')
-            axs.set_ylabel('Training Loss', color='blue')
-            ax2.set_ylabel('Validation Loss', color='orange')
-            axs.set_title('Training vs Validation Loss')
-            
-            # Show legend for both axes
-            axs.legend(loc='upper left')
-            ax2.legend(loc='upper right')
-    
-            plt.grid(True)
-            plt.show()
-            
-        ######################################################
-        ################# early stopping #####################
-        ######################################################
-        if patience > 0 and epoch>int(1/3*num_epochs):
-            if avg_val_loss < best_val_loss:
-                best_val_loss = avg_val_loss
-                patience_counter = 0
-                # Save the best model
-                torch.save({
-                    'epoch': epoch,
-                    'model_state_dict': model.state_dict(),
-                    'optimizer_state_dict': optimizer.state_dict(),
-                    'loss': loss,
-                    'scaler_state_dict': scaler.state_dict()
-                }, f'best_model_{_today}_{model_name}.pt')
-            else:
-                patience_counter += 1
-                if patience_counter >= patience:
-                    print(f'Early stopping at epoch {epoch}')
-                    break
-                
-        if (epoch==50 and save_state == True) or (epoch==75 and save_state == True) or epoch==(num_epochs-1):
-            # Save all the elements to a file
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'loss': loss,
-                'scaler_state_dict': scaler.state_dict()
-            }, f'model_e{epoch}_{_today}_{model_name}.pt')
-            
-    return model, loss, avg_train_loss_list, avg_val_loss_list
-
-
-def load_model(model_type, optimizer, scaler, model_path):
-    '''
-    Description: Load Model (from .pt file). Requires a predefined optimizer and scaler.
-    Input: Model type, Optimizer, Scaler and Model path
-    Output: Loaded Model
+def load_model(model_type, optimizer, scaler, model_path, scheduler=None, return_epoch=False):
+    '''
+    Description: Load Model (from .pt file). Requires a predefined optimizer and scaler, the scheduler is restored as well if
+    given and saved in the checkpoint. To continue an interrupted training with the exact training state use resume_from of
+    train_model instead.
+    Input: Model type, Optimizer, Scaler, Model path, Scheduler, Return Epoch Option
+    Output: Loaded Model (and Epoch of the Checkpoint with return_epoch)
     '''
     model = model_type.to(DEVICE)
-    checkpoint = torch.load(model_path, map_location=torch.device(DEVICE))
+    checkpoint = torch.load(model_path, map_location=torch.device(DEVICE), weights_only=False)
     model.load_state_dict(checkpoint['model_state_dict'])
     optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
     epoch = checkpoint['epoch']
     loss = checkpoint['loss']
     scaler.load_state_dict(checkpoint['scaler_state_dict'])
+    if scheduler is not None and checkpoint.get('scheduler_state_dict') is not None:
+        scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
 
+    if return_epoch:
+        return model, epoch
     return model
 
 #makes training etc. deterministic
@@ -831,3 +1680,114 @@ def seed_everything(seed=1234):
     torch.cuda.manual_seed(seed)
     torch.backends.cudnn.deterministic = True
 
+def training_rng_state():
+    '''
+    Description: States of all random number generators used in training (python, numpy, torch CPU and CUDA), e.g. for the
+    data order, augmentations and dropout.
+    Output: Dictionary of RNG States
+    '''
+    return {'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+def set_training_rng_state(rng_state):
+    '''
+    Description: Restores the random number generator states of training_rng_state.
+    Input: Dictionary of RNG States
+    '''
+    random.setstate(rng_state['python'])
+    np.random.set_state(rng_state['numpy'])
+    torch.set_rng_state(rng_state['torch'].cpu())
+    if rng_state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([state.cpu() for state in rng_state['cuda']])
+
+def data_order_state(loader):
+    '''
+    Description: States of the generators of a data loader and its sampler, if they have their own. Otherwise the data order
+    follows the torch RNG (training_rng_state) or, for a DistributedSampler, seed and epoch.
+    Input: Data Loader
+    Output: Dictionary of Generator States
+    '''
+    loader_generator = getattr(loader, 'generator', None)
+    sampler_generator = getattr(getattr(loader, 'sampler', None), 'generator', None)
+    return {'loader': loader_generator.get_state() if loader_generator is not None else None,
+            'sampler': sampler_generator.get_state() if sampler_generator is not None else None}
+
+def set_data_order_state(loader, order_state):
+    '''
+    Description: Restores the generator states of data_order_state.
+    Input: Data Loader, Dictionary of Generator States
+    '''
+    sampler_generator = getattr(getattr(loader, 'sampler', None), 'generator', None)
+    if order_state['sampler'] is not None and sampler_generator is not None:
+        sampler_generator.set_state(order_state['sampler'].cpu())
+    loader_generator = getattr(loader, 'generator', None)
+    if order_state['loader'] is not None and loader_generator is not None:
+        loader_generator.set_state(order_state['loader'].cpu())
+
+def _albumentations_transforms(transform):
+    '''
+    Description: The transform and all nested transforms (e.g. of an A.Compose) with their own random generators.
+    '''
+    transforms = []
+    if hasattr(transform, 'random_generator') and hasattr(transform, 'py_random'):
+        transforms.append(transform)
+    for child in getattr(transform, 'transforms', None) or []:
+        transforms.extend(_albumentations_transforms(child))
+    return transforms
+
+def dataset_transforms(dataset):
+    '''
+    Description: Albumentations transforms of a dataset and the datasets it wraps (e.g. _WH_RGB_HSI_Dataset_Wrapper, Subset).
+    Since albumentations 2 every transform draws from its own random generators instead of the global python/numpy RNG.
+    Input: Dataset
+    Output: List of Transforms
+    '''
+    transforms = []
+    while dataset is not None:
+        transform = getattr(dataset, 'transform', None)
+        if transform is not None:
+            transforms.extend(_albumentations_transforms(transform))
+        dataset = getattr(dataset, 'dataset', None)
+    return transforms
+
+def transform_rng_state(dataset):
+    '''
+    Description: States of the random generators of the augmentations of a dataset (in the main process).
+    Input: Dataset
+    Output: List of (numpy Generator State, python Random State)
+    '''
+    return [(transform.random_generator.bit_generator.state, transform.py_random.getstate())
+            for transform in dataset_transforms(dataset)]
+
+def set_transform_rng_state(dataset, rng_state):
+    '''
+    Description: Restores the augmentation random generator states of transform_rng_state.
+    Input: Dataset, List of (numpy Generator State, python Random State)
+    '''
+    for transform, (numpy_state, python_state) in zip(dataset_transforms(dataset), rng_state):
+        transform.random_generator.bit_generator.state = numpy_state
+        transform.py_random.setstate(python_state)
+
+def seed_transforms(dataset, seed):
+    '''
+    Description: Seeds the augmentations of a dataset, every transform gets an independent generator derived from the seed (the
+    set_random_seed of A.Compose gives all transforms the same seed, so e.g. horizontal and vertical flips would be correlated).
+    Input: Dataset, Seed (Int)
+    '''
+    transforms = dataset_transforms(dataset)
+    for transform, seed_sequence in zip(transforms, np.random.SeedSequence(seed).spawn(len(transforms))):
+        transform.random_generator = np.random.default_rng(seed_sequence)
+        transform.py_random = random.Random(int(seed_sequence.generate_state(1)[0]))
+
+def seed_transforms_worker(worker_id):
+    '''
+    Description: worker_init_fn of the data loaders, seeds the augmentations of each worker from the worker seed torch derives
+    from the main process RNG. Otherwise all workers use copies of the same generators and augment identically, and the
+    augmentations of a resumed training are not reproducible.
+    Input: Worker ID
+    '''
+    worker_info = torch.utils.data.get_worker_info()
+    seed_transforms(worker_info.dataset, worker_info.seed)
+
@@ -0,0 +1,490 @@
+import numpy as np
+import os
+import copy
+import time
+from contextlib import contextmanager
+
+#torch
+import torch
+from torch.utils.data import Dataset, Subset, DataLoader
+import torch.nn as nn
+import torch.nn.functional as F
+from tqdm import tqdm
+from torch.ao.quantization import QConfig, QConfigMapping, get_default_qconfig, default_weight_observer
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from TonyWang_MasterThesis.functions_and_constants import *
+from TonyWang_MasterThesis.visualisation_and_evaluation import *
+from TonyWang_MasterThesis.models import *
+
+#######################################################################
+############### Post Training Static Quantization #####################
+#######################################################################
+
+class _tensor_only_forward(nn.Module):
+    '''
+    Description: Wraps a single input model so that optional forward arguments (e.g. with_output_feature_map of the
+    UNetWithResnet50Encoder) are not traced as graph inputs during quantization.
+    '''
+    def __init__(self, model):
+        super(_tensor_only_forward,self).__init__()
+        self.model = model
+    def forward(self, x):
+        return self.model(x)
+
+def quantization_qconfig_mapping(backend='fbgemm'):
+    '''
+    Description: Quantization config, which only converts Conv and ConvTranspose layers (including the BatchNorm and ReLU layers
+    fused into them) to int8. All other layers (GELU, Dropout, Upsample) stay in float. ConvTranspose layers are quantized
+    per tensor, since per channel weights are not supported for them. There is no quantized GELU, so the GELU, HSI and fusion
+    models dequantize and quantize again around every GELU (see quantization_boundaries), which eats into the speedup that
+    unet_model_classic (ReLU, fused into the convolutions) gets. evaluate_quantized_model measures it.
+    Input: Quantization Backend ('fbgemm' for x86, 'qnnpack' for ARM)
+    Output: QConfigMapping
+    '''
+    qconfig = get_default_qconfig(backend)
+    tconv_qconfig = QConfig(activation=qconfig.activation, weight=default_weight_observer)
+
+    qconfig_mapping = QConfigMapping()
+    qconfig_mapping.set_object_type(nn.Conv2d, qconfig)
+    qconfig_mapping.set_object_type(nn.BatchNorm2d, qconfig)
+    qconfig_mapping.set_object_type(nn.ReLU, qconfig)
+    qconfig_mapping.set_object_type(nn.ConvTranspose2d, tconv_qconfig)
+
+    return qconfig_mapping
+
+@contextmanager
+def quantized_engine(backend):
+    '''
+    Description: Sets the quantization backend for the block and restores the previous one afterwards. The weights of a quantized
+    model are packed for the backend when the model is converted or loaded, running it does not depend on the global setting.
+    Input: Quantization Backend ('fbgemm' for x86, 'qnnpack' for ARM)
+    '''
+    previous_backend = torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    try:
+        yield
+    finally:
+        torch.backends.quantized.engine = previous_backend
+
+def quantize_model_static(model, calibration_dataset, data_source, num_calibration_images=32, batch_size=4, backend='fbgemm'):
+    '''
+    Description: Post training static int8 quantization for CPU inference. The model is traced, the activation ranges are
+    calibrated on a small slice of the dataset (e.g. _WH_RGB_HSI_Dataset without augmentation) and the Conv/ConvTranspose layers
+    are converted to int8. The original model is left untouched.
+    Input: Trained Model, Calibration Dataset, Data Source (String), Number of Calibration Images, Calibration Batch Size,
+    Quantization Backend
+    Output: Quantized Model (CPU only)
+    '''
+    float_model = copy.deepcopy(model).to('cpu').eval()
+    if hasattr(float_model, 'use_checkpointing'):
+        float_model.use_checkpointing = False
+    if isinstance(float_model, UNetWithResnet50Encoder):
+        float_model = _tensor_only_forward(float_model)
+
+    num_calibration_images = min(num_calibration_images, len(calibration_dataset))
+    calibration_loader = DataLoader(Subset(calibration_dataset, range(num_calibration_images)), batch_size=batch_size, shuffle=False)
+
+    rgb_img, hsi_img, _ = next(iter(calibration_loader))
+    example_inputs = select_model_inputs(rgb_img, hsi_img, data_source, device='cpu')
+
+    with quantized_engine(backend):
+        prepared_model = prepare_fx(float_model, quantization_qconfig_mapping(backend), example_inputs)
+
+        #calibration, only observes the activation ranges
+        with torch.no_grad():
+            for rgb_img, hsi_img, _ in tqdm(calibration_loader, total=len(calibration_loader)):
+                prepared_model(*select_model_inputs(rgb_img, hsi_img, data_source, device='cpu'))
+
+        quantized_model = convert_fx(prepared_model)
+
+    return quantized_model
+
+def quantization_boundaries(quantized_model):
+    '''
+    Description: Number of quantize and dequantize operations in a quantized model (convert_fx). A fully quantized model has
+    one of each, every layer that stays in float (e.g. GELU) adds a pair.
+    Input: Quantized Model (GraphModule)
+    Output: Number of Quantize/Dequantize Operations
+    '''
+    return sum(1 for node in quantized_model.graph.nodes
+               if node.target in (torch.quantize_per_tensor, torch.quantize_per_channel, 'dequantize'))
+
+def class_metrics_over_dataset(model, dataset, data_source, num_images=None, device=DEVICE):
+    '''
+    Description: Sums up the IoU and Dice components of each class over a dataset, without visualisation or printing.
+    Input: Model, Dataset, Data Source (String), Number of Images (None for entire Dataset), Device
+    Output: Intersection List, Union List, Dice Num List, Dice Denom List
+    '''
+    test_ds_union = [0] * N_CLASSES
+    test_ds_intersection = [0] * N_CLASSES
+    test_ds_numerator = [0] * N_CLASSES
+    test_ds_denominator = [0] * N_CLASSES
+
+    if num_images is None:
+        num_images = len(dataset)
+
+    model.eval()
+    with torch.no_grad():
+        for n in range(num_images):
+            rgb_img, hsi_img, mask = dataset[n]
+
+            model_inputs = select_model_inputs(rgb_img.unsqueeze(0), hsi_img.unsqueeze(0), data_source, device=device)
+            preds = torch.argmax(model(*model_inputs), axis=1).to('cpu').squeeze(0)
+
+            is_list, u_list = intersection_and_union_all_classes(mask, preds, SINGLE_PREDICTION=True)
+            n_list, d_list = dice_values_all_classes(mask, preds, SINGLE_PREDICTION=True)
+
+            for i in range(N_CLASSES):
+                test_ds_intersection[i] += is_list[i]
+                test_ds_union[i] += u_list[i]
+                test_ds_numerator[i] += n_list[i]
+                test_ds_denominator[i] += d_list[i]
+
+    return test_ds_intersection, test_ds_union, test_ds_numerator, test_ds_denominator
+
+def evaluate_quantized_model(float_model, quantized_model, test_dataset, data_source, num_images=None, file_name=''):
+    '''
+    Description: Compares the float model and the quantized model on the CPU. Prints the IoU and Dice Score of each class for both
+    models next to each other as well as the latency per frame and the number of quantize/dequantize operations of the quantized
+    model. The metrics of the quantized model are written to file with calculate_model_metrics.
+    Input: Float Model, Quantized Model, Test Dataset, Data Source (String), Number of Images (None for entire Dataset), File Name
+    Output: Dictionary with the Class IoU, Class Dice Score and Latency of both models and the Quantization Boundaries
+    '''
+    float_model = copy.deepcopy(float_model).to('cpu').eval()
+
+    float_is, float_u, float_n, float_d = class_metrics_over_dataset(float_model, test_dataset, data_source, num_images, device='cpu')
+    quant_is, quant_u, quant_n, quant_d = class_metrics_over_dataset(quantized_model, test_dataset, data_source, num_images, device='cpu')
+
+    rgb_img, hsi_img, _ = test_dataset[0]
+    model_inputs = select_model_inputs(rgb_img.unsqueeze(0), hsi_img.unsqueeze(0), data_source, device='cpu')
+    float_latency = measure_model_latency(float_model, model_inputs)
+    quant_latency = measure_model_latency(quantized_model, model_inputs)
+
+    report = {'float_iou': {}, 'int8_iou': {}, 'float_dice': {}, 'int8_dice': {},
+              'float_latency': float_latency, 'int8_latency': quant_latency,
+              'quantization_boundaries': quantization_boundaries(quantized_model) if isinstance(quantized_model, torch.fx.GraphModule) else None}
+
+    print(f'{"Class":<15}{"IoU fp32":>10}{"IoU int8":>10}{"Dice fp32":>11}{"Dice int8":>11}')
+    for i in range(N_CLASSES):
+        report['float_iou'][CLASSES_LONG[i]] = float_is[i] / (float_u[i] + 1e-06)
+        report['int8_iou'][CLASSES_LONG[i]] = quant_is[i] / (quant_u[i] + 1e-06)
+        report['float_dice'][CLASSES_LONG[i]] = float_n[i] / (float_d[i] + 1e-06)
+        report['int8_dice'][CLASSES_LONG[i]] = quant_n[i] / (quant_d[i] + 1e-06)
+
+        print(f'{CLASSES_LONG[i]:<15}{report["float_iou"][CLASSES_LONG[i]]:>10.4f}{report["int8_iou"][CLASSES_LONG[i]]:>10.4f}'
+              f'{report["float_dice"][CLASSES_LONG[i]]:>11.4f}{report["int8_dice"][CLASSES_LONG[i]]:>11.4f}')
+
+    print(f'CPU Latency per Frame fp32: {float_latency*1000:.1f}ms')
+    print(f'CPU Latency per Frame int8: {quant_latency*1000:.1f}ms (Speedup: {float_latency/quant_latency:.2f}x)')
+    if report['quantization_boundaries'] is not None:
+        print(f'Quantize/Dequantize Operations: {report["quantization_boundaries"]} (2 for a fully quantized model)')
+
+    calculate_model_metrics(quant_is, quant_u, quant_n, quant_d, defects_only=True, file_name=f'{file_name}_int8')
+
+    return report
+
+def save_quantized_model(quantized_model, test_dataset, data_source, path):
+    '''
+    Description: Saves the quantized model as TorchScript artifact, which can be loaded without the model classes.
+    Input: Quantized Model, Dataset (for an example input), Data Source (String), File Path
+    '''
+    rgb_img, hsi_img, _ = test_dataset[0]
+    example_inputs = select_model_inputs(rgb_img.unsqueeze(0), hsi_img.unsqueeze(0), data_source, device='cpu')
+
+    with torch.no_grad():
+        scripted_model = torch.jit.trace(quantized_model, example_inputs)
+    torch.jit.save(scripted_model, path)
+
+def load_quantized_model(path, backend='fbgemm'):
+    '''
+    Description: Loads a quantized TorchScript artifact for CPU inference.
+    Input: File Path, Quantization Backend
+    Output: Quantized Model
+    '''
+    with quantized_engine(backend):
+        quantized_model = torch.jit.load(path, map_location='cpu')
+    quantized_model.eval()
+    return quantized_model
+
+#######################################################################
+############### Structured Channel Pruning ############################
+#######################################################################
+
+def _unet_features(model):
+    '''
+    Description: Reads the channel widths per level of a UNet model from its transposed convolutions.
+    Input: UNet Model
+    Output: List of Channel Widths, e.g. [64, 128, 256, 512]
+    '''
+    if isinstance(model, unet_model_gelu_feature_level_fusion):
+        return [model.tconv2.out_channels, model.tconv3.out_channels, model.tconv4.out_channels, model.tconv5.out_channels]
+    return [model.tconv4.out_channels, model.tconv3.out_channels, model.tconv2.out_channels, model.tconv1.out_channels]
+
+def _rebuild_unet(model, features):
+    '''
+    Description: Creates an untrained model of the same type as the given model, but with different channel widths.
+    Input: UNet Model, List of Channel Widths
+    Output: New UNet Model
+    '''
+    out_channels = model.final_layer.out_channels
+
+    if isinstance(model, unet_model_gelu_feature_level_fusion):
+        return unet_model_gelu_feature_level_fusion(model.conv1_hsi.conv[0].in_channels, out_channels, features=features,
+                                                    use_checkpointing=model.use_checkpointing, modality_dropout=model.modality_dropout,
+                                                    fusion_mode=model.fusion_mode, hsi_scale=model.hsi_scale,
+                                                    hsi_input_full_resolution=model.hsi_input_full_resolution)
+    elif isinstance(model, unet_model_gelu_data_level_fusion):
+        return unet_model_gelu_data_level_fusion(model.conv1.conv[0].in_channels - 3, out_channels, features=features,
+                                                 use_checkpointing=model.use_checkpointing, modality_dropout=model.modality_dropout)
+    elif isinstance(model, (hsi_unet_model_gelu, hsi_unet_model_gelu_pca)):
+        return type(model)(model.conv1.conv[0].in_channels, out_channels, features=features, use_checkpointing=model.use_checkpointing)
+    elif isinstance(model, (unet_model_classic, unet_model_gelu)):
+        return type(model)(out_channels, features=features, use_checkpointing=model.use_checkpointing)
+    else:
+        raise ValueError(f'Channel pruning is not supported for {type(model).__name__}')
+
+def _pruning_plan(model):
+    '''
+    Description: Describes the connectivity of a UNet model for pruning. Each layer is listed with the layers whose outputs are
+    concatenated (in this order) to form its input, None stands for the model input. Layers in the same channel group have
+    to keep the same channels, because their outputs are fed into the same (shared) layers.
+    Input: UNet Model
+    Output: List of (Layer Name, Input Layer Names), Dictionary of Layer Name -> Channel Group
+    '''
+    if isinstance(model, unet_model_gelu_feature_level_fusion):
+        if model.fusion_mode != 'concat' or model.hsi_scale != 1:
+            raise ValueError(f'Channel pruning is not supported for fusion mode {model.fusion_mode} with hsi_scale {model.hsi_scale}')
+        plan = [('conv1_rgb', None), ('conv1_hsi', None),
+                ('conv2', ['conv1_rgb']), ('conv3', ['conv2']), ('conv4', ['conv3']), ('conv_bridge', ['conv4']),
+                ('deconv_bridge_1', ['conv_bridge', 'conv_bridge']), ('deconv_bridge_2', ['deconv_bridge_1']),
+                ('tconv5', ['deconv_bridge_1']), ('deconv4', ['conv4', 'conv4', 'tconv5']),
+                ('tconv4', ['deconv4']), ('deconv3', ['conv3', 'conv3', 'tconv4']),
+                ('tconv3', ['deconv3']), ('deconv2', ['conv2', 'conv2', 'tconv3']),
+                ('tconv2', ['deconv2']), ('deconv1', ['conv1_rgb', 'conv1_hsi', 'tconv2']),
+                ('final_layer', ['deconv1'])]
+        # conv2 is shared by both streams, so both first blocks have to keep the same channels
+        groups = {'conv1_rgb': 'conv1', 'conv1_hsi': 'conv1'}
+    else:
+        plan = [('conv1', None), ('conv2', ['conv1']), ('conv3', ['conv2']), ('conv4', ['conv3']), ('bottleneck', ['conv4']),
+                ('tconv1', ['bottleneck']), ('conv5', ['conv4', 'tconv1']),
+                ('tconv2', ['conv5']), ('conv6', ['conv3', 'tconv2']),
+                ('tconv3', ['conv6']), ('conv7', ['conv2', 'tconv3']),
+                ('tconv4', ['conv7']), ('conv8', ['conv1', 'tconv4']),
+                ('final_layer', ['conv8'])]
+        groups = {}
+
+    return plan, groups
+
+def _channel_importance(layer):
+    '''
+    Description: Importance of each output channel of a layer. For conv blocks this is the magnitude of the BatchNorm gamma of the
+    last BatchNorm layer, for transposed convolutions (no BatchNorm) the L1 norm of the filter.
+    Input: Layer (Conv Block or ConvTranspose2d)
+    Output: Importance per Output Channel (Torch Tensor)
+    '''
+    if isinstance(layer, nn.ConvTranspose2d):
+        return layer.weight.detach().abs().sum(dim=(0, 2, 3))
+    bn_layers = [m for m in layer.conv if isinstance(m, nn.BatchNorm2d)]
+    return bn_layers[-1].weight.detach().abs()
+
+def _out_channels(layer):
+    '''
+    Description: Number of output channels of a layer (Conv Block or ConvTranspose2d).
+    '''
+    if isinstance(layer, nn.ConvTranspose2d):
+        return layer.out_channels
+    return [m for m in layer.conv if isinstance(m, nn.Conv2d)][-1].out_channels
+
+def _top_channels(importance, n_keep):
+    '''
+    Description: Indices of the n most important channels, in their original order.
+    '''
+    return torch.sort(torch.topk(importance, n_keep).indices).values
+
+def _copy_conv_block(block, pruned_block, in_idx, out_idx):
+    '''
+    Description: Copies the remaining channels of a conv block (Sequential of Conv -> BN -> Activation) into the pruned block.
+    The inner channels are ranked by their BatchNorm gamma, the output channels of the last conv are given.
+    Input: Conv Block, Pruned Conv Block, Kept Input Channel Indices, Kept Output Channel Indices
+    '''
+    layers = list(block.conv)
+    pruned_layers = list(pruned_block.conv)
+    conv_positions = [i for i, layer in enumerate(layers) if isinstance(layer, nn.Conv2d)]
+
+    for i in conv_positions:
+        conv, pruned_conv, bn, pruned_bn = layers[i], pruned_layers[i], layers[i+1], pruned_layers[i+1]
+
+        if i == conv_positions[-1]:
+            conv_out_idx = out_idx
+        else:
+            conv_out_idx = _top_channels(bn.weight.detach().abs(), pruned_conv.out_channels)
+
+        pruned_conv.weight.data = conv.weight.data[conv_out_idx][:, in_idx].clone()
+        if conv.bias is not None:
+            pruned_conv.bias.data = conv.bias.data[conv_out_idx].clone()
+
+        pruned_bn.weight.data = bn.weight.data[conv_out_idx].clone()
+        pruned_bn.bias.data = bn.bias.data[conv_out_idx].clone()
+        pruned_bn.running_mean.data = bn.running_mean.data[conv_out_idx].clone()
+        pruned_bn.running_var.data = bn.running_var.data[conv_out_idx].clone()
+        pruned_bn.num_batches_tracked.data = bn.num_batches_tracked.data.clone()
+
+        in_idx = conv_out_idx
+
+def prune_unet_channels(model, keep_ratio=0.5):
+    '''
+    Description: Structured channel pruning of the UNet models. The channel widths of all levels are reduced by the keep ratio and
+    the most important channels (BatchNorm gamma magnitude) of each layer are copied into a smaller dense model of the same type.
+    Channels are removed consistently across the skip connections, i.e. the input channels of each concatenation follow the
+    kept output channels of the encoder and decoder layers. The pruned model should be fine tuned afterwards.
+    UNetWithResnet50Encoder is not supported, since its encoder widths are fixed by the pretrained ResNet.
+    Input: Trained UNet Model, Keep Ratio (Float between 0 and 1)
+    Output: Pruned UNet Model (on the same device as the model)
+    '''
+    if getattr(model, 'upsampling_method', 'conv_transpose') != 'conv_transpose':
+        raise ValueError(f'Channel pruning is only supported for transposed conv upsampling, not {model.upsampling_method}')
+
+    features = [max(1, int(round(f * keep_ratio))) for f in _unet_features(model)]
+    pruned_model = _rebuild_unet(model, features)
+
+    # the preprocessing block of the HSI model is not pruned
+    if hasattr(model, 'preprocess'):
+        pruned_model.preprocess.load_state_dict(model.preprocess.state_dict())
+
+    plan, groups = _pruning_plan(model)
+
+    # kept output channels of every layer, channel groups are ranked by their summed importance
+    kept = {}
+    for name, _ in plan[:-1]:
+        group = groups.get(name, name)
+        if group in kept:
+            continue
+        members = [member for member, _ in plan if groups.get(member, member) == group]
+        importance = sum(_channel_importance(getattr(model, member)) for member in members)
+        kept[group] = _top_channels(importance, _out_channels(getattr(pruned_model, name)))
+
+    for name, inputs in plan:
+        layer = getattr(model, name)
+        pruned_layer = getattr(pruned_model, name)
+
+        # input channel indices of concatenated inputs are offset by the channels of the preceding inputs
+        if inputs is None:
+            first_conv = layer.conv[0] if hasattr(layer, 'conv') else layer
+            in_idx = torch.arange(first_conv.in_channels)
+        else:
+            in_idx, offset = [], 0
+            for source in inputs:
+                in_idx.append(kept[groups.get(source, source)] + offset)
+                offset += _out_channels(getattr(model, source))
+            in_idx = torch.cat(in_idx)
+
+        in_idx = in_idx.to(next(model.parameters()).device)
+
+        if name == 'final_layer':
+            pruned_layer.weight.data = layer.weight.data[:, in_idx].clone()
+            pruned_layer.bias.data = layer.bias.data.clone()
+        elif isinstance(layer, nn.ConvTranspose2d):
+            out_idx = kept[groups.get(name, name)]
+            pruned_layer.weight.data = layer.weight.data[in_idx][:, out_idx].clone()
+            pruned_layer.bias.data = layer.bias.data[out_idx].clone()
+        else:
+            _copy_conv_block(layer, pruned_layer, in_idx, kept[groups.get(name, name)])
+
+    return pruned_model.to(next(model.parameters()).device)
+
+def pruning_report(model, pruned_model, test_dataset, data_source, num_images=None):
+    '''
+    Description: Compares the model before and after pruning: Parameters, GFLOPs and latency per frame on DEVICE, as well as the
+    IoU of each class on the test dataset.
+    Input: Model, Pruned Model, Test Dataset, Data Source (String), Number of Images (None for entire Dataset)
+    Output: Dictionary with the Parameters, FLOPs, Latency and Class IoU of both models
+    '''
+    rgb_img, hsi_img, _ = test_dataset[0]
+    model_inputs = select_model_inputs(rgb_img.unsqueeze(0), hsi_img.unsqueeze(0), data_source)
+
+    report = {}
+    for key, m in [('original', model), ('pruned', pruned_model)]:
+        m = m.to(DEVICE).eval()
+        intersection, union, _, _ = class_metrics_over_dataset(m, test_dataset, data_source, num_images)
+        report[key] = {'params': count_model_parameters(m),
+                       'flops': count_model_flops(m, model_inputs),
+                       'latency': measure_model_latency(m, model_inputs),
+                       'iou': [intersection[i] / (union[i] + 1e-06) for i in range(N_CLASSES)],
+                       'iou_defects_only': np.sum(intersection[3:]) / (np.sum(union[3:]) + 1e-06)}
+
+    original, pruned = report['original'], report['pruned']
+    print(f'{"":<22}{"Original":>12}{"Pruned":>12}')
+    print(f'{"Parameters (M)":<22}{original["params"]/1e6:>12.2f}{pruned["params"]/1e6:>12.2f}')
+    print(f'{"GFLOPs":<22}{original["flops"]/1e9:>12.2f}{pruned["flops"]/1e9:>12.2f}')
+    print(f'{"Latency (ms)":<22}{original["latency"]*1000:>12.1f}{pruned["latency"]*1000:>12.1f}')
+    print(f'{"IoU (Defects Only)":<22}{original["iou_defects_only"]:>12.4f}{pruned["iou_defects_only"]:>12.4f}')
+    for i in range(N_CLASSES):
+        print(f'{"IoU " + CLASSES_LONG[i]:<22}{original["iou"][i]:>12.4f}{pruned["iou"][i]:>12.4f}')
+
+    return report
+
+def prune_and_fine_tune(model, train_loader, val_loader, test_dataset, num_epochs, TRAIN_BATCH_SIZE, VAL_BATCH_SIZE,
+                        keep_ratio=0.5, learning_rate=0.00037, ce_loss_fn=None, dice_loss_fn=None, model_name='', data_source='rgb'):
+    '''
+    Description: Prunes a trained UNet model, fine tunes the smaller model with sf_model_training_multiloss and reports FLOPs,
+    parameters, latency and class IoU before and after.
+    Input: Trained Model, Train Loader, Validation Loader, Test Dataset, Number of Fine Tuning Epochs, Batch sizes, Keep Ratio,
+    Learning Rate, Cross Entropy Loss, Dice Loss (default: unweighted CE and Dice), Model Name for Save state, Data Source
+    Output: Fine Tuned Pruned Model, Pruning Report
+    '''
+    if ce_loss_fn is None:
+        ce_loss_fn = nn.CrossEntropyLoss()
+    if dice_loss_fn is None:
+        dice_loss_fn = DiceLoss(n_classes=N_CLASSES)
+
+    pruned_model = prune_unet_channels(model, keep_ratio).to(DEVICE)
+
+    optimizer = Adam(pruned_model.parameters(), lr=learning_rate, weight_decay=0.0001)
+    scaler = torch.cuda.amp.GradScaler()
+    scheduler = ExponentialLR(optimizer, last_epoch=-1, gamma=0.9)
+
+    pruned_model, _, _, _ = sf_model_training_multiloss(pruned_model, train_loader, val_loader, num_epochs,
+                                                        ce_loss_fn, dice_loss_fn, optimizer, scaler, scheduler,
+                                                        [], [], TRAIN_BATCH_SIZE, VAL_BATCH_SIZE,
+                                                        activate_scheduler=False, patience=0,
+                                                        model_name=f'{model_name}_pruned', data_source=data_source)
+
+    report = pruning_report(model, pruned_model, test_dataset, data_source)
+
+    return pruned_model, report
+
+#######################################################################
+############### Knowledge Distillation ################################
+#######################################################################
+
+def cache_teacher_logits(teacher_model, dataset, logits_dir, data_source='sf', overwrite=False):
+    '''
+    Description: Runs the trained teacher (e.g. unet_model_gelu_feature_level_fusion) once over every image of a dataset without
+    augmentation (_WH_RGB_HSI_Dataset with sf_no_transformation) and stores its logits as float16 numpy arrays in
+    (height, width, classes), named like the HSI images. Already cached images are skipped, so the teacher only runs once per image.
+    Input: Teacher Model, Dataset without Augmentation, Directory for the Logits, Data Source of the Teacher, Overwrite Option
+    '''
+    os.makedirs(logits_dir, exist_ok=True)
+
+    teacher_model = teacher_model.to(DEVICE).eval()
+    with torch.no_grad():
+        for idx in tqdm(range(len(dataset)), total=len(dataset)):
+            logits_name = os.path.join(logits_dir, dataset.rgb_images[idx].replace('.png', '.npy'))
+            if os.path.exists(logits_name) and not overwrite:
+                continue
+
+            rgb_img, hsi_img, _ = dataset[idx]
+            model_inputs = select_model_inputs(rgb_img.unsqueeze(0), hsi_img.unsqueeze(0), data_source)
+            logits = teacher_model(*model_inputs).squeeze(0).permute(1,2,0)
+
+            np.save(logits_name, logits.to('cpu').numpy().astype(np.float16))
+
+def rgb_student_model(out_channels=10, width_ratio=0.5):
+    '''
+    Description: Small RGB only student for knowledge distillation, a unet_model_gelu with reduced channel widths.
+    Input: Number of Classes, Width Ratio compared to the default widths [64, 128, 256, 512]
+    Output: Student Model
+    '''
+    features = [int(f * width_ratio) for f in [64, 128, 256, 512]]
+    return unet_model_gelu(out_channels=out_channels, features=features)
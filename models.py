@@ -8,6 +8,160 @@ import torchvision
 import torch.nn as nn
 from torch.optim import Adam
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from collections import namedtuple
+from contextlib import contextmanager
+
+##############################################
+############### Model Registry ###############
+##############################################
+
+# a model input: forward argument name, source of the batch it is taken from ('rgb', 'hsi' or 'features' for the packed
+# encoder features of a feature cache), dtype, number of
+# channels (None if it depends on the model configuration, e.g. the number of HSI bands) and device (None for the device
+# the inputs are selected for, e.g. 'cpu' for an input the model moves to the device itself when it needs it)
+ModelInput = namedtuple('ModelInput', ['name', 'source', 'dtype', 'channels', 'device'], defaults=[None])
+
+RGB_INPUT = ModelInput('x', 'rgb', torch.float32, 3)
+HSI_INPUT = ModelInput('x', 'hsi', torch.float32, None)
+FUSION_INPUTS = (ModelInput('x_rgb', 'rgb', torch.float32, 3), ModelInput('x_hsi', 'hsi', torch.float32, None))
+FEATURES_INPUT = ModelInput('packed_features', 'features', torch.float32, None)
+
+# model inputs of the data source strings
+DATA_SOURCE_INPUTS = {'rgb': (RGB_INPUT,), 'hsi': (HSI_INPUT,), 'sf': FUSION_INPUTS, 'features': (FEATURES_INPUT,)}
+
+MODEL_REGISTRY = dict()
+
+def register_model(*model_inputs):
+    '''
+    Description: Class decorator that registers a model and declares its inputs (ModelInput, in the order of the forward
+    arguments). The training loop and the evaluation functions look the inputs up with model_input_spec instead of dispatching
+    on a data source string, so only the tensors a model needs are moved to the device.
+    Input: Model Inputs (ModelInput)
+    Output: Class Decorator
+    '''
+    def decorator(model_class):
+        model_class.model_inputs = tuple(model_inputs)
+        MODEL_REGISTRY[model_class.__name__] = model_class
+        return model_class
+    return decorator
+
+def model_input_spec(model):
+    '''
+    Description: Inputs of a registered model. Wrappers (e.g. pad_and_crop_model, DistributedDataParallel) are unwrapped through
+    their model/module attribute. A data source string ('rgb', 'hsi', 'sf', 'features') is accepted as well for models that are not
+    registered, like loaded TorchScript or quantized models.
+    Input: Model or Data Source (String)
+    Output: Tuple of ModelInput
+    '''
+    if isinstance(model, str):
+        if model not in DATA_SOURCE_INPUTS:
+            raise ValueError(f'Unknown data source: {model}')
+        return DATA_SOURCE_INPUTS[model]
+
+    module = model
+    while module is not None:
+        model_inputs = getattr(module, 'model_inputs', None)
+        if model_inputs is not None:
+            return model_inputs
+        module = getattr(module, 'model', getattr(module, 'module', None))
+    raise ValueError(f'{type(model).__name__} is not registered, pass a data source instead')
+
+def model_data_source(model):
+    '''
+    Description: Data source string ('rgb', 'hsi', 'sf' or 'features') of a model, e.g. for choosing the visualisation.
+    Input: Model or Data Source (String)
+    Output: Data Source (String)
+    '''
+    sources = {model_input.source for model_input in model_input_spec(model)}
+    if sources == {'rgb', 'hsi'}:
+        return 'sf'
+    return sources.pop()
+
+##############################################
+############## Model Helpers #################
+##############################################
+
+@contextmanager
+def frozen_batchnorm_stats(module):
+    '''
+    Description: Restores the running statistics (running mean, running variance and number of tracked batches) of all
+    BatchNorm layers of a module after the block, the normalisation itself still uses the batch statistics in training mode.
+    Input: Module (nn.Module)
+    '''
+    batchnorms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved_stats = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in batchnorms]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for m, (running_mean, running_var, num_batches_tracked) in zip(batchnorms, saved_stats):
+                m.running_mean.copy_(running_mean)
+                m.running_var.copy_(running_var)
+                m.num_batches_tracked.copy_(num_batches_tracked)
+
+def checkpoint_stage(stage, *inputs, enabled=False):
+    '''
+    Description: Runs a single encoder/decoder stage. If activation checkpointing is enabled, the intermediate activations of
+    the stage are not kept for the backward pass but recomputed, which trades compute for memory. The BatchNorm running
+    statistics are only updated in the forward pass and not again in the recomputation, so they are the same as without
+    checkpointing. Checkpointing is only applied when gradients are tracked, so inference is unaffected.
+    Input: Stage (nn.Module or method of a Module), Stage Inputs (Torch Tensors), Checkpointing Option (Bool)
+    Output: Stage Output (Torch Tensor)
+    '''
+    if enabled and torch.is_grad_enabled():
+        # the first call is the forward pass, every further call a recomputation during the backward pass
+        n_calls = [0]
+        def run_stage(*stage_inputs):
+            n_calls[0] += 1
+            if n_calls[0] == 1:
+                return stage(*stage_inputs)
+            with frozen_batchnorm_stats(stage if isinstance(stage, nn.Module) else stage.__self__):
+                return stage(*stage_inputs)
+        return checkpoint(run_stage, *inputs, use_reentrant=False)
+    return stage(*inputs)
+
+def upsampling_layer(in_channels, out_channels, upsampling_method='conv_transpose'):
+    '''
+    Description: Upsampling by a factor of 2 for the UNet decoders. 'conv_transpose' is a 2x2 transposed convolution, 'bilinear'
+    a bilinear interpolation followed by a 1x1 conv and 'pixel_shuffle' a 1x1 conv to 4x the channels followed by a pixel shuffle.
+    The last two avoid checkerboard artefacts and are often faster on CPU backends.
+    Input: Input Channels, Output Channels, Upsampling Method (String)
+    Output: Upsampling Layer (nn.Module)
+    '''
+    if upsampling_method == 'conv_transpose':
+        return nn.ConvTranspose2d(in_channels, out_channels, kernel_size=2, stride=2)
+    elif upsampling_method == 'bilinear':
+        return nn.Sequential(nn.Upsample(mode='bilinear', scale_factor=2, align_corners=False),
+                             nn.Conv2d(in_channels, out_channels, kernel_size=1))
+    elif upsampling_method == 'pixel_shuffle':
+        return nn.Sequential(nn.Conv2d(in_channels, out_channels * 4, kernel_size=1), nn.PixelShuffle(2))
+    else:
+        raise ValueError(f'Unknown upsampling method: {upsampling_method}')
+
+def modality_dropout_mask(x, p, training):
+    '''
+    Description: Per sample keep mask for modality dropout. During training a modality is dropped (set to zero) for each sample
+    of the batch with probability p, so the fusion models learn to segment from RGB alone as well.
+    Input: Batch of the Modality (Torch Tensor), Dropout Probability, Training Mode (Bool)
+    Output: Keep Mask (Torch Tensor, batch x 1 x 1 x 1) or None if nothing is dropped
+    '''
+    if not training or p <= 0:
+        return None
+    return (torch.rand(x.shape[0], 1, 1, 1, device=x.device) >= p).to(x.dtype)
+
+def forward_without_input_channels(block, x, start, n_missing):
+    '''
+    Description: Runs a conv block (first layer a Conv2d) on an input without the input channels start to start + n_missing,
+    which are treated as zero. Zero channels add nothing to the first convolution, so its weights for them are skipped instead
+    of computed on zeros.
+    Input: Conv Block (nn.Sequential), Input (Torch Tensor), Index of the first missing Channel, Number of missing Channels
+    Output: Block Output (Torch Tensor)
+    '''
+    first_conv = block[0]
+    weight = torch.cat((first_conv.weight[:, :start], first_conv.weight[:, start + n_missing:]), dim=1)
+    x = F.conv2d(x, weight, first_conv.bias, first_conv.stride, first_conv.padding)
+    return block[1:](x)
 
 ##############################################
 ############## UNET CLASSIC ##################
@@ -41,6 +195,11 @@ class encoding_block_gelu_2_conv(nn.Module):
         self.conv = nn.Sequential(*model)
     def forward(self, x):
         return self.conv(x)  
+    def forward_without_channels(self, x, start, n_missing):
+        '''
+        Description: Same as forward for an input without the channels start to start + n_missing, which are treated as zero.
+        '''
+        return forward_without_input_channels(self.conv, x, start, n_missing)
     
 class encoding_block_gelu_3_conv(nn.Module):
     def __init__(self,in_channels, mid_channels, out_channels):
@@ -59,10 +218,18 @@ class encoding_block_gelu_3_conv(nn.Module):
         self.conv = nn.Sequential(*model)
     def forward(self, x):
         return self.conv(x)  
+    def forward_without_channels(self, x, start, n_missing):
+        '''
+        Description: Same as forward for an input without the channels start to start + n_missing, which are treated as zero.
+        '''
+        return forward_without_input_channels(self.conv, x, start, n_missing)
 
+@register_model(RGB_INPUT)
 class unet_model_classic(nn.Module):
-    def __init__(self,out_channels,features=[64, 128, 256, 512]):
+    def __init__(self,out_channels,features=[64, 128, 256, 512], use_checkpointing=False, upsampling_method='conv_transpose'):
         super(unet_model_classic,self).__init__()
+        self.use_checkpointing = use_checkpointing
+        self.upsampling_method = upsampling_method
         self.pool = nn.MaxPool2d(kernel_size=(2,2),stride=(2,2))
         self.conv1 = encoding_block(3,features[0])
         self.conv2 = encoding_block(features[0],features[1])
@@ -72,40 +239,40 @@ class unet_model_classic(nn.Module):
         self.conv6 = encoding_block(features[3],features[2])
         self.conv7 = encoding_block(features[2],features[1])
         self.conv8 = encoding_block(features[1],features[0])        
-        self.tconv1 = nn.ConvTranspose2d(features[-1]*2, features[-1], kernel_size=2, stride=2)
-        self.tconv2 = nn.ConvTranspose2d(features[-1], features[-2], kernel_size=2, stride=2)
-        self.tconv3 = nn.ConvTranspose2d(features[-2], features[-3], kernel_size=2, stride=2)
-        self.tconv4 = nn.ConvTranspose2d(features[-3], features[-4], kernel_size=2, stride=2)        
+        self.tconv1 = upsampling_layer(features[-1]*2, features[-1], upsampling_method)
+        self.tconv2 = upsampling_layer(features[-1], features[-2], upsampling_method)
+        self.tconv3 = upsampling_layer(features[-2], features[-3], upsampling_method)
+        self.tconv4 = upsampling_layer(features[-3], features[-4], upsampling_method)        
         self.bottleneck = encoding_block(features[3],features[3]*2)
         self.final_layer = nn.Conv2d(features[0],out_channels,kernel_size=1)
     def forward(self,x):
         skip_connections = []
-        x = self.conv1(x)
+        x = checkpoint_stage(self.conv1, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv2(x)
+        x = checkpoint_stage(self.conv2, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv3(x)
+        x = checkpoint_stage(self.conv3, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv4(x)
+        x = checkpoint_stage(self.conv4, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.bottleneck(x)
+        x = checkpoint_stage(self.bottleneck, x, enabled=self.use_checkpointing)
         skip_connections = skip_connections[::-1]
         x = self.tconv1(x)
         x = torch.cat((skip_connections[0], x), dim=1)
-        x = self.conv5(x)
+        x = checkpoint_stage(self.conv5, x, enabled=self.use_checkpointing)
         x = self.tconv2(x)
         x = torch.cat((skip_connections[1], x), dim=1)
-        x = self.conv6(x)
+        x = checkpoint_stage(self.conv6, x, enabled=self.use_checkpointing)
         x = self.tconv3(x)
         x = torch.cat((skip_connections[2], x), dim=1)
-        x = self.conv7(x)        
+        x = checkpoint_stage(self.conv7, x, enabled=self.use_checkpointing)        
         x = self.tconv4(x)
         x = torch.cat((skip_connections[3], x), dim=1)
-        x = self.conv8(x)
+        x = checkpoint_stage(self.conv8, x, enabled=self.use_checkpointing)
         x = self.final_layer(x)
         return x
 
@@ -127,10 +294,19 @@ class encoding_block_gelu(nn.Module):
         self.conv = nn.Sequential(*model)
     def forward(self, x):
         return self.conv(x)  
-
+    def forward_leading_channels(self, x):
+        '''
+        Description: Same as forward for an input with only the leading input channels, the missing channels are treated as
+        zero, so their part of the first convolution is skipped instead of computed on zeros.
+        '''
+        return forward_without_input_channels(self.conv, x, x.shape[1], self.conv[0].in_channels - x.shape[1])
+
+@register_model(RGB_INPUT)
 class unet_model_gelu(nn.Module):
-    def __init__(self,out_channels,features=[64, 128, 256, 512]):
+    def __init__(self,out_channels,features=[64, 128, 256, 512], use_checkpointing=False, upsampling_method='conv_transpose'):
         super(unet_model_gelu,self).__init__()
+        self.use_checkpointing = use_checkpointing
+        self.upsampling_method = upsampling_method
         self.pool = nn.MaxPool2d(kernel_size=(2,2),stride=(2,2))
         self.conv1 = encoding_block_gelu(3,features[0])
         self.conv2 = encoding_block_gelu(features[0],features[1])
@@ -140,40 +316,40 @@ class unet_model_gelu(nn.Module):
         self.conv6 = encoding_block_gelu(features[3],features[2])
         self.conv7 = encoding_block_gelu(features[2],features[1])
         self.conv8 = encoding_block_gelu(features[1],features[0])        
-        self.tconv1 = nn.ConvTranspose2d(features[-1]*2, features[-1], kernel_size=2, stride=2)
-        self.tconv2 = nn.ConvTranspose2d(features[-1], features[-2], kernel_size=2, stride=2)
-        self.tconv3 = nn.ConvTranspose2d(features[-2], features[-3], kernel_size=2, stride=2)
-        self.tconv4 = nn.ConvTranspose2d(features[-3], features[-4], kernel_size=2, stride=2)        
+        self.tconv1 = upsampling_layer(features[-1]*2, features[-1], upsampling_method)
+        self.tconv2 = upsampling_layer(features[-1], features[-2], upsampling_method)
+        self.tconv3 = upsampling_layer(features[-2], features[-3], upsampling_method)
+        self.tconv4 = upsampling_layer(features[-3], features[-4], upsampling_method)        
         self.bottleneck = encoding_block_gelu(features[3],features[3]*2)
         self.final_layer = nn.Conv2d(features[0],out_channels,kernel_size=1)
     def forward(self,x):
         skip_connections = []
-        x = self.conv1(x)
+        x = checkpoint_stage(self.conv1, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv2(x)
+        x = checkpoint_stage(self.conv2, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv3(x)
+        x = checkpoint_stage(self.conv3, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv4(x)
+        x = checkpoint_stage(self.conv4, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.bottleneck(x)
+        x = checkpoint_stage(self.bottleneck, x, enabled=self.use_checkpointing)
         skip_connections = skip_connections[::-1]
         x = self.tconv1(x)
         x = torch.cat((skip_connections[0], x), dim=1)
-        x = self.conv5(x)
+        x = checkpoint_stage(self.conv5, x, enabled=self.use_checkpointing)
         x = self.tconv2(x)
         x = torch.cat((skip_connections[1], x), dim=1)
-        x = self.conv6(x)
+        x = checkpoint_stage(self.conv6, x, enabled=self.use_checkpointing)
         x = self.tconv3(x)
         x = torch.cat((skip_connections[2], x), dim=1)
-        x = self.conv7(x)        
+        x = checkpoint_stage(self.conv7, x, enabled=self.use_checkpointing)        
         x = self.tconv4(x)
         x = torch.cat((skip_connections[3], x), dim=1)
-        x = self.conv8(x)
+        x = checkpoint_stage(self.conv8, x, enabled=self.use_checkpointing)
         x = self.final_layer(x)
         return x
 
@@ -234,13 +410,7 @@ class UpBlockForUNetWithResNet50(nn.Module):
         if up_conv_out_channels == None:
             up_conv_out_channels = out_channels
 
-        if upsampling_method == "conv_transpose":
-            self.upsample = nn.ConvTranspose2d(up_conv_in_channels, up_conv_out_channels, kernel_size=2, stride=2)
-        elif upsampling_method == "bilinear":
-            self.upsample = nn.Sequential(
-                nn.Upsample(mode='bilinear', scale_factor=2),
-                nn.Conv2d(in_channels, out_channels, kernel_size=1, stride=1)
-            )
+        self.upsample = upsampling_layer(up_conv_in_channels, up_conv_out_channels, upsampling_method)
         self.conv_block_1 = ConvBlock(in_channels, out_channels)
         self.conv_block_2 = ConvBlock(out_channels, out_channels)
 
@@ -258,11 +428,20 @@ class UpBlockForUNetWithResNet50(nn.Module):
         return x
 
 
+@register_model(RGB_INPUT)
 class UNetWithResnet50Encoder(nn.Module):
+    '''
+    Description: UNet with a pretrained ResNet-50 encoder. With freeze_encoder (or set_encoder_frozen) the encoder (input_block
+    and down_blocks) is not trained and stays in eval mode, so only the bridge and the up_blocks are trained. The forward pass
+    is split into encode and decode, so the encoder features of un-augmented images can be cached (cache_encoder_features)
+    and the decoder trained on the cache with resnet50_cached_decoder.
+    '''
     DEPTH = 6
 
-    def __init__(self, n_classes):
+    def __init__(self, n_classes, use_checkpointing=False, freeze_encoder=False, upsampling_method='conv_transpose'):
         super().__init__()
+        self.use_checkpointing = use_checkpointing
+        self.upsampling_method = upsampling_method
         resnet = torchvision.models.resnet.resnet50(pretrained=True)
         down_blocks = []
         up_blocks = []
@@ -273,44 +452,103 @@ class UNetWithResnet50Encoder(nn.Module):
                 down_blocks.append(bottleneck)
         self.down_blocks = nn.ModuleList(down_blocks)
         self.bridge = Bridge(2048, 2048)
-        up_blocks.append(UpBlockForUNetWithResNet50(2048, 1024))
-        up_blocks.append(UpBlockForUNetWithResNet50(1024, 512))
-        up_blocks.append(UpBlockForUNetWithResNet50(512, 256))
+        up_blocks.append(UpBlockForUNetWithResNet50(2048, 1024, upsampling_method=upsampling_method))
+        up_blocks.append(UpBlockForUNetWithResNet50(1024, 512, upsampling_method=upsampling_method))
+        up_blocks.append(UpBlockForUNetWithResNet50(512, 256, upsampling_method=upsampling_method))
         up_blocks.append(UpBlockForUNetWithResNet50(in_channels=128 + 64, out_channels=128,
-                                                    up_conv_in_channels=256, up_conv_out_channels=128))
+                                                    up_conv_in_channels=256, up_conv_out_channels=128,
+                                                    upsampling_method=upsampling_method))
         up_blocks.append(UpBlockForUNetWithResNet50(in_channels=64 + 3, out_channels=64,
-                                                    up_conv_in_channels=128, up_conv_out_channels=64))
+                                                    up_conv_in_channels=128, up_conv_out_channels=64,
+                                                    upsampling_method=upsampling_method))
 
         self.up_blocks = nn.ModuleList(up_blocks)
 
         self.out = nn.Conv2d(64, n_classes, kernel_size=1, stride=1)
 
-    def forward(self, x, with_output_feature_map=False):
+        self.set_encoder_frozen(freeze_encoder)
+
+    def set_encoder_frozen(self, frozen=True):
+        self.encoder_frozen = frozen
+        for module in [self.input_block, self.down_blocks]:
+            for param in module.parameters():
+                param.requires_grad = not frozen
+        self.train(self.training)
+
+    def train(self, mode=True):
+        super().train(mode)
+        #frozen encoder keeps its batch norm statistics
+        if getattr(self, 'encoder_frozen', False):
+            self.input_block.eval()
+            self.down_blocks.eval()
+        return self
+
+    def encode(self, x):
+        '''
+        Description: Encoder part of the forward pass.
+        Input: Image (Torch Tensor)
+        Output: Feature Pyramid (Dictionary with the skip features layer_0 - layer_4 and the bridge input bridge_input)
+        '''
         pre_pools = dict()
         pre_pools[f"layer_0"] = x
-        x = self.input_block(x)
+        x = checkpoint_stage(self.input_block, x, enabled=self.use_checkpointing)
         pre_pools[f"layer_1"] = x
         x = self.input_pool(x)
 
         for i, block in enumerate(self.down_blocks, 2):
-            x = block(x)
+            x = checkpoint_stage(block, x, enabled=self.use_checkpointing)
             if i == (UNetWithResnet50Encoder.DEPTH - 1):
                 continue
             pre_pools[f"layer_{i}"] = x
 
-        x = self.bridge(x)
+        pre_pools["bridge_input"] = x
+        return pre_pools
+
+    def decode(self, pre_pools, with_output_feature_map=False):
+        '''
+        Description: Decoder part of the forward pass (bridge, up_blocks and output layer).
+        Input: Feature Pyramid from encode, Output Feature Map Option
+        Output: Logits (and Output Feature Map)
+        '''
+        x = checkpoint_stage(self.bridge, pre_pools["bridge_input"], enabled=self.use_checkpointing)
 
         for i, block in enumerate(self.up_blocks, 1):
             key = f"layer_{UNetWithResnet50Encoder.DEPTH - 1 - i}"
-            x = block(x, pre_pools[key])
+            x = checkpoint_stage(block, x, pre_pools[key], enabled=self.use_checkpointing)
         output_feature_map = x
         x = self.out(x)
-        del pre_pools
         if with_output_feature_map:
             return x, output_feature_map
         else:
             return x
 
+    def forward(self, x, with_output_feature_map=False):
+        pre_pools = self.encode(x)
+        output = self.decode(pre_pools, with_output_feature_map)
+        del pre_pools
+        return output
+
+@register_model(FEATURES_INPUT)
+class resnet50_cached_decoder(nn.Module):
+    '''
+    Description: Trains and runs the decoder of a UNetWithResnet50Encoder on cached encoder features (_ResNet50_Feature_Cache_Dataset).
+    The cache stores the feature pyramid of an image packed into one flat vector (data source 'features'). The forward pass
+    unpacks the vector and calls decode.
+    '''
+    def __init__(self, model, feature_shapes):
+        super(resnet50_cached_decoder, self).__init__()
+        self.model = model
+        self.feature_shapes = feature_shapes
+
+    def forward(self, packed_features):
+        pre_pools = dict()
+        offset = 0
+        for name, shape in self.feature_shapes:
+            size = shape[0] * shape[1] * shape[2]
+            pre_pools[name] = packed_features[:, offset:offset + size].reshape(-1, *shape)
+            offset += size
+        return self.model.decode(pre_pools)
+
 ############################################
 ############### HSI UNET ###################
 ############################################
@@ -336,9 +574,13 @@ class preprocessing_block(nn.Module):
     def forward(self, x):
         return self.preprocess(x)
 
+@register_model(HSI_INPUT)
 class hsi_unet_model_gelu_pca(nn.Module):
-    def __init__(self, in_channels, out_channels=10, features=[64, 128, 256, 512]):
+    def __init__(self, in_channels, out_channels=10, features=[64, 128, 256, 512], use_checkpointing=False,
+                 upsampling_method='conv_transpose'):
         super(hsi_unet_model_gelu_pca,self).__init__()
+        self.use_checkpointing = use_checkpointing
+        self.upsampling_method = upsampling_method
         self.pool = nn.MaxPool2d(kernel_size=(2,2),stride=(2,2))
         self.conv1 = encoding_block_gelu(in_channels,features[0])
         self.conv2 = encoding_block_gelu(features[0],features[1])
@@ -348,46 +590,50 @@ class hsi_unet_model_gelu_pca(nn.Module):
         self.conv6 = encoding_block_gelu(features[3],features[2])
         self.conv7 = encoding_block_gelu(features[2],features[1])
         self.conv8 = encoding_block_gelu(features[1],features[0])
-        self.tconv1 = nn.ConvTranspose2d(features[-1]*2, features[-1], kernel_size=2, stride=2)
-        self.tconv2 = nn.ConvTranspose2d(features[-1], features[-2], kernel_size=2, stride=2)
-        self.tconv3 = nn.ConvTranspose2d(features[-2], features[-3], kernel_size=2, stride=2)
-        self.tconv4 = nn.ConvTranspose2d(features[-3], features[-4], kernel_size=2, stride=2)
+        self.tconv1 = upsampling_layer(features[-1]*2, features[-1], upsampling_method)
+        self.tconv2 = upsampling_layer(features[-1], features[-2], upsampling_method)
+        self.tconv3 = upsampling_layer(features[-2], features[-3], upsampling_method)
+        self.tconv4 = upsampling_layer(features[-3], features[-4], upsampling_method)
         self.bottleneck = encoding_block_gelu(features[3],features[3]*2)
         self.final_layer = nn.Conv2d(features[0],out_channels,kernel_size=1)
     def forward(self,x):
         skip_connections = []
-        x = self.conv1(x)
+        x = checkpoint_stage(self.conv1, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv2(x)
+        x = checkpoint_stage(self.conv2, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv3(x)
+        x = checkpoint_stage(self.conv3, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv4(x)
+        x = checkpoint_stage(self.conv4, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.bottleneck(x)
+        x = checkpoint_stage(self.bottleneck, x, enabled=self.use_checkpointing)
         skip_connections = skip_connections[::-1]
         x = self.tconv1(x)
         x = torch.cat((skip_connections[0], x), dim=1)
-        x = self.conv5(x)
+        x = checkpoint_stage(self.conv5, x, enabled=self.use_checkpointing)
         x = self.tconv2(x)
         x = torch.cat((skip_connections[1], x), dim=1)
-        x = self.conv6(x)
+        x = checkpoint_stage(self.conv6, x, enabled=self.use_checkpointing)
         x = self.tconv3(x)
         x = torch.cat((skip_connections[2], x), dim=1)
-        x = self.conv7(x)
+        x = checkpoint_stage(self.conv7, x, enabled=self.use_checkpointing)
         x = self.tconv4(x)
         x = torch.cat((skip_connections[3], x), dim=1)
-        x = self.conv8(x)
+        x = checkpoint_stage(self.conv8, x, enabled=self.use_checkpointing)
         x = self.final_layer(x)
         return x
 
+@register_model(ModelInput('x', 'hsi', torch.float32, 45))
 class hsi_unet_model_gelu(nn.Module):
-    def __init__(self, in_channels, out_channels=10, features=[64, 128, 256, 512]):
+    def __init__(self, in_channels, out_channels=10, features=[64, 128, 256, 512], use_checkpointing=False,
+                 upsampling_method='conv_transpose'):
         super(hsi_unet_model_gelu,self).__init__()
+        self.use_checkpointing = use_checkpointing
+        self.upsampling_method = upsampling_method
         self.preprocess = preprocessing_block(in_channels)
         self.pool = nn.MaxPool2d(kernel_size=(2,2),stride=(2,2))
         self.conv1 = encoding_block_gelu(in_channels,features[0])
@@ -398,41 +644,41 @@ class hsi_unet_model_gelu(nn.Module):
         self.conv6 = encoding_block_gelu(features[3],features[2])
         self.conv7 = encoding_block_gelu(features[2],features[1])
         self.conv8 = encoding_block_gelu(features[1],features[0])
-        self.tconv1 = nn.ConvTranspose2d(features[-1]*2, features[-1], kernel_size=2, stride=2)
-        self.tconv2 = nn.ConvTranspose2d(features[-1], features[-2], kernel_size=2, stride=2)
-        self.tconv3 = nn.ConvTranspose2d(features[-2], features[-3], kernel_size=2, stride=2)
-        self.tconv4 = nn.ConvTranspose2d(features[-3], features[-4], kernel_size=2, stride=2)
+        self.tconv1 = upsampling_layer(features[-1]*2, features[-1], upsampling_method)
+        self.tconv2 = upsampling_layer(features[-1], features[-2], upsampling_method)
+        self.tconv3 = upsampling_layer(features[-2], features[-3], upsampling_method)
+        self.tconv4 = upsampling_layer(features[-3], features[-4], upsampling_method)
         self.bottleneck = encoding_block_gelu(features[3],features[3]*2)
         self.final_layer = nn.Conv2d(features[0],out_channels,kernel_size=1)
     def forward(self,x):
-        x = self.preprocess(x)
+        x = checkpoint_stage(self.preprocess, x, enabled=self.use_checkpointing)
         skip_connections = []
-        x = self.conv1(x)
+        x = checkpoint_stage(self.conv1, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv2(x)
+        x = checkpoint_stage(self.conv2, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv3(x)
+        x = checkpoint_stage(self.conv3, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv4(x)
+        x = checkpoint_stage(self.conv4, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.bottleneck(x)
+        x = checkpoint_stage(self.bottleneck, x, enabled=self.use_checkpointing)
         skip_connections = skip_connections[::-1]
         x = self.tconv1(x)
         x = torch.cat((skip_connections[0], x), dim=1)
-        x = self.conv5(x)
+        x = checkpoint_stage(self.conv5, x, enabled=self.use_checkpointing)
         x = self.tconv2(x)
         x = torch.cat((skip_connections[1], x), dim=1)
-        x = self.conv6(x)
+        x = checkpoint_stage(self.conv6, x, enabled=self.use_checkpointing)
         x = self.tconv3(x)
         x = torch.cat((skip_connections[2], x), dim=1)
-        x = self.conv7(x)
+        x = checkpoint_stage(self.conv7, x, enabled=self.use_checkpointing)
         x = self.tconv4(x)
         x = torch.cat((skip_connections[3], x), dim=1)
-        x = self.conv8(x)
+        x = checkpoint_stage(self.conv8, x, enabled=self.use_checkpointing)
         x = self.final_layer(x)
         return x
 
@@ -440,101 +686,219 @@ class hsi_unet_model_gelu(nn.Module):
 ############### HSI/RGB UNET Feature Fusion ###################
 ###############################################################
 
+class skip_fusion_block(nn.Module):
+    '''
+    Description: Lightweight fusion of an RGB and an HSI skip connection, used instead of concatenating both skips. 'conv1x1'
+    compresses each skip to half the channels with a 1x1 conv and concatenates them, 'gated' weights both skips per pixel and
+    channel with a learned sigmoid gate. Both return as many channels as the RGB skip.
+    '''
+    def __init__(self, channels, fusion_mode='conv1x1', channels_hsi=None):
+        super(skip_fusion_block,self).__init__()
+        self.fusion_mode = fusion_mode
+        channels_hsi = channels if channels_hsi is None else channels_hsi
+        if fusion_mode == 'conv1x1':
+            self.compress_rgb = nn.Sequential(nn.Conv2d(channels, channels // 2, 1, 1, bias=False), nn.BatchNorm2d(channels // 2), nn.GELU())
+            self.compress_hsi = nn.Sequential(nn.Conv2d(channels_hsi, channels - channels // 2, 1, 1, bias=False),
+                                              nn.BatchNorm2d(channels - channels // 2), nn.GELU())
+        elif fusion_mode == 'gated':
+            #hsi skips of the reduced resolution branch have a different number of channels and are projected first
+            self.project_hsi = nn.Conv2d(channels_hsi, channels, 1, 1, bias=False) if channels_hsi != channels else nn.Identity()
+            self.gate = nn.Sequential(nn.Conv2d(channels * 2, channels, 1, 1), nn.Sigmoid())
+        else:
+            raise ValueError(f'Unknown fusion mode: {fusion_mode}')
+    def forward(self, skip_rgb, skip_hsi):
+        if self.fusion_mode == 'conv1x1':
+            return torch.cat((self.compress_rgb(skip_rgb), self.compress_hsi(skip_hsi)), dim=1)
+        skip_hsi = self.project_hsi(skip_hsi)
+        gate = self.gate(torch.cat((skip_rgb, skip_hsi), dim=1))
+        return gate * skip_rgb + (1 - gate) * skip_hsi
+    def forward_without_hsi(self, skip_rgb):
+        '''
+        Description: Same as forward with a zero HSI skip. The compressed zero skip is the same for every pixel, so in eval mode
+        it is computed for a single pixel. The projected zero skip is zero, so the gate only uses its RGB weights.
+        '''
+        if self.fusion_mode == 'conv1x1':
+            n, _, h, w = skip_rgb.shape
+            zero_size = (h, w) if self.training else (1, 1)
+            skip_hsi = self.compress_hsi(skip_rgb.new_zeros((n, self.compress_hsi[0].in_channels, *zero_size)))
+            return torch.cat((self.compress_rgb(skip_rgb), skip_hsi.expand(-1, -1, h, w)), dim=1)
+        gate_conv = self.gate[0]
+        gate = self.gate[1](F.conv2d(skip_rgb, gate_conv.weight[:, :skip_rgb.shape[1]], gate_conv.bias))
+        return gate * skip_rgb
+
+@register_model(*FUSION_INPUTS)
 class unet_model_gelu_feature_level_fusion(nn.Module):
-    def __init__(self,in_channels_hsi, out_channels=10):
+    '''
+    Description: Feature level fusion of RGB and HSI. With modality_dropout > 0 the HSI features are dropped for random samples
+    during training. At inference x_hsi can be None (e.g. when the HSI camera drops a frame), then the HSI branch is skipped
+    entirely and the model gives the output of zero HSI features, as during modality dropout, without computing them (the
+    bridge and decoder blocks skip the weights of the HSI channels of their first convolution).
+    fusion_mode 'concat' concatenates both skips with the upsampled features (3x the channels of a level). 'conv1x1' and 'gated'
+    fuse both skips with a skip_fusion_block first, so the decoder blocks only get 2x the channels and a reduced mid width,
+    which makes the decoder, the most expensive part of the model, a lot cheaper.
+    With hsi_scale 2 or 4 the HSI branch runs at 1/2 or 1/4 of the RGB resolution (about 3/4 or 15/16 less HSI compute). Each HSI
+    feature joins the RGB decoder at the level with the same resolution, the highest resolution levels have no HSI skip and the
+    deepest HSI stages are not needed. x_hsi is expected at the reduced resolution (see hsi_scale of _WH_RGB_HSI_Dataset), with
+    hsi_input_full_resolution it is expected at the RGB resolution and average pooled by the model. This is a constructor option
+    and not decided from the input shape, so the model can be traced (quantization, TorchScript and ONNX export).
+    '''
+    def __init__(self,in_channels_hsi, out_channels=10, features=[64, 128, 256, 512], use_checkpointing=False, modality_dropout=0.0,
+                 fusion_mode='concat', hsi_scale=1, upsampling_method='conv_transpose', hsi_input_full_resolution=False):
         super(unet_model_gelu_feature_level_fusion,self).__init__()
+        if hsi_scale not in (1, 2, 4):
+            raise ValueError(f'hsi_scale has to be 1, 2 or 4, not {hsi_scale}')
+        self.use_checkpointing = use_checkpointing
+        self.upsampling_method = upsampling_method
+        self.modality_dropout = modality_dropout
+        self.fusion_mode = fusion_mode
+        self.hsi_scale = hsi_scale
+        self.hsi_input_full_resolution = hsi_input_full_resolution
+        self.hsi_level_offset = {1: 0, 2: 1, 4: 2}[hsi_scale]
+        #channels of the hsi features joining the bridge and the decoder levels (deepest first), 0 if there is none
+        hsi_stage_channels = [features[0], features[1], features[2], features[3], features[3]*2]
+        self.hsi_channels = [hsi_stage_channels[level - self.hsi_level_offset] if level >= self.hsi_level_offset else 0
+                             for level in range(4, -1, -1)]
+
         self.pool = nn.MaxPool2d(kernel_size=(2,2),stride=(2,2))
-        self.conv1_rgb = encoding_block_gelu_2_conv(3, 64)
-        self.conv1_hsi = encoding_block_gelu_2_conv(in_channels_hsi, 64)
-        self.conv2 = encoding_block_gelu_2_conv(64, 128)
-        self.conv3 = encoding_block_gelu_2_conv(128, 256)
-        self.conv4 = encoding_block_gelu_2_conv(256, 512)
-        self.conv_bridge = encoding_block_gelu_2_conv(512, 1024)
-        self.deconv_bridge_1 = encoding_block_gelu_2_conv(2048, 1024)
-        self.deconv_bridge_2 = encoding_block_gelu_2_conv(1024, 512)
-        self.deconv4 = encoding_block_gelu_3_conv(1536, 1024, 512)
-        self.deconv3 = encoding_block_gelu_3_conv(768, 512, 256)
-        self.deconv2 = encoding_block_gelu_3_conv(384, 256, 128)
-        self.deconv1 = encoding_block_gelu_3_conv(192, 128, 64)
-        self.tconv5 = nn.ConvTranspose2d(1024, 512, kernel_size=2, stride=2)
-        self.tconv4 = nn.ConvTranspose2d(512, 256, kernel_size=2, stride=2)
-        self.tconv3 = nn.ConvTranspose2d(256, 128, kernel_size=2, stride=2)
-        self.tconv2 = nn.ConvTranspose2d(128, 64, kernel_size=2, stride=2)
-        self.final_layer = nn.Conv2d(64,out_channels,kernel_size=1)
-    def forward(self, x_rgb, x_hsi):
+        self.conv1_rgb = encoding_block_gelu_2_conv(3, features[0])
+        self.conv1_hsi = encoding_block_gelu_2_conv(in_channels_hsi, features[0])
+        self.conv2 = encoding_block_gelu_2_conv(features[0], features[1])
+        self.conv3 = encoding_block_gelu_2_conv(features[1], features[2])
+        self.conv4 = encoding_block_gelu_2_conv(features[2], features[3])
+        self.conv_bridge = encoding_block_gelu_2_conv(features[3], features[3]*2)
+        self.deconv_bridge_1 = encoding_block_gelu_2_conv(features[3]*2 + self.hsi_channels[0], features[3]*2)
+        self.deconv_bridge_2 = encoding_block_gelu_2_conv(features[3]*2, features[3])
+        if fusion_mode == 'concat':
+            self.deconv4 = encoding_block_gelu_3_conv(features[3]*2 + self.hsi_channels[1], features[3]*2, features[3])
+            self.deconv3 = encoding_block_gelu_3_conv(features[2]*2 + self.hsi_channels[2], features[2]*2, features[2])
+            self.deconv2 = encoding_block_gelu_3_conv(features[1]*2 + self.hsi_channels[3], features[1]*2, features[1])
+            self.deconv1 = encoding_block_gelu_3_conv(features[0]*2 + self.hsi_channels[4], features[0]*2, features[0])
+        else:
+            #skip fusion per level, from the deepest (deconv4) to the highest resolution (deconv1)
+            self.skip_fusion = nn.ModuleList([skip_fusion_block(f, fusion_mode, c) if c else nn.Identity()
+                                              for f, c in zip(features[::-1], self.hsi_channels[1:])])
+            self.deconv4 = encoding_block_gelu_3_conv(features[3]*2, features[3], features[3])
+            self.deconv3 = encoding_block_gelu_3_conv(features[2]*2, features[2], features[2])
+            self.deconv2 = encoding_block_gelu_3_conv(features[1]*2, features[1], features[1])
+            self.deconv1 = encoding_block_gelu_3_conv(features[0]*2, features[0], features[0])
+        self.tconv5 = upsampling_layer(features[3]*2, features[3], upsampling_method)
+        self.tconv4 = upsampling_layer(features[3], features[2], upsampling_method)
+        self.tconv3 = upsampling_layer(features[2], features[1], upsampling_method)
+        self.tconv2 = upsampling_layer(features[1], features[0], upsampling_method)
+        self.final_layer = nn.Conv2d(features[0],out_channels,kernel_size=1)
+    def fuse_skips(self, level, skip_rgb, skip_hsi, x_comb):
+        if skip_hsi is None:
+            return torch.cat((skip_rgb, x_comb), dim=1)
+        if self.fusion_mode == 'concat':
+            return torch.cat((skip_rgb, skip_hsi, x_comb), dim=1)
+        return torch.cat((self.skip_fusion[level](skip_rgb, skip_hsi), x_comb), dim=1)
+    def decoder_stage(self, level, block, skip_rgb, skip_hsi, x_comb, hsi_missing=False):
+        '''
+        Description: Fuses the skips of a decoder level (0 is the deepest) with the upsampled features and runs its decoder block.
+        If the HSI input is missing, the zero HSI skip is not concatenated and the decoder block skips its weights.
+        '''
+        n_hsi = self.hsi_channels[level + 1]
+        if hsi_missing and n_hsi:
+            if self.fusion_mode == 'concat':
+                x_comb = torch.cat((skip_rgb, x_comb), dim=1)
+                return checkpoint_stage(block.forward_without_channels, x_comb, skip_rgb.shape[1], n_hsi, enabled=self.use_checkpointing)
+            x_comb = torch.cat((self.skip_fusion[level].forward_without_hsi(skip_rgb), x_comb), dim=1)
+        else:
+            x_comb = self.fuse_skips(level, skip_rgb, skip_hsi, x_comb)
+        return checkpoint_stage(block, x_comb, enabled=self.use_checkpointing)
+    def forward(self, x_rgb, x_hsi=None):
         skip_connections_rgb = []
         skip_connections_hsi = []
         
         #rgb downsampling
-        x_rgb = self.conv1_rgb(x_rgb) # 320, 320, 3 -> 320, 320, 64
+        x_rgb = checkpoint_stage(self.conv1_rgb, x_rgb, enabled=self.use_checkpointing) # 320, 320, 3 -> 320, 320, 64
         skip_connections_rgb.append(x_rgb)
         x_rgb = self.pool(x_rgb)
         
-        x_rgb = self.conv2(x_rgb) # 320, 320, 64 -> 160, 160, 128 
+        x_rgb = checkpoint_stage(self.conv2, x_rgb, enabled=self.use_checkpointing) # 320, 320, 64 -> 160, 160, 128 
         skip_connections_rgb.append(x_rgb)
         x_rgb = self.pool(x_rgb)
         
-        x_rgb = self.conv3(x_rgb) # 160, 160, 128 -> 80, 80, 256
+        x_rgb = checkpoint_stage(self.conv3, x_rgb, enabled=self.use_checkpointing) # 160, 160, 128 -> 80, 80, 256
         skip_connections_rgb.append(x_rgb)
         x_rgb = self.pool(x_rgb)
         
-        x_rgb = self.conv4(x_rgb) # 80, 80, 256 -> 40, 40, 512
+        x_rgb = checkpoint_stage(self.conv4, x_rgb, enabled=self.use_checkpointing) # 80, 80, 256 -> 40, 40, 512
         skip_connections_rgb.append(x_rgb)
         x_rgb = self.pool(x_rgb)
         
-        x_rgb = self.conv_bridge(x_rgb) # 40, 40, 512 -> 20, 20, 1024
+        x_rgb = checkpoint_stage(self.conv_bridge, x_rgb, enabled=self.use_checkpointing) # 40, 40, 512 -> 20, 20, 1024
         skip_connections_rgb = skip_connections_rgb[::-1] #reverses order of list
         
-        #hsi downsampling
-        x_hsi = self.conv1_hsi(x_hsi) # 320, 320, 3 -> 320, 320, 64
-        skip_connections_hsi.append(x_hsi)
-        x_hsi = self.pool(x_hsi)
-        
-        x_hsi = self.conv2(x_hsi) # 320, 320, 64 -> 
-        skip_connections_hsi.append(x_hsi)
-        x_hsi = self.pool(x_hsi)
-        
-        x_hsi = self.conv3(x_hsi) # 160, 160, 128 -> 80, 80, 256
-        skip_connections_hsi.append(x_hsi)
-        x_hsi = self.pool(x_hsi)
-        
-        x_hsi = self.conv4(x_hsi) # 80, 80, 256 -> 40, 40, 512
-        skip_connections_hsi.append(x_hsi)
-        x_hsi = self.pool(x_hsi)
-        
-        x_hsi = self.conv_bridge(x_hsi) # 40, 40, 512 -> 20, 20, 1024
-        skip_connections_hsi = skip_connections_hsi[::-1] #reverses order of list
-        
+        hsi_missing = x_hsi is None
+        if hsi_missing:
+            #hsi branch skipped, the decoder treats its features as zero like during modality dropout
+            skip_connections_hsi = [None] * 4
+        else:
+            if self.hsi_input_full_resolution and self.hsi_scale > 1:
+                x_hsi = F.avg_pool2d(x_hsi, self.hsi_scale)
+
+            #hsi downsampling, with hsi_scale > 1 the deepest stages are not needed
+            hsi_stages = [self.conv1_hsi, self.conv2, self.conv3, self.conv4, self.conv_bridge][:5 - self.hsi_level_offset]
+            for i, stage in enumerate(hsi_stages):
+                if i > 0:
+                    x_hsi = self.pool(x_hsi)
+                x_hsi = checkpoint_stage(stage, x_hsi, enabled=self.use_checkpointing) # 320, 320, 3 -> 320, 320, 64 -> ... -> 20, 20, 1024
+                skip_connections_hsi.append(x_hsi)
+
+            #hsi features aligned with the rgb levels (bridge and skips, deepest first), None where no hsi feature exists
+            skip_connections_hsi = skip_connections_hsi[::-1] + [None] * self.hsi_level_offset
+            x_hsi, skip_connections_hsi = skip_connections_hsi[0], skip_connections_hsi[1:]
+
+            keep_hsi = modality_dropout_mask(x_rgb, self.modality_dropout, self.training)
+            if keep_hsi is not None:
+                skip_connections_hsi = [skip * keep_hsi if skip is not None else None for skip in skip_connections_hsi]
+                x_hsi = x_hsi * keep_hsi if x_hsi is not None else None
+
         #bridge
-        x_comb = torch.cat((x_rgb, x_hsi), dim=1) #-> 20, 20, 2048
-        x_comb = self.deconv_bridge_1(x_comb) # 20, 20, 2048 -> 20, 20, 1024
+        if hsi_missing and self.hsi_channels[0]:
+            x_comb = checkpoint_stage(self.deconv_bridge_1.forward_without_channels, x_rgb, x_rgb.shape[1], self.hsi_channels[0],
+                                      enabled=self.use_checkpointing) # 20, 20, 1024 -> 20, 20, 1024
+        else:
+            x_comb = torch.cat((x_rgb, x_hsi), dim=1) if x_hsi is not None else x_rgb #-> 20, 20, 2048
+            x_comb = checkpoint_stage(self.deconv_bridge_1, x_comb, enabled=self.use_checkpointing) # 20, 20, 2048 -> 20, 20, 1024
         
         # combined upsampling
         x_comb = self.tconv5(x_comb) # 20, 20, 1024 -> 40, 40, 512
         #x_comb = self.deconv_bridge_2(x_comb) # 40, 40, 1024 -> 40, 40, 512
-        x_comb = torch.cat((skip_connections_rgb[0], skip_connections_hsi[0], x_comb), dim=1) #-> 40, 40, 1536
-        #print(x_comb.shape)
         
-        x_comb = self.deconv4(x_comb) # 40, 40, 1536 -> 40, 40, 512
+        #-> 40, 40, 1536 (concat), 1024 (conv1x1/gated) -> 40, 40, 512
+        x_comb = self.decoder_stage(0, self.deconv4, skip_connections_rgb[0], skip_connections_hsi[0], x_comb, hsi_missing)
         x_comb = self.tconv4(x_comb) # 40, 40, 512 -> 80, 80, 512
-        x_comb = torch.cat((skip_connections_rgb[1], skip_connections_hsi[1], x_comb), dim=1) #-> 80, 80, 768
         
-        x_comb = self.deconv3(x_comb) # 80, 80, 768 -> 80, 80, 256
+        #-> 80, 80, 768 (concat), 512 (conv1x1/gated) -> 80, 80, 256
+        x_comb = self.decoder_stage(1, self.deconv3, skip_connections_rgb[1], skip_connections_hsi[1], x_comb, hsi_missing)
         x_comb = self.tconv3(x_comb) # 80, 80, 256 -> 160, 160, 128
-        x_comb = torch.cat((skip_connections_rgb[2], skip_connections_hsi[2], x_comb), dim=1) #-> 160, 160, 384
         
-        x_comb = self.deconv2(x_comb) # 160, 160, 384 -> 160, 160, 128
+        #-> 160, 160, 384 (concat), 256 (conv1x1/gated) -> 160, 160, 128
+        x_comb = self.decoder_stage(2, self.deconv2, skip_connections_rgb[2], skip_connections_hsi[2], x_comb, hsi_missing)
         x_comb = self.tconv2(x_comb) # 160, 160, 128 -> 320, 320, 64
-        x_comb = torch.cat((skip_connections_rgb[3], skip_connections_hsi[3], x_comb), dim=1) #-> 320, 320, 192
         
-        x_comb = self.deconv1(x_comb) # 320, 320, 192 -> 320, 320, 64
+        #-> 320, 320, 192 (concat), 128 (conv1x1/gated) -> 320, 320, 64
+        x_comb = self.decoder_stage(3, self.deconv1, skip_connections_rgb[3], skip_connections_hsi[3], x_comb, hsi_missing)
         x_comb = self.final_layer(x_comb)
         
         return x_comb
 
+@register_model(*FUSION_INPUTS)
 class unet_model_gelu_data_level_fusion(nn.Module):
-    def __init__(self,in_channels_hsi, out_channels=10,features=[64, 128, 256, 512]):
+    '''
+    Description: Data level fusion of RGB and HSI. With modality_dropout > 0 the HSI channels are set to zero for random samples
+    during training. At inference x_hsi can be None (e.g. when the HSI camera drops a frame), then the model gives the output
+    of zero HSI channels without computing them (the first convolution only uses its RGB weights).
+    '''
+    def __init__(self,in_channels_hsi, out_channels=10,features=[64, 128, 256, 512], use_checkpointing=False, modality_dropout=0.0,
+                 upsampling_method='conv_transpose'):
         super(unet_model_gelu_data_level_fusion,self).__init__()
+        self.use_checkpointing = use_checkpointing
+        self.upsampling_method = upsampling_method
+        self.in_channels_hsi = in_channels_hsi
+        self.modality_dropout = modality_dropout
         self.pool = nn.MaxPool2d(kernel_size=(2,2),stride=(2,2))
         self.conv1 = encoding_block_gelu(3+in_channels_hsi,features[0])
         self.conv2 = encoding_block_gelu(features[0],features[1])
@@ -544,40 +908,110 @@ class unet_model_gelu_data_level_fusion(nn.Module):
         self.conv6 = encoding_block_gelu(features[3],features[2])
         self.conv7 = encoding_block_gelu(features[2],features[1])
         self.conv8 = encoding_block_gelu(features[1],features[0])        
-        self.tconv1 = nn.ConvTranspose2d(features[-1]*2, features[-1], kernel_size=2, stride=2)
-        self.tconv2 = nn.ConvTranspose2d(features[-1], features[-2], kernel_size=2, stride=2)
-        self.tconv3 = nn.ConvTranspose2d(features[-2], features[-3], kernel_size=2, stride=2)
-        self.tconv4 = nn.ConvTranspose2d(features[-3], features[-4], kernel_size=2, stride=2)        
+        self.tconv1 = upsampling_layer(features[-1]*2, features[-1], upsampling_method)
+        self.tconv2 = upsampling_layer(features[-1], features[-2], upsampling_method)
+        self.tconv3 = upsampling_layer(features[-2], features[-3], upsampling_method)
+        self.tconv4 = upsampling_layer(features[-3], features[-4], upsampling_method)        
         self.bottleneck = encoding_block_gelu(features[3],features[3]*2)
         self.final_layer = nn.Conv2d(features[0],out_channels,kernel_size=1)
-    def forward(self,x_rgb, x_hsi):
-        x = torch.cat((x_rgb, x_hsi,), dim=1)
+    def forward(self,x_rgb, x_hsi=None):
         skip_connections = []
-        x = self.conv1(x)
+        if x_hsi is None:
+            #zero hsi channels add nothing to the first convolution, so only its rgb weights are used
+            x = checkpoint_stage(self.conv1.forward_leading_channels, x_rgb, enabled=self.use_checkpointing)
+        else:
+            keep_hsi = modality_dropout_mask(x_hsi, self.modality_dropout, self.training)
+            if keep_hsi is not None:
+                x_hsi = x_hsi * keep_hsi
+            x = torch.cat((x_rgb, x_hsi,), dim=1)
+            x = checkpoint_stage(self.conv1, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv2(x)
+        x = checkpoint_stage(self.conv2, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv3(x)
+        x = checkpoint_stage(self.conv3, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.conv4(x)
+        x = checkpoint_stage(self.conv4, x, enabled=self.use_checkpointing)
         skip_connections.append(x)
         x = self.pool(x)
-        x = self.bottleneck(x)
+        x = checkpoint_stage(self.bottleneck, x, enabled=self.use_checkpointing)
         skip_connections = skip_connections[::-1]
         x = self.tconv1(x)
         x = torch.cat((skip_connections[0], x), dim=1)
-        x = self.conv5(x)
+        x = checkpoint_stage(self.conv5, x, enabled=self.use_checkpointing)
         x = self.tconv2(x)
         x = torch.cat((skip_connections[1], x), dim=1)
-        x = self.conv6(x)
+        x = checkpoint_stage(self.conv6, x, enabled=self.use_checkpointing)
         x = self.tconv3(x)
         x = torch.cat((skip_connections[2], x), dim=1)
-        x = self.conv7(x)        
+        x = checkpoint_stage(self.conv7, x, enabled=self.use_checkpointing)        
         x = self.tconv4(x)
         x = torch.cat((skip_connections[3], x), dim=1)
-        x = self.conv8(x)
+        x = checkpoint_stage(self.conv8, x, enabled=self.use_checkpointing)
         x = self.final_layer(x)
         return x
+
+###############################################################
+############### Arbitrary Input Size ##########################
+###############################################################
+
+def required_input_multiple(model):
+    '''
+    Description: Spatial size the inputs of a model have to be divisible by, so that the skip connections match after the
+    pooling layers. 16 for the UNets with four pooling layers, 32 for UNetWithResnet50Encoder.
+    Input: Model
+    Output: Multiple (Int)
+    '''
+    if any(isinstance(module, UNetWithResnet50Encoder) for module in model.modules()):
+        return 32
+    return 16
+
+class pad_and_crop_model(nn.Module):
+    '''
+    Description: Wrapper that makes any UNet accept arbitrary input sizes (e.g. the native 672x320 HSI resolution or full camera
+    frames) without a resize pass. All inputs are reflect padded symmetrically to the next multiple of 16 (32 for
+    UNetWithResnet50Encoder) and the logits are cropped back to the input size, so they match the unresized mask pixel by pixel.
+    Inputs at a reduced resolution (HSI with hsi_scale 2 or 4) get the padding of the first input divided by their scale, so
+    they stay aligned with it. Inputs that are too small for reflect padding are padded by replicating the border.
+    '''
+    def __init__(self, model, multiple=None):
+        super(pad_and_crop_model, self).__init__()
+        self.model = model
+        self.multiple = multiple if multiple is not None else required_input_multiple(model)
+
+    def padding(self, height, width, alignment=1):
+        '''
+        Description: Padding (left, right, top, bottom) for an input size. With alignment > 1 every side is a multiple of
+        alignment, so inputs at 1/alignment of the resolution can be padded by the same amount divided by alignment.
+        '''
+        pad_h = -height % self.multiple
+        pad_w = -width % self.multiple
+        left = pad_w // 2 // alignment * alignment
+        top = pad_h // 2 // alignment * alignment
+        return (left, pad_w - left, top, pad_h - top)
+
+    def forward(self, *model_inputs):
+        height, width = model_inputs[0].shape[2:]
+        # inputs at a reduced resolution (e.g. x_hsi with hsi_scale of _WH_RGB_HSI_Dataset) are padded proportionally
+        scales = [height // x.shape[2] if x is not None else 1 for x in model_inputs]
+        for x, scale in zip(model_inputs, scales):
+            if x is not None and (x.shape[2] * scale != height or x.shape[3] * scale != width):
+                raise ValueError(f'Input size {tuple(x.shape[2:])} is not the size {(height, width)} of the first input divided by an integer')
+        left, right, top, bottom = self.padding(height, width, alignment=max(scales))
+        if left + right + top + bottom == 0:
+            return self.model(*model_inputs)
+
+        padded_inputs = []
+        for x, scale in zip(model_inputs, scales):
+            # optional inputs (x_hsi=None of the fusion models) are passed through
+            if x is None:
+                padded_inputs.append(None)
+                continue
+            padding = (left // scale, right // scale, top // scale, bottom // scale)
+            mode = 'reflect' if max(padding[:2]) < x.shape[3] and max(padding[2:]) < x.shape[2] else 'replicate'
+            padded_inputs.append(F.pad(x, padding, mode=mode))
+
+        logits = self.model(*padded_inputs)
+        return logits[:, :, top:top + height, left:left + width]
@@ -39,9 +39,12 @@ def capture_model_metrics_pixelwise_and_confusion_matrix_sf_postprocess_cv(model
     '''
     Description: Specifically for Post processing. Predicts Mask and Calculate the IoU and Dice Score of each image within a dataset for all data sources. Individually output 
     those scores for each individual class. 
-    Input: Model, Test Dataset, Data Source (String)
+    Input: Model, Test Dataset, Data Source (String, None to take the model inputs from the model registry)
     Ouput: Intersection List, Union List, Dice Num List, Dice Denom List
     '''
+    input_source = model if data_source is None else data_source
+    data_source = model_data_source(input_source)
+
     test_ds_union = [0,0,0,0,0,0,0,0,0,0]
     test_ds_intersection = [0,0,0,0,0,0,0,0,0,0]
     test_ds_numerator = [0,0,0,0,0,0,0,0,0,0]
@@ -61,32 +64,13 @@ def capture_model_metrics_pixelwise_and_confusion_matrix_sf_postprocess_cv(model
 
             rgb_img, hsi_img, mask = batch
 
-            # model prediction
-            if data_source=='rgb':
-                rgb_img = rgb_img.to(DEVICE).unsqueeze(0)
-                mask = mask.to(DEVICE)
-
-                softmax = nn.Softmax(dim=1)
-
-                preds = torch.argmax(softmax(model(rgb_img.float())),axis=1).to('cpu').squeeze(0)
-
-            if data_source=='hsi':
-                hsi_img = hsi_img.to(DEVICE).unsqueeze(0)
-                mask = mask.to(DEVICE)
-
-                softmax = nn.Softmax(dim=1)
-
-                preds = torch.argmax(softmax(model(hsi_img.float())),axis=1).to('cpu').squeeze(0)
-
-            elif data_source=='sf':
-
-                rgb_img = rgb_img.to(DEVICE).unsqueeze(0)
-                hsi_img = hsi_img.to(DEVICE).unsqueeze(0)
-                mask = mask.to(DEVICE)
+            # model prediction, only the inputs the model needs are put onto the device
+            model_inputs = select_model_inputs(rgb_img.unsqueeze(0), hsi_img.unsqueeze(0), input_source)
+            mask = mask.to(DEVICE)
 
-                softmax = nn.Softmax(dim=1)
+            softmax = nn.Softmax(dim=1)
 
-                preds = torch.argmax(softmax(model(rgb_img.float(), hsi_img)),axis=1).to('cpu').squeeze(0)
+            preds = torch.argmax(softmax(model(*model_inputs)),axis=1).to('cpu').squeeze(0)
 
             # get post processed mask
             preds_np = preds.squeeze(0).numpy().astype(np.uint8)
@@ -0,0 +1,80 @@
+import pytest
+import torch
+
+from TonyWang_MasterThesis.deployment import cpu_inference_model, export_onnx, export_torchscript, onnx_session, verify_exported_model
+from TonyWang_MasterThesis.models import unet_model_gelu, unet_model_gelu_feature_level_fusion
+
+
+def _test_inputs(*channels):
+    '''
+    Full frame, batch of two and a different spatial size, as in export_and_verify_model.
+    '''
+    return [tuple(torch.rand(batch_size, c, height, width) for c in channels)
+            for batch_size, height, width in [(1, 64, 96), (2, 64, 96), (1, 32, 64)]]
+
+
+def test_torchscript_export_accepts_other_sizes(tmp_path):
+    '''
+    The traced model has to be loadable without the model classes and give the output of the model for other batch and
+    spatial sizes than the example input.
+    '''
+    torch.manual_seed(0)
+    model = unet_model_gelu(out_channels=10, features=[4, 8, 16, 32]).eval()
+    test_inputs = _test_inputs(3)
+
+    export_torchscript(model, test_inputs[0], str(tmp_path / 'model.pt'))
+    loaded_model = torch.jit.load(str(tmp_path / 'model.pt'))
+
+    with torch.no_grad():
+        for model_inputs in test_inputs:
+            torch.testing.assert_close(loaded_model(*model_inputs), model(*model_inputs), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('model_fn, data_source, channels', [
+    (lambda: unet_model_gelu(out_channels=10, features=[4, 8, 16, 32]), 'rgb', (3,)),
+    (lambda: unet_model_gelu_feature_level_fusion(in_channels_hsi=6, out_channels=10, features=[4, 8, 16, 32]), 'sf', (3, 6)),
+])
+def test_onnx_export_has_dynamic_batch_and_spatial_size(model_fn, data_source, channels, tmp_path):
+    '''
+    The ONNX export has to match the model for other batch and spatial sizes than the example input (dynamic axes).
+    '''
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+    torch.manual_seed(0)
+    model = model_fn().eval()
+    test_inputs = _test_inputs(*channels)
+
+    traced_model = export_torchscript(model, test_inputs[0], str(tmp_path / 'model.pt'))
+    export_onnx(model, test_inputs[0], data_source, str(tmp_path / 'model.onnx'))
+    verified, errors = verify_exported_model(model, traced_model, onnx_session(str(tmp_path / 'model.onnx')), test_inputs,
+                                             data_source)
+
+    assert verified, errors
+
+
+class _PackedFeatureModel(torch.nn.Module):
+    '''
+    Takes an image and a flat feature vector (like the packed features of resnet50_cached_decoder).
+    '''
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(3, 4, 3, padding=1)
+        self.linear = torch.nn.Linear(8, 4)
+
+    def forward(self, x, packed_features):
+        return self.conv(x) + self.linear(packed_features)[:, :, None, None]
+
+
+@pytest.mark.parametrize('freeze', [False, True])
+def test_cpu_inference_model_accepts_inputs_that_are_not_4d(freeze):
+    '''
+    Channels last only applies to 4D tensors, flat inputs have to be passed through unchanged.
+    '''
+    torch.manual_seed(0)
+    model = _PackedFeatureModel().eval()
+    model_inputs = (torch.rand(2, 3, 16, 16), torch.rand(2, 8))
+
+    cpu_model = cpu_inference_model(model, model_inputs, channels_last=True, freeze=freeze)
+
+    with torch.no_grad():
+        torch.testing.assert_close(cpu_model(*model_inputs), model(*model_inputs), rtol=1e-4, atol=1e-5)
@@ -0,0 +1,65 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from TonyWang_MasterThesis.efficient_inference import cascade_model, fillet_detector, tiled_sparse_model
+from TonyWang_MasterThesis.models import unet_model_gelu
+
+
+@pytest.mark.parametrize('overlap', [-1, 64, 96])
+def test_tiled_model_rejects_invalid_overlap(overlap):
+    '''
+    The tile stride (tile size - overlap) has to be positive and the overlap must not be negative.
+    '''
+    with pytest.raises(ValueError):
+        tiled_sparse_model(nn.Conv2d(3, 10, 1), fillet_detector(), tile_size=64, overlap=overlap, out_channels=10)
+
+
+class _PixelFusionModel(nn.Module):
+    '''
+    Per pixel model of an RGB input and an HSI input at 1/hsi_scale of the resolution, so tiles give the same logits as the
+    full frame.
+    '''
+    def __init__(self, hsi_scale=2):
+        super().__init__()
+        self.rgb = nn.Conv2d(3, 10, 1)
+        self.hsi = nn.Conv2d(6, 10, 1)
+        self.hsi_scale = hsi_scale
+
+    def forward(self, x_rgb, x_hsi):
+        return self.rgb(x_rgb) + nn.functional.interpolate(self.hsi(x_hsi), scale_factor=self.hsi_scale, mode='nearest')
+
+
+@pytest.mark.parametrize('height, width', [(96, 160), (48, 64)])
+def test_tiled_model_equals_dense_model(height, width):
+    '''
+    With every pixel detected as fillet, cutting the (reduced resolution) inputs into overlapping tiles and blending the logits
+    back has to give the logits of the full frame.
+    '''
+    torch.manual_seed(0)
+    model = _PixelFusionModel().eval()
+    detector = fillet_detector(in_channels=3)
+    nn.init.zeros_(detector.classifier.weight)
+    nn.init.constant_(detector.classifier.bias, 10.0)
+    tiled_model = tiled_sparse_model(model, detector, tile_size=64, overlap=16, out_channels=10)
+    x_rgb, x_hsi = torch.rand(2, 3, height, width), torch.rand(2, 6, height // 2, width // 2)
+
+    with torch.no_grad():
+        torch.testing.assert_close(tiled_model(x_rgb, x_hsi), model(x_rgb, x_hsi), rtol=1e-5, atol=1e-5)
+    assert tiled_model.processed_rate == 1.0
+
+
+@pytest.mark.parametrize('tile_size', [None, 32])
+def test_cascade_with_threshold_zero_equals_fusion_model(tile_size):
+    '''
+    With threshold 0 every frame/tile is escalated, so the cascade has to give the logits of the fusion model.
+    '''
+    torch.manual_seed(0)
+    fusion_model = _PixelFusionModel(hsi_scale=1).eval()
+    cascade = cascade_model(unet_model_gelu(out_channels=10, features=[4, 8, 16, 32]), fusion_model, threshold=0.0,
+                            tile_size=tile_size).eval()
+    x_rgb, x_hsi = torch.rand(2, 3, 64, 96), torch.rand(2, 6, 64, 96)
+
+    with torch.no_grad():
+        torch.testing.assert_close(cascade(x_rgb, x_hsi), fusion_model(x_rgb, x_hsi))
+    assert cascade.escalation_rate == 1.0
@@ -0,0 +1,113 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from TonyWang_MasterThesis.model_compression import (load_quantized_model, prune_unet_channels, quantization_boundaries,
+                                                     quantize_model_static, save_quantized_model)
+from TonyWang_MasterThesis.models import (unet_model_classic, unet_model_gelu, hsi_unet_model_gelu,
+                                          unet_model_gelu_data_level_fusion, unet_model_gelu_feature_level_fusion)
+
+FEATURES = [8, 16, 32, 64]
+
+PRUNABLE_MODELS = [
+    (lambda: unet_model_classic(out_channels=10, features=FEATURES), (3,)),
+    (lambda: unet_model_gelu(out_channels=10, features=FEATURES), (3,)),
+    (lambda: hsi_unet_model_gelu(in_channels=10, out_channels=10, features=FEATURES), (45,)),
+    (lambda: unet_model_gelu_data_level_fusion(in_channels_hsi=6, out_channels=10, features=FEATURES), (3, 6)),
+    (lambda: unet_model_gelu_feature_level_fusion(in_channels_hsi=6, out_channels=10, features=FEATURES), (3, 6)),
+]
+
+
+def _trained_model(model_fn):
+    '''
+    Model with random BatchNorm parameters and statistics, so the channel ranking is not uniform.
+    '''
+    torch.manual_seed(0)
+    model = model_fn()
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            nn.init.uniform_(m.weight, 0.5, 1.5)
+            nn.init.uniform_(m.bias, -0.5, 0.5)
+            nn.init.uniform_(m.running_mean, -0.5, 0.5)
+            nn.init.uniform_(m.running_var, 0.5, 1.5)
+    return model.eval()
+
+
+@pytest.mark.parametrize('model_fn, in_channels', PRUNABLE_MODELS)
+def test_pruning_without_removed_channels_keeps_output(model_fn, in_channels):
+    '''
+    With keep_ratio 1.0 every channel is kept, so the pruned model has to give the output of the original model.
+    '''
+    model = _trained_model(model_fn)
+    inputs = [torch.rand(2, c, 32, 32) for c in in_channels]
+
+    pruned_model = prune_unet_channels(model, keep_ratio=1.0).eval()
+
+    with torch.no_grad():
+        torch.testing.assert_close(pruned_model(*inputs), model(*inputs))
+
+
+@pytest.mark.parametrize('model_fn, in_channels', PRUNABLE_MODELS)
+def test_pruned_model_runs(model_fn, in_channels):
+    '''
+    With keep_ratio 0.5 the pruned model has half the channels of each level and has to accept the inputs of the original model.
+    '''
+    model = _trained_model(model_fn)
+    inputs = [torch.rand(2, c, 32, 32) for c in in_channels]
+
+    pruned_model = prune_unet_channels(model, keep_ratio=0.5).eval()
+
+    with torch.no_grad():
+        output = pruned_model(*inputs)
+    assert output.shape == (2, 10, 32, 32)
+    assert sum(p.numel() for p in pruned_model.parameters()) < sum(p.numel() for p in model.parameters())
+
+
+class _CalibrationDataset(torch.utils.data.Dataset):
+    def __init__(self, n=4, size=32):
+        torch.manual_seed(0)
+        self.samples = [(torch.rand(3, size, size), torch.rand(6, size, size), torch.zeros(size, size, dtype=torch.long))
+                        for _ in range(n)]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        return self.samples[idx]
+
+
+def test_quantization_restores_the_global_backend(tmp_path, monkeypatch):
+    '''
+    Quantizing and loading a model must not change the global quantization backend, and the quantized model has to run with
+    another global backend.
+    '''
+    previous_backend = torch.backends.quantized.engine
+    model = _trained_model(lambda: unet_model_classic(out_channels=10, features=FEATURES))
+    dataset = _CalibrationDataset()
+
+    quantized_model = quantize_model_static(model, dataset, 'rgb', num_calibration_images=4, batch_size=2, backend='fbgemm')
+    save_quantized_model(quantized_model, dataset, 'rgb', str(tmp_path / 'int8.pt'))
+    loaded_model = load_quantized_model(str(tmp_path / 'int8.pt'), backend='fbgemm')
+    assert torch.backends.quantized.engine == previous_backend
+
+    monkeypatch.setattr(torch.backends.quantized, 'engine', 'qnnpack')
+    x = dataset[0][0].unsqueeze(0)
+    with torch.no_grad():
+        output = model(x)
+        torch.testing.assert_close(quantized_model(x), output, rtol=0, atol=0.2)
+        torch.testing.assert_close(loaded_model(x), output, rtol=0, atol=0.2)
+
+
+def test_gelu_layers_stay_in_float_after_quantization():
+    '''
+    The ReLU UNet is quantized end to end (one quantize and one dequantize), the GELU UNet leaves every GELU in float.
+    '''
+    dataset = _CalibrationDataset()
+    n_boundaries = {}
+    for model_fn in (unet_model_classic, unet_model_gelu):
+        model = _trained_model(lambda: model_fn(out_channels=10, features=FEATURES))
+        n_boundaries[model_fn] = quantization_boundaries(quantize_model_static(model, dataset, 'rgb', num_calibration_images=4,
+                                                                               batch_size=2))
+
+    assert n_boundaries[unet_model_classic] == 2
+    assert n_boundaries[unet_model_gelu] > 2
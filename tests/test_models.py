@@ -0,0 +1,147 @@
+import copy
+
+import pytest
+import torch
+import torch.nn as nn
+
+from TonyWang_MasterThesis.models import (unet_model_classic, unet_model_gelu, hsi_unet_model_gelu, pad_and_crop_model,
+                                          unet_model_gelu_data_level_fusion, unet_model_gelu_feature_level_fusion)
+
+
+def _batchnorm_stats(model):
+    return {name: (m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone())
+            for name, m in model.named_modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)}
+
+
+@pytest.mark.parametrize('model_fn, in_channels', [
+    (lambda: unet_model_classic(out_channels=10), 3),
+    (lambda: unet_model_gelu(out_channels=10), 3),
+    (lambda: hsi_unet_model_gelu(in_channels=10, out_channels=10), 45),
+])
+def test_checkpointing_keeps_batchnorm_stats(model_fn, in_channels):
+    '''
+    Activation checkpointing must update the BatchNorm running statistics once per step like the model without it.
+    '''
+    torch.manual_seed(0)
+    model = model_fn()
+    checkpointed_model = copy.deepcopy(model)
+    checkpointed_model.use_checkpointing = True
+    x = torch.rand(2, in_channels, 32, 32)
+
+    for m in (model, checkpointed_model):
+        m.train()
+        torch.manual_seed(1)
+        m(x).sum().backward()
+
+    stats = _batchnorm_stats(model)
+    checkpointed_stats = _batchnorm_stats(checkpointed_model)
+    assert stats
+    for name, (running_mean, running_var, num_batches_tracked) in stats.items():
+        assert checkpointed_stats[name][2].item() == num_batches_tracked.item() == 1
+        torch.testing.assert_close(checkpointed_stats[name][0], running_mean)
+        torch.testing.assert_close(checkpointed_stats[name][1], running_var)
+
+
+@pytest.mark.parametrize('use_checkpointing', [False, True])
+def test_data_level_fusion_without_hsi_equals_zero_hsi(use_checkpointing):
+    '''
+    x_hsi=None skips the HSI channels but has to give the same output as zero HSI channels.
+    '''
+    torch.manual_seed(0)
+    model = unet_model_gelu_data_level_fusion(in_channels_hsi=45, out_channels=10, use_checkpointing=use_checkpointing).eval()
+    x_rgb = torch.rand(2, 3, 32, 32)
+
+    with torch.no_grad():
+        output = model(x_rgb, None)
+        zero_hsi_output = model(x_rgb, torch.zeros(2, 45, 32, 32))
+
+    torch.testing.assert_close(output, zero_hsi_output, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('fusion_mode, hsi_scale, use_checkpointing', [
+    ('concat', 1, False), ('concat', 1, True), ('concat', 2, False), ('conv1x1', 1, False), ('conv1x1', 2, True),
+    ('gated', 1, False), ('gated', 4, False),
+])
+def test_feature_level_fusion_without_hsi_equals_zero_hsi_features(fusion_mode, hsi_scale, use_checkpointing):
+    '''
+    x_hsi=None skips the HSI branch and the HSI weights of the decoder but has to give the same output as zero HSI features
+    (modality dropout of every sample).
+    '''
+    torch.manual_seed(0)
+    model = unet_model_gelu_feature_level_fusion(in_channels_hsi=6, out_channels=10, features=[4, 8, 16, 32],
+                                                 use_checkpointing=use_checkpointing, fusion_mode=fusion_mode,
+                                                 hsi_scale=hsi_scale).eval()
+    x_rgb = torch.rand(2, 3, 32, 32)
+    x_hsi = torch.rand(2, 6, 32 // hsi_scale, 32 // hsi_scale)
+
+    with torch.no_grad():
+        output = model(x_rgb, None)
+        # modality dropout only depends on the training flag of the model itself, the layers stay in eval mode
+        model.modality_dropout = 1.0
+        model.training = True
+        zero_hsi_output = model(x_rgb, x_hsi)
+
+    torch.testing.assert_close(output, zero_hsi_output, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('hsi_input_full_resolution', [False, True])
+def test_reduced_resolution_hsi_branch_can_be_traced(hsi_input_full_resolution):
+    '''
+    With hsi_scale 2 the model has to be traceable (torch.fx for quantization, torch.jit.trace for the export) and the traced
+    model has to give the eager output for an input size other than the example input.
+    '''
+    torch.manual_seed(0)
+    model = unet_model_gelu_feature_level_fusion(in_channels_hsi=6, out_channels=10, features=[4, 8, 16, 32], hsi_scale=2,
+                                                 hsi_input_full_resolution=hsi_input_full_resolution).eval()
+    hsi_size = 1 if hsi_input_full_resolution else 2
+
+    def inputs(size):
+        return torch.rand(2, 3, size, size), torch.rand(2, 6, size // hsi_size, size // hsi_size)
+
+    with torch.no_grad():
+        fx_model = torch.fx.symbolic_trace(model)
+        traced_model = torch.jit.trace(model, inputs(32))
+        x_rgb, x_hsi = inputs(64)
+        output = model(x_rgb, x_hsi)
+        torch.testing.assert_close(fx_model(x_rgb, x_hsi), output)
+        torch.testing.assert_close(traced_model(x_rgb, x_hsi), output)
+
+
+@pytest.mark.parametrize('model_fn, channels, hsi_size', [
+    (lambda: unet_model_classic(out_channels=10, features=[4, 8, 16, 32]), (3,), None),
+    (lambda: unet_model_gelu(out_channels=10, features=[4, 8, 16, 32]), (3,), None),
+    (lambda: unet_model_gelu_data_level_fusion(in_channels_hsi=6, out_channels=10, features=[4, 8, 16, 32]), (3, 6), 1),
+    (lambda: unet_model_gelu_feature_level_fusion(in_channels_hsi=6, out_channels=10, features=[4, 8, 16, 32], hsi_scale=2),
+     (3, 6), 2),
+])
+def test_pad_and_crop_keeps_the_input_size(model_fn, channels, hsi_size):
+    '''
+    For sizes that are not a multiple of 16 the wrapped model has to give logits of the input size (reduced resolution HSI
+    inputs are padded proportionally).
+    '''
+    torch.manual_seed(0)
+    model = pad_and_crop_model(model_fn()).eval()
+    height, width = 70, 42
+    model_inputs = [torch.rand(2, channels[0], height, width)]
+    if hsi_size is not None:
+        model_inputs.append(torch.rand(2, channels[1], height // hsi_size, width // hsi_size))
+
+    with torch.no_grad():
+        assert model(*model_inputs).shape == (2, 10, height, width)
+
+
+@pytest.mark.parametrize('hsi_scale', [1, 2])
+@pytest.mark.parametrize('fusion_mode', ['concat', 'conv1x1', 'gated'])
+def test_feature_level_fusion_modes_run_forward(fusion_mode, hsi_scale):
+    '''
+    Every skip fusion mode has to give logits of the input size, also with reduced resolution HSI (levels without HSI skip).
+    '''
+    torch.manual_seed(0)
+    model = unet_model_gelu_feature_level_fusion(in_channels_hsi=6, out_channels=10, features=[4, 8, 16, 32],
+                                                 fusion_mode=fusion_mode, hsi_scale=hsi_scale).eval()
+    x_rgb, x_hsi = torch.rand(2, 3, 64, 64), torch.rand(2, 6, 64 // hsi_scale, 64 // hsi_scale)
+
+    with torch.no_grad():
+        output = model(x_rgb, x_hsi)
+    assert output.shape == (2, 10, 64, 64)
+    assert torch.isfinite(output).all()
@@ -0,0 +1,429 @@
+import json
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+from torch.utils.data import Dataset
+
+from TonyWang_MasterThesis.functions_and_constants import (AsyncCheckpointWriter, DiceLoss, DistillationLoss,
+                                                           TrainingCallback, TrainingEntry, atomic_torch_save,
+                                                           cache_encoder_features, create_data_loader, seed_everything,
+                                                           seed_transforms, select_model_inputs, sf_no_transformation,
+                                                           sf_transformation, train_model, train_models,
+                                                           update_confusion_matrix, _ResNet50_Feature_Cache_Dataset,
+                                                           _WH_RGB_HSI_Dataset_Wrapper)
+from TonyWang_MasterThesis.distributed_training import ShardSampler
+from TonyWang_MasterThesis.models import UNetWithResnet50Encoder, model_input_spec, resnet50_cached_decoder, unet_model_gelu
+from TonyWang_MasterThesis.visualisation_and_evaluation import load_training_metrics, _class_loop_dice_loss
+
+
+class _InMemoryDataset(Dataset):
+    def __init__(self, n=4, size=240, hsi_channels=6):
+        rng = np.random.default_rng(0)
+        self.samples = [(rng.random((size, size, 3)), rng.random((size, size, hsi_channels)).astype(np.float32),
+                         rng.integers(0, 10, (size, size)).astype(np.int64)) for _ in range(n)]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        return self.samples[idx]
+
+
+class _Interrupt(TrainingCallback):
+    def on_epoch_end(self, state):
+        if state['epoch'] == 1:
+            raise KeyboardInterrupt
+
+
+def _run(num_workers, resume_from=None, callbacks=None, seed=0):
+    seed_everything(seed)
+    model = unet_model_gelu(out_channels=10, features=[4, 8, 16, 32])
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    train_dataset = _WH_RGB_HSI_Dataset_Wrapper(_InMemoryDataset(), sf_transformation)
+    seed_transforms(train_dataset, seed)
+    train_loader = create_data_loader(train_dataset, 2, shuffle=True, num_workers=num_workers, persistent_workers=False)
+    val_loader = torch.utils.data.DataLoader(_WH_RGB_HSI_Dataset_Wrapper(_InMemoryDataset(2, 64), sf_no_transformation),
+                                             batch_size=2)
+    _, _, train_losses, val_losses = train_model(model, train_loader, val_loader, 3, nn.CrossEntropyLoss(), optimizer,
+                                                 data_source='rgb', model_name='resume', save_last=True,
+                                                 resume_from=resume_from, callbacks=callbacks)
+    return model, train_losses, val_losses
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_resume_with_augmentation_is_exact(num_workers, tmp_path, monkeypatch):
+    '''
+    A training resumed from a save_last checkpoint has to continue with the same augmentations (sf_transformation), data
+    order and random numbers as the uninterrupted training.
+    '''
+    monkeypatch.chdir(tmp_path)
+    model, train_losses, val_losses = _run(num_workers)
+
+    with pytest.raises(KeyboardInterrupt):
+        _run(num_workers, callbacks=[_Interrupt()])
+    # different initial weights and RNG states, everything has to come from the checkpoint
+    resumed_model, resumed_train_losses, resumed_val_losses = _run(num_workers, resume_from='last_checkpoint_resume.pt', seed=1)
+
+    assert resumed_train_losses == train_losses
+    assert resumed_val_losses == val_losses
+    for name, value in model.state_dict().items():
+        assert torch.equal(resumed_model.state_dict()[name], value), name
+
+
+class _TeacherLogitsDataset(Dataset):
+    '''
+    Adds fixed teacher logits as fourth element, like _WH_RGB_HSI_Distillation_Dataset.
+    '''
+    def __init__(self, dataset):
+        torch.manual_seed(1)
+        self.dataset = dataset
+        self.teacher_logits = [torch.randn(10, *mask.shape) for _, _, mask in dataset]
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return (*self.dataset[idx], self.teacher_logits[idx])
+
+
+def _pixel_classifier(in_channels=3):
+    torch.manual_seed(0)
+    # per pixel classifier without BatchNorm and Dropout, so the batch composition does not change the gradients
+    model = nn.Conv2d(in_channels, 10, kernel_size=1)
+    return model, torch.optim.SGD(model.parameters(), lr=0.5)
+
+
+def _pixel_classifier_loaders(batch_size, teacher_logits=False):
+    train_dataset = _WH_RGB_HSI_Dataset_Wrapper(_InMemoryDataset(6, 32), sf_no_transformation)
+    if teacher_logits:
+        train_dataset = _TeacherLogitsDataset(train_dataset)
+    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=False)
+    val_loader = torch.utils.data.DataLoader(_WH_RGB_HSI_Dataset_Wrapper(_InMemoryDataset(2, 32), sf_no_transformation),
+                                             batch_size=2)
+    return train_loader, val_loader
+
+
+def _train_pixel_classifier(batch_size, accumulation_steps=1, num_epochs=2, teacher_logits=False, **kwargs):
+    model, optimizer = _pixel_classifier()
+    train_loader, val_loader = _pixel_classifier_loaders(batch_size, teacher_logits)
+    kwargs.setdefault('async_checkpoints', False)
+    return train_model(model, train_loader, val_loader, num_epochs, nn.CrossEntropyLoss(), optimizer, data_source='rgb',
+                       model_name='pixel_classifier', accumulation_steps=accumulation_steps, **kwargs)
+
+
+def test_gradient_accumulation_equals_large_batches(tmp_path, monkeypatch):
+    '''
+    Batches of 2 with 2 accumulation steps have to give the weights of batches of 4. With 3 batches per epoch the last window
+    only has one batch, which has to be weighted like the last (smaller) batch of the large batch run.
+    '''
+    monkeypatch.chdir(tmp_path)
+    large_batch_model = _train_pixel_classifier(batch_size=4, accumulation_steps=1)[0]
+    accumulated_model = _train_pixel_classifier(batch_size=2, accumulation_steps=2)[0]
+
+    for name, value in large_batch_model.state_dict().items():
+        torch.testing.assert_close(accumulated_model.state_dict()[name], value, rtol=1e-5, atol=1e-6)
+
+
+
+def test_distillation_without_weight_equals_hard_label_training(tmp_path, monkeypatch):
+    '''
+    With alpha=0 the distillation loss must not change the training on the hard labels.
+    '''
+    monkeypatch.chdir(tmp_path)
+    model, _, train_losses, val_losses = _train_pixel_classifier(batch_size=2)
+    distilled_model, _, distilled_train_losses, distilled_val_losses = _train_pixel_classifier(
+        batch_size=2, teacher_logits=True, distillation_loss_fn=DistillationLoss(alpha=0.0))
+
+    assert distilled_train_losses == train_losses
+    assert distilled_val_losses == val_losses
+    for name, value in model.state_dict().items():
+        assert torch.equal(distilled_model.state_dict()[name], value), name
+
+
+def test_train_models_applies_the_distillation_loss_of_each_entry(tmp_path, monkeypatch):
+    '''
+    A TrainingEntry with a distillation loss has to train like train_model with that distillation loss, the other entry like
+    train_model without it.
+    '''
+    monkeypatch.chdir(tmp_path)
+    distillation_loss_fn = DistillationLoss(temperature=2.0, alpha=0.5)
+    distilled_model = _train_pixel_classifier(batch_size=2, teacher_logits=True, distillation_loss_fn=distillation_loss_fn)[0]
+    model = _train_pixel_classifier(batch_size=2, teacher_logits=True)[0]
+
+    entries = []
+    for name, loss_fn in [('distilled', distillation_loss_fn), ('hard_labels', None)]:
+        entry_model, optimizer = _pixel_classifier()
+        entries.append(TrainingEntry(entry_model, nn.CrossEntropyLoss(), optimizer, data_source='rgb', model_name=name,
+                                     distillation_loss_fn=loss_fn))
+    results = train_models(entries, *_pixel_classifier_loaders(2, teacher_logits=True), 2, async_checkpoints=False)
+
+    for (trained_model, *_), expected_model in zip(results, [distilled_model, model]):
+        for name, value in expected_model.state_dict().items():
+            torch.testing.assert_close(trained_model.state_dict()[name], value)
+
+
+
+class _BatchLosses(TrainingCallback):
+    def __init__(self):
+        self.losses = []
+
+    def on_epoch_begin(self, state):
+        self.losses.append([])
+
+    def on_batch_end(self, state):
+        self.losses[-1].append(state['loss'].item())
+
+
+def test_device_side_loss_accumulation_equals_batch_loss_average(tmp_path, monkeypatch):
+    '''
+    The training losses summed on the device have to give the average of the per batch losses of every epoch, also if the
+    progress bar is only synchronized once per epoch.
+    '''
+    monkeypatch.chdir(tmp_path)
+    batch_losses = _BatchLosses()
+    _, _, train_losses, _ = _train_pixel_classifier(batch_size=2, num_epochs=3, callbacks=[batch_losses], sync_every_n_steps=100)
+
+    assert train_losses == pytest.approx([sum(losses) / len(losses) for losses in batch_losses.losses], rel=1e-6)
+
+
+
+def test_metrics_log_has_run_step_and_epoch_records(tmp_path, monkeypatch):
+    '''
+    metrics_path has to append a run record, a step record every log_every_n_steps steps (3 steps per epoch) and an epoch
+    record with the losses of train_model, which load_training_metrics reads back.
+    '''
+    monkeypatch.chdir(tmp_path)
+    _, _, train_losses, val_losses = _train_pixel_classifier(batch_size=2, metrics_path='metrics.jsonl', log_every_n_steps=2)
+
+    with open(tmp_path / 'metrics.jsonl') as f:
+        records = [json.loads(line) for line in f]
+    assert [record['type'] for record in records] == ['run', 'step', 'epoch', 'step', 'step', 'epoch']
+    metrics = load_training_metrics(str(tmp_path / 'metrics.jsonl'))
+    assert [record['step'] for record in metrics['step']] == [2, 4, 6]
+    assert [record['train_loss'] for record in metrics['epoch']] == train_losses
+    assert [record['val_loss'] for record in metrics['epoch']] == val_losses
+    for record in metrics['epoch']:
+        assert {'lr', 'throughput', 'data_wait_time', 'defect_iou'} <= record.keys()
+
+
+
+def test_train_models_equals_separate_trainings(tmp_path, monkeypatch):
+    '''
+    Training an RGB and an HSI model in one pass over the data has to give the weights and losses of two train_model runs.
+    '''
+    monkeypatch.chdir(tmp_path)
+    expected, entries = [], []
+    for data_source, in_channels in [('rgb', 3), ('hsi', 6)]:
+        model, optimizer = _pixel_classifier(in_channels)
+        expected.append(train_model(model, *_pixel_classifier_loaders(2), 2, nn.CrossEntropyLoss(), optimizer,
+                                    data_source=data_source, model_name=data_source, async_checkpoints=False))
+        model, optimizer = _pixel_classifier(in_channels)
+        entries.append(TrainingEntry(model, nn.CrossEntropyLoss(), optimizer, data_source=data_source, model_name=data_source))
+
+    results = train_models(entries, *_pixel_classifier_loaders(2), 2, async_checkpoints=False)
+
+    for (model, _, train_losses, val_losses), (expected_model, _, expected_train_losses, expected_val_losses) in zip(
+            results, expected):
+        assert train_losses == expected_train_losses
+        assert val_losses == expected_val_losses
+        for name, value in expected_model.state_dict().items():
+            assert torch.equal(model.state_dict()[name], value), name
+
+
+def test_atomic_save_keeps_the_old_checkpoint_if_saving_fails(tmp_path, monkeypatch):
+    '''
+    A failed save must neither truncate the existing checkpoint nor leave a file behind, a successful save replaces it.
+    '''
+    path = tmp_path / 'checkpoint.pt'
+    atomic_torch_save({'epoch': 1}, path)
+    torch_save = torch.save
+
+    def interrupted_save(obj, f):
+        with open(f, 'wb') as file:
+            file.write(b'truncated')
+        raise OSError('disk full')
+
+    monkeypatch.setattr(torch, 'save', interrupted_save)
+    with pytest.raises(OSError):
+        atomic_torch_save({'epoch': 2}, path)
+    assert torch.load(path)['epoch'] == 1
+    assert [p.name for p in tmp_path.iterdir()] == ['checkpoint.pt']
+
+    monkeypatch.setattr(torch, 'save', torch_save)
+    atomic_torch_save({'epoch': 3}, path)
+    assert torch.load(path)['epoch'] == 3
+    assert [p.name for p in tmp_path.iterdir()] == ['checkpoint.pt']
+
+
+@pytest.mark.parametrize('async_checkpoints', [False, True])
+def test_top_k_checkpoints_keep_the_best_epochs(async_checkpoints, tmp_path, monkeypatch):
+    '''
+    Only the checkpoints of the k epochs with the lowest validation loss are kept.
+    '''
+    monkeypatch.chdir(tmp_path)
+    _, _, _, val_losses = _train_pixel_classifier(batch_size=2, num_epochs=5, keep_top_k=2, async_checkpoints=async_checkpoints)
+
+    best_epochs = sorted(np.argsort(val_losses)[:2])
+    kept_epochs = sorted(int(p.name.split('_')[1][1:]) for p in tmp_path.glob('checkpoint_e*.pt'))
+    assert kept_epochs == best_epochs
+
+
+def test_failed_async_save_keeps_the_displaced_checkpoint(tmp_path):
+    '''
+    Deletions queued after a failed save are dropped and the first error is raised.
+    '''
+    good_path = tmp_path / 'good.pt'
+    atomic_torch_save({'epoch': 1}, good_path)
+
+    writer = AsyncCheckpointWriter()
+    writer.save({'epoch': 2}, str(tmp_path / 'missing_first' / 'new.pt'))
+    writer.delete(str(good_path))
+    writer.save({'epoch': 3}, str(tmp_path / 'missing_second' / 'new.pt'))
+    with pytest.raises(Exception, match='missing_first'):
+        writer.wait()
+    writer.delete(str(good_path))
+    writer.close()
+
+    assert torch.load(good_path)['epoch'] == 1
+
+
+
+def test_compiled_training_equals_eager_training(tmp_path, monkeypatch):
+    '''
+    compile_model only changes how the forward pass runs, the trained weights and losses have to match the eager training.
+    '''
+    monkeypatch.chdir(tmp_path)
+    eager_model, _, eager_train_losses, eager_val_losses = _train_pixel_classifier(batch_size=2)
+    compiled_model, _, compiled_train_losses, compiled_val_losses = _train_pixel_classifier(batch_size=2, compile_model=True)
+
+    assert compiled_train_losses == pytest.approx(eager_train_losses, rel=1e-5)
+    assert compiled_val_losses == pytest.approx(eager_val_losses, rel=1e-5)
+    for name, value in eager_model.state_dict().items():
+        torch.testing.assert_close(compiled_model.state_dict()[name], value, rtol=1e-5, atol=1e-6)
+
+
+def test_profiler_writes_a_trace_of_the_training_steps(tmp_path, monkeypatch):
+    '''
+    profile_path has to write a Chrome trace of the recorded steps (steps 7 to 11 with 3 steps per epoch).
+    '''
+    monkeypatch.chdir(tmp_path)
+    _train_pixel_classifier(batch_size=2, num_epochs=4, profile_path='trace.json')
+
+    with open(tmp_path / 'trace.json') as f:
+        trace = json.load(f)
+    assert any(event.get('name') == 'ProfilerStep#7' for event in trace['traceEvents'])
+
+
+
+class _NamedImageDataset(Dataset):
+    '''
+    Un-augmented images with file names, like _WH_RGB_HSI_Dataset with sf_no_transformation.
+    '''
+    def __init__(self, n=2, size=64):
+        torch.manual_seed(0)
+        self.rgb_images = [f'image_{i}.png' for i in range(n)]
+        self.samples = [(torch.rand(3, size, size), torch.zeros(0), torch.randint(0, 10, (size, size))) for _ in range(n)]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        return self.samples[idx]
+
+
+def test_cached_features_give_the_output_of_the_full_model(tmp_path, monkeypatch):
+    '''
+    The cached decoder has to give the output of UNetWithResnet50Encoder on the cached (float16) features. A second run over
+    the cached dataset reads the shapes from feature_shapes.json and must not run the encoder.
+    '''
+    torch.manual_seed(0)
+    model = UNetWithResnet50Encoder(n_classes=10, freeze_encoder=True).eval()
+    dataset = _NamedImageDataset()
+
+    feature_shapes = cache_encoder_features(model, dataset, str(tmp_path))
+    cache = _ResNet50_Feature_Cache_Dataset(str(tmp_path))
+    decoder = resnet50_cached_decoder(model, cache.feature_shapes).eval()
+
+    with torch.no_grad():
+        for (rgb_img, _, mask), (packed_features, _, cached_mask) in zip(dataset, cache):
+            torch.testing.assert_close(decoder(packed_features.float().unsqueeze(0)), model(rgb_img.unsqueeze(0)),
+                                       rtol=1e-2, atol=1e-2)
+            assert torch.equal(cached_mask, mask)
+
+    def encode(x):
+        raise AssertionError('cached images were encoded again')
+    monkeypatch.setattr(model, 'encode', encode)
+    assert cache_encoder_features(model, dataset, str(tmp_path)) == feature_shapes
+
+
+def test_cached_decoder_trains_on_the_features_source(tmp_path, monkeypatch):
+    '''
+    The cached decoder reads its input from the 'features' source of the cache batches, so train_model needs no data source.
+    '''
+    monkeypatch.chdir(tmp_path)
+    torch.manual_seed(0)
+    model = UNetWithResnet50Encoder(n_classes=10, freeze_encoder=True)
+    cache_encoder_features(model, _NamedImageDataset(), str(tmp_path / 'cache'))
+    cache = _ResNet50_Feature_Cache_Dataset(str(tmp_path / 'cache'))
+    decoder = resnet50_cached_decoder(model, cache.feature_shapes)
+    loader = torch.utils.data.DataLoader(cache, batch_size=2)
+
+    packed_features, hsi_img, _ = next(iter(loader))
+    assert [model_input.source for model_input in model_input_spec(decoder)] == ['features']
+    assert torch.equal(select_model_inputs(packed_features, hsi_img, decoder, device='cpu')[0], packed_features.float())
+
+    optimizer = torch.optim.Adam([p for p in decoder.parameters() if p.requires_grad], lr=1e-3)
+    _, _, train_losses, val_losses = train_model(decoder, loader, loader, 1, nn.CrossEntropyLoss(), optimizer,
+                                                 model_name='cached_decoder', async_checkpoints=False)
+    assert len(train_losses) == len(val_losses) == 1
+
+
+
+def test_vectorised_dice_loss_equals_class_loop():
+    '''
+    The vectorised DiceLoss has to give the loss and gradients of the per class loop, also with ignore labels (255).
+    '''
+    torch.manual_seed(0)
+    dice_loss_fn = DiceLoss(10)
+    logits = torch.randn(2, 10, 16, 16, requires_grad=True)
+    target = torch.randint(0, 10, (2, 16, 16))
+    target[:, :2] = 255
+
+    loop_loss = _class_loop_dice_loss(dice_loss_fn, logits, target)
+    loop_grad, = torch.autograd.grad(loop_loss, logits)
+    loss, class_dice = dice_loss_fn(logits, target, return_class_wise=True)
+    grad, = torch.autograd.grad(loss, logits)
+
+    torch.testing.assert_close(loss, loop_loss)
+    torch.testing.assert_close(grad, loop_grad)
+    assert class_dice.shape == (10,)
+    torch.testing.assert_close((1.0 - class_dice).mean(), loop_loss.detach())
+
+
+def test_confusion_matrix_ignores_out_of_range_labels():
+    '''
+    Ignore (255) and negative labels must not be counted and must not break the validation confusion matrix.
+    '''
+    predictions = torch.zeros(1, 10, 2, 2)
+    predictions[:, 3] = 1.0
+    mask = torch.tensor([[[3, 255], [-1, 0]]])
+
+    confusion = update_confusion_matrix(torch.zeros(10, 10, dtype=torch.long), predictions, mask)
+
+    expected = torch.zeros(10, 10, dtype=torch.long)
+    expected[3, 3] = 1
+    expected[0, 3] = 1
+    assert torch.equal(confusion, expected)
+
+
+@pytest.mark.parametrize('n_samples', [4, 5])
+def test_validation_shards_cover_every_sample_once(n_samples):
+    '''
+    The validation shards of all processes together have to contain every sample exactly once (no padding).
+    '''
+    shards = [list(ShardSampler(range(n_samples), rank=rank, num_replicas=2)) for rank in range(2)]
+
+    assert sorted(shards[0] + shards[1]) == list(range(n_samples))
+    assert [len(ShardSampler(range(n_samples), rank=rank, num_replicas=2)) for rank in range(2)] == [len(shard) for shard in shards]
@@ -6,6 +6,7 @@ import cv2
 from matplotlib.colors import ListedColormap, BoundaryNorm
 from datetime import datetime
 import time
+import json
 
 #augmentation
 from albumentations.pytorch import ToTensorV2
@@ -230,6 +231,59 @@ def plot_confusion_matrix(gt_flat, pred_flat, label_array):
     '''
     conf=ConfusionMatrixDisplay.from_predictions(gt_flat, pred_flat, display_labels=label_array)
 
+def load_training_metrics(metrics_path):
+    '''
+    Description: Reads the metrics log of a training (MetricsLogger, metrics_path of train_model). Epochs which were logged
+    twice, because a training was resumed from an earlier checkpoint, keep their last record.
+    Input: Metrics Log (JSONL File Path)
+    Output: Dictionary with the 'run', 'step' and 'epoch' records (Lists of Dictionaries)
+    '''
+    records = {'run': [], 'step': [], 'epoch': []}
+    with open(metrics_path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                records[record['type']].append(record)
+
+    records['epoch'] = sorted({record['epoch']: record for record in records['epoch']}.values(), key=lambda record: record['epoch'])
+    records['step'] = sorted({record['step']: record for record in records['step']}.values(), key=lambda record: record['step'])
+    return records
+
+def plot_training_metrics(metrics_path, keys=('train_loss', 'val_loss', 'defect_iou', 'lr', 'throughput', 'data_wait_time'),
+                          save_path=None):
+    '''
+    Description: Offline plot of the metrics log of a training, one subplot per epoch scalar and the training loss of the
+    logged steps. Can be run during the training (e.g. on another machine) or afterwards, the training itself does not render
+    anything. With save_path the figure is saved instead of shown, e.g. for batch jobs without a display.
+    Input: Metrics Log (JSONL File Path), Epoch Scalars to plot, File Path of the Figure (None to show it)
+    '''
+    records = load_training_metrics(metrics_path)
+    epochs = [record['epoch'] for record in records['epoch']]
+
+    n_plots = len(keys) + (1 if records['step'] else 0)
+    fig, axs = plt.subplots(n_plots, 1, figsize=(9, 3*n_plots), sharex=False, squeeze=False)
+    axs = axs[:, 0]
+
+    for ax, key in zip(axs, keys):
+        ax.plot(epochs, [record.get(key) for record in records['epoch']], marker='o', linestyle='-')
+        ax.set_xlabel('Epochs')
+        ax.set_ylabel(key)
+
+    if records['step']:
+        axs[-1].plot([record['step'] for record in records['step']], [record['loss'] for record in records['step']], linestyle='-')
+        axs[-1].set_xlabel('Steps')
+        axs[-1].set_ylabel('Training Loss')
+
+    title = records['run'][-1]['model_name'] if records['run'] else metrics_path
+    axs[0].set_title(f'Training Metrics {title}')
+    fig.tight_layout()
+
+    if save_path is not None:
+        fig.savefig(save_path)
+        plt.close(fig)
+    else:
+        plt.show()
+
 ###############################################
 ############### Evaluation ####################
 ###############################################
@@ -242,9 +296,12 @@ def capture_model_metrics_pixelwise_and_confusion_matrix_sf(model, test_dataset_
     '''
     Description: Predicts Mask and Calculate the IoU and Dice Score of each image within a dataset for all data sources. Individually output 
     those scores for each individual class.
-    Input: Model, Test Dataset, Data Source (String)
+    Input: Model, Test Dataset, Data Source (String, None to take the model inputs from the model registry)
     Ouput: Intersection List, Union List, Dice Num List, Dice Denom List
     '''
+    input_source = model if data_source is None else data_source
+    data_source = model_data_source(input_source)
+
     test_ds_union = [0,0,0,0,0,0,0,0,0,0]
     test_ds_intersection = [0,0,0,0,0,0,0,0,0,0]
     test_ds_numerator = [0,0,0,0,0,0,0,0,0,0]
@@ -262,32 +319,13 @@ def capture_model_metrics_pixelwise_and_confusion_matrix_sf(model, test_dataset_
 
             rgb_img, hsi_img, mask = batch
 
-            # model prediction
-            if data_source=='rgb':
-                rgb_img = rgb_img.to(DEVICE).unsqueeze(0)
-                mask = mask.to(DEVICE)
-
-                softmax = nn.Softmax(dim=1)
-
-                preds = torch.argmax(softmax(model(rgb_img.float())),axis=1).to('cpu').squeeze(0)
-
-            if data_source=='hsi':
-                hsi_img = hsi_img.to(DEVICE).unsqueeze(0)
-                mask = mask.to(DEVICE)
+            # model prediction, only the inputs the model needs are put onto the device
+            model_inputs = select_model_inputs(rgb_img.unsqueeze(0), hsi_img.unsqueeze(0), input_source)
+            mask = mask.to(DEVICE)
 
-                softmax = nn.Softmax(dim=1)
+            softmax = nn.Softmax(dim=1)
 
-                preds = torch.argmax(softmax(model(hsi_img.float())),axis=1).to('cpu').squeeze(0)
-
-            elif data_source=='sf':
-
-                rgb_img = rgb_img.to(DEVICE).unsqueeze(0)
-                hsi_img = hsi_img.to(DEVICE).unsqueeze(0)
-                mask = mask.to(DEVICE)
-
-                softmax = nn.Softmax(dim=1)
-
-                preds = torch.argmax(softmax(model(rgb_img.float(), hsi_img)),axis=1).to('cpu').squeeze(0)
+            preds = torch.argmax(softmax(model(*model_inputs)),axis=1).to('cpu').squeeze(0)
 
             # convert torch tensor to numpy array
             prediction_all_images[:,:,n] = preds.numpy()
@@ -476,30 +514,23 @@ def dice_values_all_classes(truth_mask, pred_mask, N_CLASS=N_CLASSES, print_dice
 
     return numinator_list, denominator_list
 
-def calculate_model_inference_time(model, batch, data_source):
+def calculate_model_inference_time(model, batch, data_source=None):
     '''
-    Description: Calculates a model's inference time averaged over a data loader batch. 
-    Input: Model, Batch, Data source
+    Description: Calculates a model's inference time averaged over a data loader batch. Only the inputs the model needs are put
+    onto the device.
+    Input: Model, Batch, Data source (None to take the model inputs from the model registry)
     '''
     model = model.to(DEVICE)
 
     # Here implement division by batch size
     rgb_img, hsi_img, mask = next(iter(batch))
-    rgb_img = rgb_img.to(DEVICE)
-    hsi_img = hsi_img.to(DEVICE)
+    model_inputs = select_model_inputs(rgb_img, hsi_img, model if data_source is None else data_source)
     print(rgb_img.shape)
     model.eval()
     with torch.no_grad():
         start_time = time.time()
 
-        if data_source == 'sf':
-            _ = model(rgb_img.float(), hsi_img)
-
-        elif data_source == 'hsi':
-            _ = model(hsi_img)
-
-        elif data_source == 'rgb':
-            _ = model(rgb_img.float())
+        _ = model(*model_inputs)
 
         end_time = time.time()
         
@@ -509,4 +540,164 @@ def calculate_model_inference_time(model, batch, data_source):
     print(f' Single Image Inference Time: {inference_time/rgb_img.shape[0]}s')
 
     return inference_time/rgb_img.shape[0]
-    
+
+def measure_model_latency(model, model_inputs, n_warmup=3, n_runs=10):
+    '''
+    Description: Measures the average latency of a single forward pass. Warm up runs are not timed and the device is
+    synchronized before the time is taken, so the result is not distorted by asynchronous CUDA kernels.
+    Input: Model, Model Inputs (Tuple of Torch Tensors on the model's device), Number of Warm Up Runs, Number of Timed Runs
+    Output: Average Latency per Forward Pass in Seconds
+    '''
+    model.eval()
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            _ = model(*model_inputs)
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+
+        for _ in range(n_runs):
+            _ = model(*model_inputs)
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        end_time = time.perf_counter()
+
+    return (end_time - start_time) / n_runs
+
+
+def count_model_parameters(model):
+    '''
+    Description: Counts the number of parameters of a model.
+    Input: Model
+    Output: Number of Parameters (Int)
+    '''
+    return sum(p.numel() for p in model.parameters())
+
+def count_model_flops(model, model_inputs):
+    '''
+    Description: Counts the FLOPs of a single forward pass (2 FLOPs per multiply-accumulate) of all Conv and ConvTranspose
+    layers, which make up nearly the entire compute of the UNet models. Counted with forward hooks, so the model is run once.
+    Input: Model, Model Inputs (Tuple of Torch Tensors on the model's device)
+    Output: Number of FLOPs (Int)
+    '''
+    flops = []
+
+    def conv_hook(module, inputs, output):
+        kernel_ops = module.kernel_size[0] * module.kernel_size[1] * module.in_channels // module.groups
+        flops.append(2 * output.numel() * kernel_ops)
+
+    def tconv_hook(module, inputs, output):
+        kernel_ops = module.kernel_size[0] * module.kernel_size[1] * module.out_channels // module.groups
+        flops.append(2 * inputs[0].numel() * kernel_ops)
+
+    hooks = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            hooks.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.ConvTranspose2d):
+            hooks.append(module.register_forward_hook(tconv_hook))
+
+    model.eval()
+    with torch.no_grad():
+        _ = model(*model_inputs)
+
+    for hook in hooks:
+        hook.remove()
+
+    return sum(flops)
+
+def measure_model_memory(model, model_inputs):
+    '''
+    Description: Measures the memory of a single forward pass without gradients. On CUDA this is the peak allocated memory
+    during the forward pass (without the memory allocated before). On the CPU, where no allocator statistics are available,
+    the summed size of all layer outputs is used, which is an upper bound of the activation memory.
+    Input: Model, Model Inputs (Tuple of Torch Tensors on the model's device)
+    Output: Memory in Bytes (Int)
+    '''
+    model.eval()
+    device = model_inputs[0].device
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        start_memory = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        with torch.no_grad():
+            _ = model(*model_inputs)
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated(device) - start_memory
+
+    output_bytes = []
+    def output_hook(module, inputs, output):
+        if isinstance(output, torch.Tensor):
+            output_bytes.append(output.numel() * output.element_size())
+
+    hooks = [module.register_forward_hook(output_hook) for module in model.modules() if len(list(module.children())) == 0]
+    with torch.no_grad():
+        _ = model(*model_inputs)
+    for hook in hooks:
+        hook.remove()
+
+    return sum(output_bytes)
+
+def _class_loop_dice_loss(dice_loss_fn, inputs, target):
+    '''
+    Description: Reference Dice Loss with one comparison and one reduction per class and a host sync per class (.item()),
+    as it was computed before the vectorised DiceLoss. Only used by dice_loss_benchmark.
+    '''
+    inputs = torch.softmax(inputs, dim=1)
+    loss = 0.0
+    class_wise_dice = []
+    for i in range(dice_loss_fn.n_classes):
+        score = inputs[:, i]
+        class_target = (target == i).float()
+        intersect = torch.sum(score * class_target)
+        y_sum = torch.sum(class_target * class_target)
+        z_sum = torch.sum(score * score)
+        dice = 1 - (2 * intersect + 1e-5) / (z_sum + y_sum + 1e-5)
+        class_wise_dice.append(1.0 - dice.item())
+        loss += dice
+    return loss / dice_loss_fn.n_classes
+
+def dice_loss_benchmark(n_classes=N_CLASSES, batch_size=8, image_size=(320,320), n_warmup=3, n_runs=20, device=DEVICE):
+    '''
+    Description: Micro benchmark of the Dice Loss on random logits and masks. Times forward and backward pass of the vectorised
+    DiceLoss against the per class loop reference and checks that both give the same loss and gradients.
+    Input: Number of Classes, Batch Size, Image Size (Tuple), Number of Warm Up Runs, Number of Timed Runs, Device
+    Output: Dictionary with Time per Call in Seconds ('loop', 'vectorised'), Speedup and Max Absolute Difference of Loss and Gradients
+    '''
+    dice_loss_fn = DiceLoss(n_classes)
+    logits = torch.randn(batch_size, n_classes, *image_size, device=device, requires_grad=True)
+    target = torch.randint(0, n_classes, (batch_size, *image_size), device=device)
+
+    def run(loss_fn):
+        logits.grad = None
+        loss = loss_fn(logits, target)
+        loss.backward()
+        return loss.detach(), logits.grad.clone()
+
+    def timed(loss_fn):
+        for _ in range(n_warmup):
+            run(loss_fn)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        for _ in range(n_runs):
+            run(loss_fn)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start_time) / n_runs
+
+    loop_loss, loop_grad = run(lambda x, y: _class_loop_dice_loss(dice_loss_fn, x, y))
+    vectorised_loss, vectorised_grad = run(dice_loss_fn)
+
+    results = {'loop': timed(lambda x, y: _class_loop_dice_loss(dice_loss_fn, x, y)),
+               'vectorised': timed(dice_loss_fn),
+               'loss_difference': (loop_loss - vectorised_loss).abs().item(),
+               'grad_difference': (loop_grad - vectorised_grad).abs().max().item()}
+    results['speedup'] = results['loop'] / results['vectorised']
+
+    print(f"Dice Loss loop: {results['loop']*1000:.2f}ms, vectorised: {results['vectorised']*1000:.2f}ms, speedup: {results['speedup']:.2f}x")
+    print(f"Max difference loss: {results['loss_difference']:.2e}, gradients: {results['grad_difference']:.2e}")
+    return results